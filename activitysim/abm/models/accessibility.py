@@ -80,7 +80,7 @@ class AccessibilitySkims(object):
         skim['DISTANCE'] or skim[('SOVTOLL_TIME', 'MD')]
         """
 
-        data = self.skim_dict.get(key).data
+        data = self.skim_dict.get(key).decoded_data()
 
         if self.transpose:
             data = data.transpose()
@@ -7,6 +7,7 @@ install_aliases()  # noqa: E402
 
 import logging
 
+import numpy as np
 import pandas as pd
 
 from activitysim.core import simulate
@@ -97,17 +98,122 @@ def get_tour_satisfaction(candidates, participate):
     return satisfaction
 
 
+def satisfying_participation(candidates, participate_probs, rands):
+    """
+    Draw participation choices for candidates of joint tours from the distribution of their
+    independent participation choices conditional on every tour being satisfied (see
+    get_tour_satisfaction) without resorting to rejection sampling.
+
+    Adults and children tours need at least 2 participants and mixed tours need at least one
+    adult and one child, so we track each tour's outstanding requirement as a pair of counts
+    (participants or adults still needed, children still needed) which are at most (2, 1).
+
+    Working backwards through each tour's candidates, we compute the probability that the
+    candidates from there on could satisfy every possible outstanding requirement. Then,
+    working forwards, each candidate participates with its probability conditional on the
+    remaining candidates being able to satisfy what is still needed. Both are a single
+    vectorized pass per candidate position (i.e. household size) rather than per iteration.
+
+    Parameters
+    ----------
+    candidates : pandas.DataFrame
+        with tour_id, composition and adult columns
+    participate_probs : numpy.ndarray
+        unconditional probability that each candidate participates
+    rands : numpy.ndarray
+        one random number per candidate
+
+    Returns
+    -------
+    participate : numpy.ndarray of bool
+        in same order as candidates
+    """
+
+    # - sort by tour, keeping candidates in original order within tour
+    order = np.argsort(candidates.tour_id.values, kind='mergesort')
+    tour_ids = candidates.tour_id.values[order]
+    p = participate_probs[order]
+    mixed = (candidates.composition.values == 'mixed')[order]
+    adult = candidates.adult.values.astype(bool)[order]
+
+    num_candidates = len(tour_ids)
+    first = np.r_[True, tour_ids[1:] != tour_ids[:-1]]
+    last = np.r_[tour_ids[1:] != tour_ids[:-1], True]
+    tour_start = np.flatnonzero(first)
+    position = np.arange(num_candidates) - \
+        np.repeat(tour_start, np.diff(np.r_[tour_start, num_candidates]))
+
+    # amount each candidate's participation counts towards its tour's outstanding requirement
+    need1_step = np.where(mixed, adult, True).astype(int)
+    need2_step = (mixed & ~adult).astype(int)
+
+    # row of the next candidate of the same tour (or the terminal row if last candidate of tour)
+    next_row = np.where(last, num_candidates, np.arange(num_candidates) + 1)
+
+    # satisfiable[i, n1, n2] is probability candidates i.. of tour can satisfy requirement (n1, n2)
+    # terminal row (after last candidate) can only satisfy requirement that has been met
+    satisfiable = np.zeros((num_candidates + 1, 3, 2))
+    satisfiable[num_candidates, 0, 0] = 1.0
+
+    need1 = np.arange(3)[None, :, None]
+    need2 = np.arange(2)[None, None, :]
+    positions = [np.flatnonzero(position == k) for k in range(position.max() + 1)]
+
+    for rows in reversed(positions):
+        nxt = next_row[rows][:, None, None]
+        pr = p[rows][:, None, None]
+        need1_if = np.maximum(need1 - need1_step[rows][:, None, None], 0)
+        need2_if = np.maximum(need2 - need2_step[rows][:, None, None], 0)
+        satisfiable[rows] = \
+            pr * satisfiable[nxt, need1_if, need2_if] + (1 - pr) * satisfiable[nxt, need1, need2]
+
+    # outstanding requirement of each candidate's tour
+    tour_num = np.cumsum(first) - 1
+    need1_left = np.where(mixed[first], 1, 2)
+    need2_left = np.where(mixed[first], 1, 0)
+
+    unsatisfiable = satisfiable[tour_start, need1_left, need2_left] <= 0
+    if unsatisfiable.any():
+        bad_tours = tour_ids[tour_start][unsatisfiable]
+        raise RuntimeError("%s joint tours can't be satisfied by their candidates, e.g. %s" %
+                           (len(bad_tours), bad_tours[:10]))
+
+    sorted_rands = rands[order]
+    participate = np.zeros(num_candidates, dtype=bool)
+    for rows in positions:
+        t = tour_num[rows]
+        n1, n2 = need1_left[t], need2_left[t]
+        n1_if = np.maximum(n1 - need1_step[rows], 0)
+        n2_if = np.maximum(n2 - need2_step[rows], 0)
+        nxt = next_row[rows]
+        conditional_prob = \
+            p[rows] * satisfiable[nxt, n1_if, n2_if] / satisfiable[rows, n1, n2]
+        chosen = sorted_rands[rows] < conditional_prob
+        participate[rows] = chosen
+        need1_left[t] = np.where(chosen, n1_if, n1)
+        need2_left[t] = np.where(chosen, n2_if, n2)
+
+    assert (need1_left == 0).all() and (need2_left == 0).all()
+
+    # back in original candidates order
+    result = np.empty(num_candidates, dtype=bool)
+    result[order] = participate
+    return result
+
+
 def participants_chooser(probs, choosers, spec, trace_label):
     """
     custom alternative to logit.make_choices for simulate.simple_simulate
 
     Choosing participants for mixed tours is trickier than adult or child tours becuase we
-    need at least one adult and one child participant in a mixed tour. We call logit.make_choices
-    and then check to see if the tour statisfies this requirement, and rechoose for any that
-    fail until all are satisfied.
+    need at least one adult and one child participant in a mixed tour (and adult and child tours
+    need at least two participants.)
 
-    In principal, this shold always occur eventually, but we fail after MAX_ITERATIONS,
-    just in case there is some failure in program logic (haven't seen this occur.)
+    We call logit.make_choices, and keep the choices for tours that satisfy their requirements.
+    Participation for candidates of the remaining tours is then drawn directly from the
+    distribution of their choices conditional on their tour being satisfied (see
+    satisfying_participation), which is the distribution we would eventually get by redrawing
+    choices for unsatisfied tours until they were all satisfied, without the redrawing.
 
     Parameters
     ----------
@@ -138,66 +244,44 @@ def participants_chooser(probs, choosers, spec, trace_label):
     choice_col = model_settings.get('participation_choice', 'participate')
     assert choice_col in spec.columns, \
         "couldn't find participation choice column '%s' in spec"
+    assert len(spec.columns) == 2
     PARTICIPATE_CHOICE = spec.columns.get_loc(choice_col)
-    MAX_ITERATIONS = model_settings.get('max_participation_choice_iterations', 5000)
+    NOT_PARTICIPATE_CHOICE = 1 - PARTICIPATE_CHOICE
 
     trace_label = tracing.extend_trace_label(trace_label, 'participants_chooser')
 
-    candidates = choosers.copy()
-    choices_list = []
-    rands_list = []
-
-    num_tours_remaining = len(candidates.tour_id.unique())
-    logger.info('%s %s joint tours to satisfy.', trace_label, num_tours_remaining,)
-
-    iter = 0
-    while candidates.shape[0] > 0:
-
-        iter += 1
-
-        if iter > MAX_ITERATIONS:
-            logger.warning('%s max iterations exceeded (%s).', trace_label, MAX_ITERATIONS)
-            diagnostic_cols = ['tour_id', 'household_id', 'composition', 'adult']
-            unsatisfied_candidates = candidates[diagnostic_cols].join(probs)
-            tracing.write_csv(unsatisfied_candidates,
-                              file_name='%s.UNSATISFIED' % trace_label, transpose=False)
-            print(unsatisfied_candidates.head(20))
-            assert False
+    num_tours = len(choosers.tour_id.unique())
+    logger.info('%s %s joint tours to satisfy.', trace_label, num_tours,)
 
-        choices, rands = logit.make_choices(probs, trace_label=trace_label, trace_choosers=choosers)
-        participate = (choices == PARTICIPATE_CHOICE)
-
-        # satisfaction indexed by tour_id
-        tour_satisfaction = get_tour_satisfaction(candidates, participate)
-        num_tours_satisfied_this_iter = tour_satisfaction.sum()
-
-        if num_tours_satisfied_this_iter > 0:
+    choices, rands = logit.make_choices(probs, trace_label=trace_label, trace_choosers=choosers)
+    participate = (choices == PARTICIPATE_CHOICE)
 
-            num_tours_remaining -= num_tours_satisfied_this_iter
+    # satisfaction indexed by tour_id
+    tour_satisfaction = get_tour_satisfaction(choosers, participate)
+    unsatisfied = ~reindex(tour_satisfaction, choosers.tour_id).values
 
-            satisfied = reindex(tour_satisfaction, candidates.tour_id)
+    logger.info('%s %s joint tours satisfied by first choice, %s drawn conditionally' %
+                (trace_label, tour_satisfaction.sum(), num_tours - tour_satisfaction.sum()))
 
-            choices_list.append(choices[satisfied])
-            rands_list.append(rands[satisfied])
+    if unsatisfied.any():
 
-            # remove candidates of satisfied tours
-            probs = probs[~satisfied]
-            candidates = candidates[~satisfied]
+        unsatisfied_candidates = choosers[unsatisfied]
+        redraw_rands = pipeline.get_rn_generator().random_for_df(unsatisfied_candidates)
 
-        logger.info('%s iteration %s : %s joint tours satisfied %s remaining' %
-                    (trace_label, iter, num_tours_satisfied_this_iter, num_tours_remaining,))
+        redraw_participate = satisfying_participation(
+            unsatisfied_candidates,
+            probs.values[unsatisfied, PARTICIPATE_CHOICE],
+            redraw_rands.ravel())
 
-    choices = pd.concat(choices_list)
-    rands = pd.concat(rands_list).reindex(choosers.index)
+        choices = choices.copy()
+        choices[unsatisfied] = \
+            np.where(redraw_participate, PARTICIPATE_CHOICE, NOT_PARTICIPATE_CHOICE)
+        rands = rands.copy()
+        rands[unsatisfied] = redraw_rands.ravel()
 
-    # reindex choices and rands to match probs and v index
-    choices = choices.reindex(choosers.index)
-    rands = rands.reindex(choosers.index)
     assert choices.index.equals(choosers.index)
     assert rands.index.equals(choosers.index)
 
-    logger.info('%s %s iterations to satisfy all joint tours.', trace_label, iter,)
-
     return choices, rands
 
 
@@ -73,6 +73,9 @@ With shadow pricing, and iterative treatment of each segment, the structure of t
             run_location_logsums
             run_location_simulate
     until convergence
+
+(If shadow_pricing REUSE_LOCATION_SAMPLE is True, run_location_sample and run_location_logsums
+are only run on the first iteration, see run_location_choice.)
 """
 
 logger = logging.getLogger(__name__)
@@ -291,18 +294,61 @@ def run_location_simulate(
     return choices
 
 
+def changed_sample_choosers(location_sample_df, dest_size_terms, last_dest_size_terms,
+                            alt_dest_col_name):
+    """
+    Return index of choosers with any sampled alternative whose size term or shadow price
+    adjustment has changed since last_dest_size_terms
+
+    Parameters
+    ----------
+    location_sample_df : pandas.DataFrame
+        location sample indexed by chooser id (with one row per sampled alternative)
+    dest_size_terms : pandas.DataFrame
+        current size terms and shadow price adjustments (one row per zone)
+    last_dest_size_terms : pandas.DataFrame
+        dest_size_terms used when the choices being replaced were simulated
+    alt_dest_col_name : str
+        name of location_sample_df column with alternative zone id
+
+    Returns
+    -------
+    pandas.Index
+        (unique) chooser ids
+    """
+
+    assert dest_size_terms.index.equals(last_dest_size_terms.index)
+
+    last_dest_size_terms = last_dest_size_terms[dest_size_terms.columns]
+
+    changed_zones = \
+        dest_size_terms.index[(dest_size_terms.values != last_dest_size_terms.values).any(axis=1)]
+
+    changed = location_sample_df[alt_dest_col_name].isin(changed_zones)
+
+    return location_sample_df.index[changed].unique()
+
+
 def run_location_choice(
         persons_merged_df,
         skim_dict, skim_stack,
         spc,
         model_settings,
-        chunk_size, trace_hh_id, trace_label
+        chunk_size, trace_hh_id, trace_label,
+        sample_cache=None
         ):
     """
     Run the three-part location choice algorithm to generate a location choice for each chooser
 
     Handle the various segments separately and in turn for simplicity of expression files
 
+    If sample_cache is not None, the location sample (annotated with logsums), dest_size_terms
+    and choices for each segment are saved in it, and if they were saved by a previous shadow
+    price iteration, the sample and logsums are reused rather than recomputed. Since only
+    size terms and shadow prices change between iterations, only choosers with a sampled
+    alternative whose size term adjustment changed are re-simulated, and the rest keep their
+    previous choice.
+
     Parameters
     ----------
     persons_merged_df : pandas.DataFrame
@@ -315,6 +361,8 @@ def run_location_choice(
     chunk_size : int
     trace_hh_id : int
     trace_label : str
+    sample_cache : dict or None
+        {<segment_name>: (<location_sample_df>, <dest_size_terms>, <choices>)}
 
     Returns
     -------
@@ -323,6 +371,7 @@ def run_location_choice(
     """
 
     chooser_segment_column = model_settings['CHOOSER_SEGMENT_COLUMN_NAME']
+    alt_dest_col_name = model_settings["ALT_DEST_COL_NAME"]
 
     # maps segment names to compact (integer) ids
     segment_ids = model_settings['SEGMENT_IDS']
@@ -339,45 +388,86 @@ def run_location_choice(
             logger.info("%s skipping segment %s: no choosers", trace_label, segment_name)
             continue
 
-        # - location_sample
-        location_sample_df = \
-            run_location_sample(
-                segment_name,
-                choosers,
-                skim_dict,
-                dest_size_terms,
-                model_settings,
-                chunk_size,
-                tracing.extend_trace_label(trace_label, 'sample.%s' % segment_name))
-
-        # - location_logsums
-        location_sample_df = \
-            run_location_logsums(
-                segment_name,
-                choosers,
-                skim_dict, skim_stack,
-                location_sample_df,
-                model_settings,
-                chunk_size,
-                trace_hh_id,
-                tracing.extend_trace_label(trace_label, 'logsums.%s' % segment_name))
+        cached = sample_cache.get(segment_name) if sample_cache is not None else None
+
+        if cached is None:
+
+            # - location_sample
+            location_sample_df = \
+                run_location_sample(
+                    segment_name,
+                    choosers,
+                    skim_dict,
+                    dest_size_terms,
+                    model_settings,
+                    chunk_size,
+                    tracing.extend_trace_label(trace_label, 'sample.%s' % segment_name))
+
+            # - location_logsums
+            location_sample_df = \
+                run_location_logsums(
+                    segment_name,
+                    choosers,
+                    skim_dict, skim_stack,
+                    location_sample_df,
+                    model_settings,
+                    chunk_size,
+                    trace_hh_id,
+                    tracing.extend_trace_label(trace_label, 'logsums.%s' % segment_name))
+
+            simulate_choosers = choosers
+            simulate_sample_df = location_sample_df
+            last_choices = None
+
+        else:
+
+            # - reuse location_sample and logsums, and only re-simulate choosers with changes
+            location_sample_df, last_dest_size_terms, last_choices = cached
+
+            # interaction_sample would have added the zone id column, which run_location_simulate
+            # needs merged into alternatives so the chooser zone column is suffixed (TAZ_chooser)
+            dest_size_terms[dest_size_terms.index.name] = dest_size_terms.index
+
+            changed_choosers = \
+                changed_sample_choosers(location_sample_df, dest_size_terms,
+                                        last_dest_size_terms, alt_dest_col_name)
+
+            logger.info("%s segment %s re-simulating %s of %s choosers with changed size terms" %
+                        (trace_label, segment_name, len(changed_choosers), len(choosers)))
+
+            simulate_choosers = choosers[choosers.index.isin(changed_choosers)]
+            simulate_sample_df = \
+                location_sample_df[location_sample_df.index.isin(changed_choosers)]
 
         # - location_simulate
-        choices = \
-            run_location_simulate(
-                segment_name,
-                choosers,
-                location_sample_df,
-                skim_dict,
-                dest_size_terms,
-                model_settings,
-                chunk_size,
-                tracing.extend_trace_label(trace_label, 'simulate.%s' % segment_name))
+        if simulate_choosers.shape[0] > 0:
+            choices = \
+                run_location_simulate(
+                    segment_name,
+                    simulate_choosers,
+                    simulate_sample_df,
+                    skim_dict,
+                    dest_size_terms,
+                    model_settings,
+                    chunk_size,
+                    tracing.extend_trace_label(trace_label, 'simulate.%s' % segment_name))
+
+            if last_choices is not None:
+                # choosers not re-simulated keep their previous choice
+                last_choices = last_choices.copy()
+                last_choices.loc[choices.index] = choices
+                choices = last_choices
+        else:
+            choices = last_choices
+
+        if sample_cache is not None:
+            sample_cache[segment_name] = (location_sample_df, dest_size_terms, choices)
 
         choices_list.append(choices)
 
         # FIXME - want to do this here?
         del location_sample_df
+        del simulate_sample_df
         force_garbage_collect()
 
     return pd.concat(choices_list) if len(choices_list) > 0 else pd.Series()
@@ -428,6 +518,9 @@ def iterate_location_choice(
 
     logging.debug("%s max_iterations: %s" % (trace_label, max_iterations))
 
+    # location samples (with logsums) to reuse in later iterations if REUSE_LOCATION_SAMPLE
+    sample_cache = {} if spc.reuse_location_sample else None
+
     choices = None
     for iteration in range(1, max_iterations + 1):
 
@@ -440,7 +533,8 @@ def iterate_location_choice(
             spc,
             model_settings,
             chunk_size, trace_hh_id,
-            trace_label=tracing.extend_trace_label(trace_label, 'i%s' % iteration))
+            trace_label=tracing.extend_trace_label(trace_label, 'i%s' % iteration),
+            sample_cache=sample_cache)
 
         choices_df = choices.to_frame('dest_choice')
         choices_df['segment_id'] = \
@@ -7,6 +7,7 @@ install_aliases()  # noqa: E402
 from builtins import range
 
 import logging
+import multiprocessing
 
 import numpy as np
 import pandas as pd
@@ -16,6 +17,7 @@ from activitysim.core import config
 from activitysim.core import pipeline
 from activitysim.core import simulate
 from activitysim.core import inject
+from activitysim.core import spec_compiler
 
 from activitysim.core.tracing import print_elapsed_time
 
@@ -108,6 +110,31 @@ def trip_destination_sample(
     return destination_sample
 
 
+def ood_logsum_key_columns(choosers, logsum_settings, logsum_spec, od_skims, locals_dict):
+    """
+    Return list of the choosers columns that out-of-direction logsums can depend on,
+    or None if they might depend on other chooser attributes (or we can't tell)
+
+    These are the (pre-annotation) chooser columns referenced by the logsum spec and preprocessor
+    expressions, and the od_skims keys (e.g. origin, destination, and trip_period)
+    """
+
+    names = spec_compiler.compile_spec(logsum_spec.index).referenced_names(locals_dict)
+
+    if names is not None:
+        preprocessor_names = expressions.preprocessor_referenced_names(
+            logsum_settings.get('preprocessor'), locals_dict)
+        names = None if preprocessor_names is None else names | preprocessor_names
+
+    # can't dedupe if expressions might reference the index (e.g. df.index or trip_id)
+    if names is None or 'index' in names or choosers.index.name in names:
+        return None
+
+    names = names | simulate.skim_wrapper_columns(od_skims)
+
+    return [c for c in choosers.columns if c in names]
+
+
 def compute_ood_logsums(
         choosers,
         logsum_settings,
@@ -119,17 +146,44 @@ def compute_ood_logsums(
     Compute one (of two) out-of-direction logsums for destination alternatives
 
     Will either be trip_origin -> alt_dest or alt_dest -> primary_dest
+
+    Unless the dedupe_logsums setting is False, logsums (and preprocessor annotations) are only
+    computed once for each distinct set of values of the choosers columns they depend on
+    (see ood_logsum_key_columns) and then broadcast back to the choosers. Since there are
+    sample_size destination_sample rows for every trip, and trips on the same tour share
+    purpose, primary_dest and chooser attributes, keys repeat a lot, especially for dp logsums.
     """
 
     locals_dict.update(od_skims)
 
+    logsum_spec = simulate.read_model_spec(file_name=logsum_settings['SPEC'])
+
+    # traced choosers need their own logsums so we don't dedupe if there are trace targets
+    group_ids = None
+    if config.setting('dedupe_logsums', True) and not tracing.has_trace_targets(choosers):
+
+        key_columns = ood_logsum_key_columns(choosers, logsum_settings, logsum_spec,
+                                             od_skims, locals_dict)
+        if key_columns is not None:
+            unique_choosers, group_ids = \
+                simulate.dedupe_logsum_choosers(choosers, logsum_spec, od_skims, key_columns)
+
+            if group_ids is not None:
+                logger.debug("%s dedupe ood logsums for %s choosers to %s" %
+                             (trace_label, len(choosers), len(unique_choosers)))
+                chooser_index = choosers.index
+                choosers = unique_choosers
+
+            # annotate a narrow copy rather than adding preprocessor columns to caller's choosers
+            # (which would otherwise look like key columns when computing the other ood logsum)
+            choosers = choosers[key_columns].copy()
+
     expressions.annotate_preprocessors(
         choosers, locals_dict, od_skims,
         logsum_settings,
         trace_label)
 
     nest_spec = config.get_logit_model_settings(logsum_settings)
-    logsum_spec = simulate.read_model_spec(file_name=logsum_settings['SPEC'])
 
     logsums = simulate.simple_simulate_logsums(
         choosers,
@@ -145,6 +199,9 @@ def compute_ood_logsums(
     # FIXME not strictly necessary, but would make trace files more legible?
     # logsums = logsums.replace(-np.inf, -999)
 
+    if group_ids is not None:
+        logsums = pd.Series(logsums.values[group_ids], index=chooser_index)
+
     return logsums
 
 
@@ -351,6 +408,111 @@ def choose_trip_destination(
     return destinations
 
 
+# (segment_args, kwargs) for choose_trip_destination_segments worker processes to inherit on fork
+_SEGMENT_ARGS = None
+
+
+def _choose_trip_destination_segment(i):
+    """
+    worker process function for choose_trip_destination_segments
+
+    Returns
+    -------
+    destinations : pandas.Series
+        choose_trip_destination result for the i-th segment
+    offsets : 1-D ndarray
+        random stream offsets for the segment trips after making its choices
+    """
+
+    segment_args, kwargs = _SEGMENT_ARGS
+    primary_purpose, trips_segment, trace_label = segment_args[i]
+
+    destinations = choose_trip_destination(primary_purpose, trips_segment,
+                                           trace_label=trace_label, **kwargs)
+    offsets = pipeline.get_rn_generator().get_row_offsets(trips_segment)
+
+    return destinations, offsets
+
+
+def choose_trip_destination_segments(
+        nth_trips,
+        alternatives,
+        tours_merged,
+        model_settings,
+        size_term_matrix, skims,
+        chunk_size, trace_hh_id,
+        trace_label):
+    """
+    Run choose_trip_destination for each primary_purpose segment of nth_trips
+
+    If SEGMENT_PROCESSES model setting is greater than 1, segments are run concurrently in a
+    pool of forked worker processes (which inherit skims and other large read-only data from
+    the parent without copying.) Since each trip belongs to exactly one segment, the random
+    draws made for a segment only depend on the stream offsets of the segment's own trips.
+    So the workers return the updated offsets along with their choices, and these are set
+    in the parent's channel, which leaves the rng in the same state (and the results the same)
+    as a sequential run.
+
+    Returns
+    -------
+    destinations : pandas.Series
+        chosen destination for nth_trips with viable destination alternatives
+    """
+
+    global _SEGMENT_ARGS
+
+    segment_args = \
+        [(primary_purpose, trips_segment, tracing.extend_trace_label(trace_label, primary_purpose))
+         for primary_purpose, trips_segment in nth_trips.groupby('primary_purpose')]
+
+    kwargs = dict(
+        alternatives=alternatives,
+        tours_merged=tours_merged,
+        model_settings=model_settings,
+        size_term_matrix=size_term_matrix, skims=skims,
+        chunk_size=chunk_size, trace_hh_id=trace_hh_id)
+
+    num_processes = min(model_settings.get('SEGMENT_PROCESSES', 0), len(segment_args))
+
+    # trace files are written in segment order, so we don't fork when tracing
+    if num_processes > 1 and trace_hh_id:
+        logger.info("%s running segments sequentially because tracing is on", trace_label)
+        num_processes = 0
+
+    if num_processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning("%s running segments sequentially because fork is not available",
+                       trace_label)
+        num_processes = 0
+
+    if num_processes <= 1:
+        choices_list = [
+            choose_trip_destination(primary_purpose, trips_segment,
+                                    trace_label=segment_trace_label, **kwargs)
+            for primary_purpose, trips_segment, segment_trace_label in segment_args]
+        return pd.concat(choices_list)
+
+    logger.info("%s running %s segments in %s processes",
+                trace_label, len(segment_args), num_processes)
+
+    _SEGMENT_ARGS = (segment_args, kwargs)
+    try:
+        pool = multiprocessing.get_context('fork').Pool(num_processes)
+        try:
+            results = pool.map(_choose_trip_destination_segment, range(len(segment_args)), 1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _SEGMENT_ARGS = None
+
+    # bring parent rng up to date with the draws made in the worker processes
+    rng = pipeline.get_rn_generator()
+    for (_, trips_segment, _), (_, offsets) in zip(segment_args, results):
+        rng.set_row_offsets(trips_segment, offsets)
+
+    return pd.concat([destinations for destinations, _ in results])
+
+
 def wrap_skims(model_settings):
     """
     wrap skims of trip destination using origin, dest column names from model settings.
@@ -488,21 +650,14 @@ def run_trip_destination(
             logger.info("Running %s with %d trips", nth_trace_label, nth_trips.shape[0])
 
             # - choose destination for nth_trips, segmented by primary_purpose
-            choices_list = []
-            for primary_purpose, trips_segment in nth_trips.groupby('primary_purpose'):
-                choices = choose_trip_destination(
-                    primary_purpose,
-                    trips_segment,
-                    alternatives,
-                    tours_merged,
-                    model_settings,
-                    size_term_matrix, skims,
-                    chunk_size, trace_hh_id,
-                    trace_label=tracing.extend_trace_label(nth_trace_label, primary_purpose))
-
-                choices_list.append(choices)
-
-            destinations = pd.concat(choices_list)
+            destinations = choose_trip_destination_segments(
+                nth_trips,
+                alternatives,
+                tours_merged,
+                model_settings,
+                size_term_matrix, skims,
+                chunk_size, trace_hh_id,
+                trace_label=nth_trace_label)
 
             failed_trip_ids = nth_trips.index.difference(destinations.index)
             if failed_trip_ids.any():
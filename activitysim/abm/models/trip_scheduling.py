@@ -11,7 +11,6 @@ import logging
 import numpy as np
 import pandas as pd
 
-from activitysim.core import logit
 from activitysim.core import config
 from activitysim.core import inject
 from activitysim.core import tracing
@@ -36,7 +35,6 @@ tourpurp,isInbound,interval,trip,p1,p2,p3,p4,p5...p40
 
 """
 
-NO_TRIP_ID = 0
 NO_DEPART = 0
 
 DEPART_ALT_BASE = 'DEPART_ALT_BASE'
@@ -88,50 +86,108 @@ def set_tour_hour(trips, tours):
         reindex(subtours[subtours.tour_num == subtours.tour_count]['end'], trips[inbound].tour_id)
 
 
-def clip_probs(trips, probs, model_settings):
+def schedule_departs(probs, earliest, latest, leg_length, rands, outbound, depart_alt_base,
+                     choose_most_initial=False):
     """
-    zero out probs before trips.earliest or after trips.latest
+    Choose depart periods for the trips of any number of legs at once.
+
+    Trips must be sorted by leg, and within leg in the order they are to be scheduled (i.e. by
+    distance from the leg's unscheduled initial trip) so that the nth trip of every leg is at a
+    fixed offset from the start of its leg. We step along the legs one position at a time,
+    scheduling the nth trips of all legs as a single array operation, with each choice becoming
+    the earliest (outbound) or latest (inbound) depart allowed for the next trip in its leg.
 
     Parameters
     ----------
-    trips: pd.DataFrame
-    probs: pd.DataFrame
+    probs : numpy.ndarray
         one row per trip, one column per time period, with float prob of picking that time period
-
-    depart_alt_base: int
+        (before clipping to the trip's depart window)
+    earliest : numpy.ndarray of int
+        earliest depart allowed for each trip (before constraint by preceding trips in leg)
+    latest : numpy.ndarray of int
+        latest depart allowed for each trip (before constraint by succeeding trips in leg)
+    leg_length : numpy.ndarray of int
+        number of trips in each leg, in the order the legs appear in the trip arrays
+    rands : numpy.ndarray
+        one random number per trip
+    outbound : bool
+    depart_alt_base : int
         int to add to probs column index to get time period it represents.
         e.g. depart_alt_base = 5 means first column (column 0) represents 5 am
+    choose_most_initial : bool
+        if True, trips that can't be scheduled are assigned their most initial allowed depart
 
     Returns
     -------
-    probs: pd.DataFrame
-        clipped version of probs
-
+    depart : numpy.ndarray of int
+        depart choice for each trip (NO_DEPART for trips that could not be scheduled)
+    failed : numpy.ndarray of bool
+        True for trips whose depart choice failed (even if assigned their most initial depart)
     """
 
-    depart_alt_base = model_settings.get(DEPART_ALT_BASE)
-
-    # there should be one row in probs per trip
-    assert trips.shape[0] == probs.shape[0]
+    num_trips, num_alts = probs.shape
+    assert len(earliest) == len(latest) == len(rands) == num_trips
+    assert leg_length.sum() == num_trips
 
     # probs should sum to 1 across rows before clipping
-    probs = probs.div(probs.sum(axis=1), axis=0)
+    probs = probs / probs.sum(axis=1).reshape(num_trips, 1)
+
+    alt_periods = np.arange(num_alts) + depart_alt_base
+
+    earliest = earliest.astype(np.int64)
+    latest = latest.astype(np.int64)
+
+    # depart of preceding trip constrains earliest depart of outbound trips
+    # inbound trips are scheduled in reverse order, so it constrains latest depart instead
+    # (this bound is also the most initial depart for trips that can't be scheduled)
+    bound = earliest if outbound else latest
+
+    depart = np.full(num_trips, NO_DEPART, dtype=np.int64)
+    failed = np.zeros(num_trips, dtype=bool)
+
+    leg_start = np.cumsum(leg_length) - leg_length
+    max_leg_length = leg_length.max() if len(leg_length) else 0
+
+    for n in range(max_leg_length):
+
+        # index of nth trip of every leg with more than n trips
+        nth = leg_start[leg_length > n] + n
 
-    num_rows, num_cols = probs.shape
-    ix_map = np.tile(np.arange(0, num_cols), num_rows).reshape(num_rows, num_cols) + depart_alt_base
-    # 5 6 7 8 9 10...
-    # 5 6 7 8 9 10...
-    # 5 6 7 8 9 10...
+        if n > 0:
+            # preceding trips that were scheduled constrain the bound of the nth trips
+            prior_depart = depart[nth - 1]
+            bound[nth] = np.where(prior_depart != NO_DEPART, prior_depart, bound[nth])
 
-    clip_mask = ((ix_map >= trips.earliest.values.reshape(num_rows, 1)) &
-                 (ix_map <= trips.latest.values.reshape(num_rows, 1))) * 1
-    #  [0 0 0 0 0 0 0 0 0 0 0 0 1 1 1 1 0 0 0]
-    #  [0 0 0 1 1 1 1 1 1 1 0 0 0 0 0 0 0 0 0]
-    #  [0 0 0 0 0 0 0 0 0 1 0 0 0 0 0 0 0 0 0]...
+        # zero out probs outside earliest-latest window
+        nth_probs = probs[nth] * ((alt_periods >= earliest[nth].reshape(-1, 1)) &
+                                  (alt_periods <= latest[nth].reshape(-1, 1)))
 
-    probs = probs*clip_mask
+        if n == 0:
+            # probs of first trip in leg should sum to 1 unless all zero
+            row_sums = nth_probs.sum(axis=1).reshape(-1, 1)
+            nth_probs = np.divide(nth_probs, row_sums,
+                                  out=np.zeros_like(nth_probs), where=(row_sums > 0))
 
-    return probs
+        # probs should sum to 1 with residual probs resulting in choice of 'fail' (last column)
+        fail_probs = 1 - nth_probs.sum(axis=1).clip(0, 1)
+        cum_probs = np.hstack([nth_probs, fail_probs.reshape(-1, 1)]).cumsum(axis=1)
+        choices = np.argmax((cum_probs - rands[nth].reshape(-1, 1)) > 0.0, axis=1)
+
+        nth_failed = (choices == num_alts)
+        nth_depart = choices + depart_alt_base
+
+        assert (nth_depart[~nth_failed] >= earliest[nth][~nth_failed]).all()
+        assert (nth_depart[~nth_failed] <= latest[nth][~nth_failed]).all()
+
+        if choose_most_initial:
+            nth_depart = np.where(nth_failed, bound[nth], nth_depart)
+        else:
+            nth_depart = np.where(nth_failed, NO_DEPART, nth_depart)
+
+        depart[nth] = nth_depart
+        failed[nth] = nth_failed
+
+    return depart, failed
 
 
 def report_bad_choices(bad_row_map, df, filename, trace_label, trace_choosers=None):
@@ -171,89 +227,99 @@ def report_bad_choices(bad_row_map, df, filename, trace_label, trace_choosers=No
         logger.warning(row_msg)
 
 
-def schedule_nth_trips(
+def schedule_trips_in_leg(
+        outbound,
         trips,
         probs_spec,
         model_settings,
-        first_trip_in_leg,
-        report_failed_trips,
-        trace_hh_id,
-        trace_label):
+        last_iteration,
+        trace_hh_id, trace_label):
     """
-    We join each trip with the appropriate row in probs_spec by joining on probs_join_cols,
-    which should exist in both trips, probs_spec dataframe.
+    Schedule the trips of all outbound (or inbound) legs in trips
+
+    The initial trip of each leg (and all atwork trips) get the tour_hour. The rest are joined
+    with the appropriate row in probs_spec, sorted by leg and position along leg, and scheduled
+    all at once by schedule_departs.
 
     Parameters
     ----------
-    trips: pd.DataFrame
-    probs_spec: pd.DataFrame
+    outbound : bool
+    trips : pd.DataFrame
+    probs_spec : pd.DataFrame
         Dataframe of probs for choice of depart times and join columns to match them with trips.
         Depart columns names are irrelevant. Instead, they are position dependent,
         time period choice is their index + depart_alt_base
-    depart_alt_base: int
-        int to add to probs column index to get time period it represents.
-        e.g. depart_alt_base = 5 means first column (column 0) represents 5 am
-    report_failed_trips : bool
+    model_settings : dict
+    last_iteration : bool
     trace_hh_id
     trace_label
 
     Returns
     -------
     choices: pd.Series
-        time periods depart choices, one per trip (except for trips with zero probs)
+        depart choice for trips, indexed by trip_id (except for trips that could not be scheduled)
     """
 
-    depart_alt_base = model_settings.get('DEPART_ALT_BASE')
+    failfix = model_settings.get(FAILFIX, FAILFIX_DEFAULT)
+    depart_alt_base = model_settings.get(DEPART_ALT_BASE)
+
+    assert (trips.outbound == outbound).all()
+
+    # initial trip of leg and all atwork trips get tour_hour
+    is_initial = (trips.trip_num == 1) if outbound else (trips.trip_num == trips.trip_count)
+    no_scheduling = is_initial | (trips.primary_purpose == 'atwork')
+    choices = trips.tour_hour[no_scheduling]
+
+    if no_scheduling.all():
+        return choices
+
+    trips = trips[~no_scheduling]
 
+    # sort by leg and then by position along leg in the order trips are to be scheduled
+    # outbound trips in ascending trip_num order, inbound trips in descending trip_num order
+    position = (trips.trip_num - 1) if outbound else (trips.trip_count - trips.trip_num)
+    trips = trips.iloc[np.lexsort((position.values, trips.tour_id.values))]
+    _, leg_length = np.unique(trips.tour_id.values, return_counts=True)
+
+    # left join trips to probs (there should be one row per trip)
     probs_join_cols = ['primary_purpose', 'outbound', 'tour_hour', 'trip_num']
     probs_cols = [c for c in probs_spec.columns if c not in probs_join_cols]
-
-    # left join trips to probs (there may be multiple rows per trip for multiple depart ranges)
-    choosers = pd.merge(trips.reset_index(), probs_spec, on=probs_join_cols,
-                        how='left').set_index('trip_id')
+    choosers = pd.merge(trips[probs_join_cols].reset_index(), probs_spec, on=probs_join_cols,
+                        how='left').set_index(trips.index.name)
     chunk.log_df(trace_label, "choosers", choosers)
 
-    if trace_hh_id and tracing.has_trace_targets(trips):
-        tracing.trace_df(choosers, '%s.choosers' % trace_label)
-
     # choosers should now match trips row for row
     assert choosers.index.is_unique
     assert len(choosers.index) == len(trips.index)
 
-    # zero out probs outside earliest-latest window
-    chooser_probs = clip_probs(trips, choosers[probs_cols], model_settings)
-
-    chunk.log_df(trace_label, "chooser_probs", chooser_probs)
+    if trace_hh_id and tracing.has_trace_targets(trips):
+        tracing.trace_df(choosers, '%s.choosers' % trace_label)
 
-    if first_trip_in_leg:
-        # probs should sum to 1 unless all zero
-        chooser_probs = chooser_probs.div(chooser_probs.sum(axis=1), axis=0).fillna(0)
+    rands = pipeline.get_rn_generator().random_for_df(trips).flatten()
 
-    # probs should sum to 1 with residual probs resulting in choice of 'fail'
-    chooser_probs['fail'] = 1 - chooser_probs.sum(axis=1).clip(0, 1)
+    choose_most_initial = last_iteration and (failfix == FAILFIX_CHOOSE_MOST_INITIAL)
 
-    if trace_hh_id and tracing.has_trace_targets(trips):
-        tracing.trace_df(chooser_probs, '%s.chooser_probs' % trace_label)
+    depart, failed = schedule_departs(
+        probs=choosers[probs_cols].values,
+        earliest=trips.earliest.values,
+        latest=trips.latest.values,
+        leg_length=leg_length,
+        rands=rands,
+        outbound=outbound,
+        depart_alt_base=depart_alt_base,
+        choose_most_initial=choose_most_initial)
 
-    choices, rands = logit.make_choices(
-        chooser_probs,
-        trace_label=trace_label, trace_choosers=choosers)
-
-    chunk.log_df(trace_label, "choices", choices)
-    chunk.log_df(trace_label, "rands", rands)
+    chunk.log_df(trace_label, "depart", depart)
 
     if trace_hh_id and tracing.has_trace_targets(trips):
-        tracing.trace_df(choices, '%s.choices' % trace_label, columns=[None, 'depart'])
-        tracing.trace_df(rands, '%s.rands' % trace_label, columns=[None, 'rand'])
-
-    # convert alt choice index to depart time (setting failed choices to -1)
-    failed = (choices == chooser_probs.columns.get_loc('fail'))
-    choices = (choices + depart_alt_base).where(~failed, -1)
+        tracing.trace_df(pd.DataFrame({'depart': depart, 'rand': rands, 'failed': failed},
+                                      index=trips.index),
+                         '%s.choices' % trace_label)
 
-    chunk.log_df(trace_label, "failed", failed)
+    failed = pd.Series(failed, index=trips.index)
 
     # report failed trips while we have the best diagnostic info
-    if report_failed_trips and failed.any():
+    if last_iteration and failed.any():
         report_bad_choices(
             bad_row_map=failed,
             df=choosers,
@@ -261,120 +327,15 @@ def schedule_nth_trips(
             trace_label=trace_label,
             trace_choosers=None)
 
-    # trace before removing failures
-    if trace_hh_id and tracing.has_trace_targets(trips):
-        tracing.trace_df(choices, '%s.choices' % trace_label, columns=[None, 'depart'])
-        tracing.trace_df(rands, '%s.rands' % trace_label, columns=[None, 'rand'])
-
-    # remove any failed choices
-    if failed.any():
-        choices = choices[~failed]
-
-    assert (choices >= trips.earliest[~failed]).all()
-    assert (choices <= trips.latest[~failed]).all()
-
-    return choices
-
-
-def schedule_trips_in_leg(
-        outbound,
-        trips,
-        probs_spec,
-        model_settings,
-        last_iteration,
-        trace_hh_id, trace_label):
-    """
-
-    Parameters
-    ----------
-    outbound
-    trips
-    probs_spec
-    depart_alt_base
-    last_iteration
-    trace_hh_id
-    trace_label
-
-    Returns
-    -------
-    choices: pd.Series
-        depart choice for trips, indexed by trip_id
-    """
-
-    failfix = model_settings.get(FAILFIX, FAILFIX_DEFAULT)
-
-    # logger.debug("%s scheduling %s trips" % (trace_label, trips.shape[0]))
-
-    assert (trips.outbound == outbound).all()
-
-    # initial trip of leg and all atwork trips get tour_hour
-    is_initial = (trips.trip_num == 1) if outbound else (trips.trip_num == trips.trip_count)
-    no_scheduling = is_initial | (trips.primary_purpose == 'atwork')
-    choices = trips.tour_hour[no_scheduling]
-
-    if no_scheduling.all():
-        return choices
-
-    result_list = []
-    result_list.append(choices)
-    trips = trips[~no_scheduling]
-
-    # add next_trip_id temp column (temp as trips is now a copy, as result of slicing)
-    trips = trips.sort_index()
-    trips['next_trip_id'] = np.roll(trips.index, -1 if outbound else 1)
-    is_final = (trips.trip_num == trips.trip_count) if outbound else (trips.trip_num == 1)
-    trips.next_trip_id = trips.next_trip_id.where(is_final, NO_TRIP_ID)
-
-    # iterate over outbound trips in ascending trip_num order, skipping the initial trip
-    # iterate over inbound trips in descending trip_num order, skipping the finial trip
-    first_trip_in_leg = True
-    for i in range(trips.trip_num.min(), trips.trip_num.max() + 1):
-
-        if outbound:
-            nth_trips = trips[trips.trip_num == i]
-        else:
-            nth_trips = trips[trips.trip_num == trips.trip_count - i]
-
-        nth_trace_label = tracing.extend_trace_label(trace_label, 'num_%s' % i)
-
-        chunk.log_open(nth_trace_label, chunk_size=0, effective_chunk_size=0)
-
-        choices = schedule_nth_trips(
-            nth_trips,
-            probs_spec,
-            model_settings,
-            first_trip_in_leg=first_trip_in_leg,
-            report_failed_trips=last_iteration,
-            trace_hh_id=trace_hh_id,
-            trace_label=nth_trace_label)
-
-        chunk.log_close(nth_trace_label)
-
-        # if outbound, this trip's depart constrains next trip's earliest depart option
-        # if inbound, we are handling in reverse order, so it constrains latest depart instead
-        ADJUST_NEXT_DEPART_COL = 'earliest' if outbound else 'latest'
-
-        # most initial departure (when no choice was made because all probs were zero)
-        if last_iteration and (failfix == FAILFIX_CHOOSE_MOST_INITIAL):
-            choices = choices.reindex(nth_trips.index)
-            logger.warning("%s coercing %s depart choices to most initial" %
-                           (nth_trace_label, choices.isna().sum()))
-            choices = choices.fillna(trips[ADJUST_NEXT_DEPART_COL])
-
-        # adjust allowed depart range of next trip
-        has_next_trip = (nth_trips.next_trip_id != NO_TRIP_ID)
-        if has_next_trip.any():
-            next_trip_ids = nth_trips.next_trip_id[has_next_trip]
-            # patch choice any trips with next_trips that weren't scheduled
-            trips.loc[next_trip_ids, ADJUST_NEXT_DEPART_COL] = \
-                choices.reindex(next_trip_ids.index).fillna(trips[ADJUST_NEXT_DEPART_COL]).values
-
-        result_list.append(choices)
-
-        first_trip_in_leg = False
+    if choose_most_initial:
+        logger.warning("%s coercing %s depart choices to most initial" %
+                       (trace_label, failed.sum()))
+    else:
+        # remove any failed choices
+        depart = depart[~failed.values]
+        trips = trips[~failed]
 
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+    choices = pd.concat([choices, pd.Series(depart, index=trips.index)])
 
     return choices
 
@@ -424,7 +385,8 @@ def run_trip_scheduling(
         trip_scheduling_rpc(chunk_size, trips, probs_spec, trace_label)
 
     result_list = []
-    for i, num_chunks, trips_chunk in chunk.chunked_choosers_by_chunk_id(trips, rows_per_chunk):
+    for i, num_chunks, trips_chunk in chunk.chunked_choosers_by_chunk_id(
+            trips, rows_per_chunk, trace_label):
 
         if num_chunks > 1:
             chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i)
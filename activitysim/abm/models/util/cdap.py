@@ -207,6 +207,31 @@ def individual_utilities(
     return indiv_utils
 
 
+def interaction_codes(ptypes):
+    """
+    Return the integer interaction code for the ptypes of the persons in each row of ptypes
+
+    The code has the ptypes as digits in increasing ptype order (e.g. 28 for an interaction
+    between ptypes 2 and 8 or 8 and 2) so interactions are symmetrical and the codes match the
+    interaction_ptypes in cdap_interaction_coefficients.csv
+
+    Parameters
+    ----------
+    ptypes : numpy.ndarray
+        int array of ptypes (between 1 and 9) with one row per interaction and one column
+        per person in the interaction
+
+    Returns
+    -------
+    codes : numpy.ndarray
+        int interaction code for each row
+    """
+
+    cardinality = ptypes.shape[1]
+
+    return np.sort(ptypes, axis=1).dot(10 ** np.arange(cardinality - 1, -1, -1))
+
+
 def preprocess_interaction_coefficients(interaction_coefficients):
     """
     The input cdap_interaction_coefficients.csv file has three columns:
@@ -229,6 +254,10 @@ def preprocess_interaction_coefficients(interaction_coefficients):
     slug
         a human friendly efficient name so we can dump a readable spec trace file for debugging
         this slug is then replaced with the numerical coefficient value prior to evaluation
+
+    interaction_code
+        integer interaction code (see interaction_codes) of the interaction_ptypes
+        (or 0 for wildcards) to use to look up the coefficients of household interactions
     """
 
     # make a copy
@@ -248,6 +277,11 @@ def preprocess_interaction_coefficients(interaction_coefficients):
         coefficients['activity'] * coefficients['cardinality'] \
         + coefficients['interaction_ptypes'].astype(str)
 
+    coefficients['interaction_code'] = 0
+    for _, rows in coefficients[~wildcards].groupby('cardinality'):
+        ptypes = np.array([list(p) for p in rows['interaction_ptypes'].astype(str)], dtype=int)
+        coefficients.loc[rows.index, 'interaction_code'] = interaction_codes(ptypes)
+
     return coefficients
 
 
@@ -497,24 +531,14 @@ def add_interaction_column(choosers, p_tup):
 
     # Since ptypes are always between 1 and 8, we represent the interaction as an integer (24)
     # rather than as a string ('24')
-    # FIXME - check that coding interactions as integers is in fact faster then coding as strings
 
     if p_tup != tuple(sorted(p_tup)):
         raise RuntimeError("add_interaction_column tuple not sorted" % p_tup)
 
-    # FIXME - this could be made more elegant and efficient
-    # I couldn't figure out a good way to do this in pandas, but we want to do something like:
-    # choosers['p1_p3'] = choosers['ptype_p1'].astype(str) + choosers['ptype_p3'].astype(str)
-
     dest_col = '_'.join(['p%s' % pnum for pnum in p_tup])
 
-    # build a string concatenating the ptypes of the persons in the order they appear in p_tup
-    choosers[dest_col] = choosers[add_pn('ptype', p_tup[0])].astype(str)
-    for pnum in p_tup[1:]:
-        choosers[dest_col] = choosers[dest_col] + choosers[add_pn('ptype', pnum)].astype(str)
-
-    # sort the list of ptypes so it is in increasing ptype order, then convert to int
-    choosers[dest_col] = choosers[dest_col].apply(lambda x: ''.join(sorted(x))).astype(int)
+    ptype_cols = [add_pn('ptype', pnum) for pnum in p_tup]
+    choosers[dest_col] = interaction_codes(choosers[ptype_cols].values.astype(int))
 
 
 def hh_choosers(indiv_utils, hhsize):
@@ -596,6 +620,118 @@ def hh_choosers(indiv_utils, hhsize):
     return choosers
 
 
+def alternative_activity_codes(hhsize):
+    """
+    Return array with the activity code (index into 'HMN') of each person in each alternative
+
+    Alternatives are in the same order as the build_cdap_spec alternative columns
+    (e.g. ['HH', 'HM', 'HN', 'MH', 'MM', 'MN', 'NH', 'NM', 'NN'] for hhsize 2)
+
+    Returns
+    -------
+    alt_codes : numpy.ndarray
+        int array with shape (3 ** hhsize, hhsize)
+    """
+    return np.array(list(itertools.product(range(len('HMN')), repeat=hhsize)), dtype=int)
+
+
+def household_utilities(indiv_utils, interaction_coefficients, hhsize):
+    """
+    Calculate household utilities for each activity pattern alternative for households of hhsize
+
+    This computes the same utilities as evaluating the build_cdap_spec spec for the hh_choosers
+    choosers table, but builds them directly as a (households x 3 ** hhsize) array from an
+    array of individual utilities with shape (households, hhsize, 3) and integer interaction
+    codes of the ptypes of the persons in each interaction. So there are no merges, string
+    interaction columns or spec expressions to eval.
+
+    Parameters
+    ----------
+    indiv_utils : pandas.DataFrame
+        CDAP utilities for each individual, ignoring interactions
+    interaction_coefficients : pandas.DataFrame
+        Rules and coefficients (as preprocessed by preprocess_interaction_coefficients)
+    hhsize : int
+        household size for which utilities should be calculated (2..MAX_HHSIZE)
+
+    Returns
+    -------
+    utils : pandas.DataFrame
+        index _hh_index_ and one column per alternative (e.g. 'HH', 'HM',... for hhsize 2)
+    """
+
+    if hhsize > MAX_HHSIZE:
+        raise RuntimeError("household_utilities hhsize > MAX_HHSIZE")
+
+    if hhsize < MAX_HHSIZE:
+        include_households = (indiv_utils[_hh_size_] == hhsize)
+    else:
+        # we want to include larger households along with MAX_HHSIZE households
+        include_households = (indiv_utils[_hh_size_] >= MAX_HHSIZE)
+
+    hh_persons = indiv_utils[include_households & (indiv_utils['cdap_rank'] <= hhsize)]
+
+    # households in order of their cdap_rank 1 persons (same order as hh_choosers)
+    hh_ids = hh_persons.loc[hh_persons['cdap_rank'] == 1, _hh_id_].values
+    hh_ixs = pd.Series(np.arange(len(hh_ids)), index=hh_ids)
+    row_ixs = hh_persons[_hh_id_].map(hh_ixs).values
+    person_ixs = hh_persons['cdap_rank'].values - 1
+
+    # individual utilities and ptypes of each person (in cdap_rank order) in each household
+    person_utils = np.zeros((len(hh_ids), hhsize, len('HMN')))
+    person_utils[row_ixs, person_ixs] = hh_persons[list('HMN')].values.astype(float)
+    ptypes = np.zeros((len(hh_ids), hhsize), dtype=int)
+    ptypes[row_ixs, person_ixs] = hh_persons[_ptype_].values
+
+    alt_codes = alternative_activity_codes(hhsize)
+    alternatives = [''.join('HMN'[c] for c in codes) for codes in alt_codes]
+
+    # - individual utilities of each person's activity in each alternative
+    utils = np.zeros((len(hh_ids), len(alternatives)))
+    for p in range(hhsize):
+        utils += person_utils[:, p, alt_codes[:, p]]
+
+    # - interactions
+    # coefficients applied to rows of the same slug replace rather than add to each other
+    coefficients = interaction_coefficients[interaction_coefficients.cardinality <= hhsize]
+    coefficients = coefficients.drop_duplicates(subset='slug', keep='last')
+
+    wildcards = (coefficients.interaction_ptypes == '')
+
+    # wildcard interactions only apply if the interaction includes all household members
+    for row in coefficients[wildcards & (coefficients.cardinality == hhsize)].itertuples():
+        activity = 'HMN'.index(row.activity)
+        utils[:, (alt_codes == activity).all(axis=1)] += row.coefficient
+
+    coefficients = coefficients[~wildcards]
+
+    bad_cardinality = ~coefficients.cardinality.between(0, MAX_INTERACTION_CARDINALITY)
+    if bad_cardinality.any():
+        row = coefficients[bad_cardinality].iloc[0]
+        raise RuntimeError("Bad row cardinality %d for %s" % (row.cardinality, row.slug))
+
+    for (cardinality, activity), rules in coefficients.groupby(['cardinality', 'activity']):
+
+        # coefficient lookup table indexed by interaction_code
+        coefficient_lookup = np.zeros(10 ** cardinality)
+        coefficient_lookup[rules.interaction_code.values] = rules.coefficient.values
+
+        activity = 'HMN'.index(activity)
+
+        for tup in itertools.combinations(list(range(hhsize)), cardinality):
+
+            hh_coefficients = coefficient_lookup[interaction_codes(ptypes[:, tup])]
+
+            # alternatives in which all persons in tup have the interaction activity
+            alt_mask = (alt_codes[:, list(tup)] == activity).all(axis=1)
+
+            utils[:, alt_mask] += hh_coefficients.reshape(-1, 1)
+
+    utils = pd.DataFrame(utils, index=pd.Index(hh_ids, name=_hh_index_), columns=alternatives)
+
+    return utils
+
+
 def household_activity_choices(indiv_utils, interaction_coefficients, hhsize,
                                trace_hh_id=None, trace_label=None):
     """
@@ -634,13 +770,14 @@ def household_activity_choices(indiv_utils, interaction_coefficients, hhsize,
         set_hh_index(utils)
     else:
 
-        choosers = hh_choosers(indiv_utils, hhsize=hhsize)
-
-        spec = build_cdap_spec(interaction_coefficients, hhsize,
-                               trace_spec=(trace_hh_id in choosers.index),
-                               trace_label=trace_label)
+        choosers = None
+        utils = household_utilities(indiv_utils, interaction_coefficients, hhsize)
 
-        utils = simulate.eval_utilities(spec, choosers, trace_label=trace_label)
+        # the equivalent choosers and spec are only built to trace them
+        if trace_hh_id in utils.index:
+            choosers = hh_choosers(indiv_utils, hhsize=hhsize)
+            build_cdap_spec(interaction_coefficients, hhsize,
+                            trace_spec=True, trace_label=trace_label)
 
     if len(utils.index) == 0:
         return pd.Series()
@@ -656,7 +793,7 @@ def household_activity_choices(indiv_utils, interaction_coefficients, hhsize,
 
     if trace_hh_id:
 
-        if hhsize > 1:
+        if choosers is not None:
             tracing.trace_df(choosers, '%s.hhsize%d_choosers' % (trace_label, hhsize),
                              column_labels=['expression', 'person'])
 
@@ -944,7 +1081,8 @@ def run_cdap(
 
     result_list = []
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, persons_chunk in chunk.chunked_choosers_by_chunk_id(persons, rows_per_chunk):
+    for i, num_chunks, persons_chunk in chunk.chunked_choosers_by_chunk_id(
+            persons, rows_per_chunk, trace_label):
 
         logger.info("Running chunk %s of %s with %d persons" % (i, num_chunks, len(persons_chunk)))
 
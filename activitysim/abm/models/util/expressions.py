@@ -18,6 +18,7 @@ from activitysim.core import config
 from activitysim.core import assign
 from activitysim.core import inject
 from activitysim.core import simulate
+from activitysim.core import spec_compiler
 
 from activitysim.core.util import other_than
 from activitysim.core.util import assign_in_place
@@ -239,6 +240,47 @@ def annotate_preprocessors(
         assign_in_place(tours_df, results)
 
 
+def preprocessor_referenced_names(preprocessor_settings, locals_dict=None):
+    """
+    Return set of names referenced by preprocessor expressions (see annotate_preprocessors)
+    or None if we can't tell what names they might reference
+
+    Parameters
+    ----------
+    preprocessor_settings : dict, list of dict, or None
+        preprocessor model_settings with SPEC name of assignment expressions file
+    locals_dict : dict or None
+        locals the expressions will be evaluated with (to resolve df[<name>] column names)
+
+    Returns
+    -------
+    names : set of str or None
+    """
+
+    if not preprocessor_settings:
+        return set()
+
+    if not isinstance(preprocessor_settings, list):
+        assert isinstance(preprocessor_settings, dict)
+        preprocessor_settings = [preprocessor_settings]
+
+    names = set()
+    for model_settings in preprocessor_settings:
+
+        spec_name = model_settings['SPEC']
+        if not spec_name.endswith(".csv"):
+            spec_name = '%s.csv' % spec_name
+        assignment_spec = assign.read_assignment_spec(config.config_file_path(spec_name))
+
+        spec_names = spec_compiler.compile_spec(assignment_spec.expression, python=True)\
+            .referenced_names(locals_dict)
+        if spec_names is None:
+            return None
+        names |= spec_names
+
+    return names
+
+
 def filter_chooser_columns(choosers, chooser_columns):
 
     missing_columns = [c for c in chooser_columns if c not in choosers]
@@ -3,6 +3,7 @@
 
 import os.path
 
+import numpy as np
 import pandas as pd
 import pandas.util.testing as pdt
 import pytest
@@ -60,6 +61,21 @@ def test_bad_coefficients(configs_dir):
     assert "Expect only M, N, or H" in str(excinfo.value)
 
 
+def test_interaction_codes(cdap_interaction_coefficients):
+
+    ptypes = np.array([[2, 8], [8, 2], [3, 1]])
+    assert list(cdap.interaction_codes(ptypes)) == [28, 28, 13]
+
+    ptypes = np.array([[3, 1, 2], [1, 1, 8]])
+    assert list(cdap.interaction_codes(ptypes)) == [123, 118]
+
+    coefficients = cdap_interaction_coefficients
+    wildcards = coefficients.interaction_ptypes == ''
+    assert (coefficients.interaction_code[wildcards] == 0).all()
+    assert (coefficients.interaction_code[~wildcards] ==
+            coefficients.interaction_ptypes[~wildcards].astype(int)).all()
+
+
 def test_assign_cdap_rank(people):
 
     cdap.assign_cdap_rank(people)
@@ -128,3 +144,19 @@ def test_build_cdap_spec_hhsize2(people, cdap_indiv_and_hhsize1, cdap_interactio
         columns=['HH', 'HM', 'HN', 'MH', 'MM', 'MN', 'NH', 'NM', 'NN']).astype('float')
 
     pdt.assert_frame_equal(utils, expected, check_names=False)
+
+
+def test_household_utilities(people, cdap_indiv_and_hhsize1, cdap_interaction_coefficients):
+
+    cdap.assign_cdap_rank(people)
+    indiv_utils = cdap.individual_utilities(people, cdap_indiv_and_hhsize1, locals_d=None)
+
+    for hhsize in range(2, cdap.MAX_HHSIZE + 1):
+
+        choosers = cdap.hh_choosers(indiv_utils, hhsize=hhsize)
+        spec = cdap.build_cdap_spec(cdap_interaction_coefficients, hhsize=hhsize, cache=False)
+        expected = simulate.eval_utilities(spec, choosers)
+
+        utils = cdap.household_utilities(indiv_utils, cdap_interaction_coefficients, hhsize)
+
+        pdt.assert_frame_equal(utils, expected, check_names=False)
@@ -19,6 +19,7 @@ from activitysim.core import chunk
 from activitysim.core import simulate
 from activitysim.core import assign
 from activitysim.core import logit
+from activitysim.core import spec_compiler
 
 from activitysim.core import timetable as tt
 
@@ -163,6 +164,101 @@ def compute_logsums(alt_tdd, tours_merged, tour_purpose, model_settings, trace_l
     return logsums
 
 
+def period_logsum_columns(model_settings):
+    """
+    Return list of the alt tdd columns that tour scheduling logsums depend on
+
+    Logsums always depend on the out_period and in_period skim time period labels, and also on
+    duration if the logsum spec or preprocessor expressions might reference it (e.g. to compute
+    parking costs), or if we can't tell whether they do.
+    """
+
+    logsum_settings = config.read_model_settings(model_settings['LOGSUM_SETTINGS'])
+
+    names = spec_compiler.compile_spec(get_logsum_spec(logsum_settings).index).referenced_names()
+
+    preprocessor = model_settings.get('LOGSUM_PREPROCESSOR', 'preprocessor')
+    preprocessor_settings = logsum_settings[preprocessor]
+
+    if names is not None:
+        preprocessor_names = expressions.preprocessor_referenced_names(preprocessor_settings)
+        names = None if preprocessor_names is None else names | preprocessor_names
+
+    if names is None or 'duration' in names:
+        return ['out_period', 'in_period', 'duration']
+
+    return ['out_period', 'in_period']
+
+
+def compute_period_logsums(alt_tdd, tours_merged, alts, choice_column,
+                           tour_purpose, model_settings, trace_label):
+    """
+    Compute logsums for the tour alt_tdds by computing logsums once for each distinct
+    (tour, period key) pair among the available alt_tdds, where the period key is the
+    (out_period, in_period) skim time period pair of the tdd alt, and then looking up the
+    logsum for each alt_tdd.
+
+    With 5 skim time periods, the 190 mtctm1 tdd alternatives map to at most 15 period pairs, so
+    this computes far fewer logsums than there are alt_tdds. If the logsums depend on duration
+    (see period_logsum_columns), duration is part of the key, and the savings are smaller, but
+    no more logsums are computed than by compute_logsums, which dedupes the alt_tdd interaction
+    dataset on (tour_id, out_period, in_period, duration). Pairs are found with integer array
+    operations, rather than by deduping and merging on period label columns.
+
+    Parameters
+    ----------
+    alt_tdd : pandas.DataFrame
+        tdd interaction dataset indexed (not unique) on tour_id
+    tours_merged : pandas.DataFrame
+        tours (merged with persons) indexed by tour_id
+    alts : pandas.DataFrame
+        tdd alternatives with start and end columns
+    choice_column : str
+        name of alt_tdd column with the alts index (tdd) of each alt_tdd row
+
+    Returns
+    -------
+    logsums : pandas.Series
+        logsum for each alt_tdd row, with same index as alt_tdd
+    """
+
+    key_columns = period_logsum_columns(model_settings)
+
+    alt_periods = pd.DataFrame({
+        'out_period': expressions.skim_time_period_label(alts['start']),
+        'in_period': expressions.skim_time_period_label(alts['end']),
+        'duration': alts['end'] - alts['start']
+    }, index=alts.index)[key_columns]
+
+    # groups are numbered in order of first appearance so periods[i] is alt_periods of group i
+    period_ids = alt_periods.groupby(key_columns, sort=False).ngroup().values
+    periods = alt_periods[~pd.Series(period_ids).duplicated().values]
+    num_periods = len(periods)
+
+    # - distinct (tour, period key) pairs of available alt_tdds
+    tour_rows = tours_merged.index.get_indexer(alt_tdd.index)
+    alt_period_ids = period_ids[alts.index.get_indexer(alt_tdd[choice_column])]
+    pair_ids = tour_rows.astype(np.int64) * num_periods + alt_period_ids
+    pair_ids, alt_tdd_pairs = np.unique(pair_ids, return_inverse=True)
+    pair_tour_rows, pair_period_ids = np.divmod(pair_ids, num_periods)
+
+    logger.info("%s compute_period_logsums for %d alt_tdds with %d distinct tour %s" %
+                (trace_label, len(alt_tdd), len(pair_ids), key_columns))
+
+    # - compute logsums for each (tour, period key) pair
+    tour_periods = periods.take(pair_period_ids)
+    tour_periods.index = pd.Index(tours_merged.index.values[pair_tour_rows],
+                                  name=tours_merged.index.name)
+    chunk.log_df(trace_label, "tour_periods", tour_periods)
+
+    logsums = _compute_logsums(tour_periods, tours_merged, tour_purpose,
+                               model_settings, trace_label)
+    chunk.log_df(trace_label, "tour_periods", None)
+
+    # - look up logsum for each alt_tdd by its (tour, period key) pair
+    return pd.Series(logsums.values[alt_tdd_pairs], index=alt_tdd.index)
+
+
 def get_previous_tour_by_tourid(current_tour_window_ids,
                                 previous_tour_by_window_id,
                                 alts):
@@ -231,24 +327,17 @@ def tdd_interaction_dataset(tours, alts, timetable, choice_column, window_id_col
 
     """
 
-    alts_ids = np.tile(alts.index, len(tours.index))
-    tour_ids = np.repeat(tours.index, len(alts.index))
-    window_row_ids = np.repeat(tours[window_id_col], len(alts.index))
+    # only the available (tour, tdd) pairs, rather than tiling every alt for every tour and
+    # then slicing out the unavailable ones
+    row_positions, alts_ids = timetable.available_tdds(tours[window_id_col])
+    assert len(alts_ids) > 0
 
+    # timetable requires alts to have a range index, so alt ids are also alt positions
     alt_tdd = alts.take(alts_ids)
 
-    alt_tdd.index = tour_ids
-    alt_tdd[window_id_col] = window_row_ids
+    alt_tdd.index = tours.index.take(row_positions)
     alt_tdd[choice_column] = alts_ids
 
-    # slice out all non-available tours
-    available = timetable.tour_available(alt_tdd[window_id_col], alt_tdd[choice_column])
-    assert available.any()
-    alt_tdd = alt_tdd[available]
-
-    # FIXME - don't need this any more after slicing
-    del alt_tdd[window_id_col]
-
     return alt_tdd
 
 
@@ -330,7 +419,11 @@ def _schedule_tours(
     chunk.log_df(tour_trace_label, "alt_tdd", alt_tdd)
 
     # - add logsums
-    if logsum_tour_purpose:
+    if logsum_tour_purpose and model_settings.get('PRECOMPUTE_PERIOD_LOGSUMS', False):
+        logsums = \
+            compute_period_logsums(alt_tdd, tours, alts, choice_column,
+                                   logsum_tour_purpose, model_settings, tour_trace_label)
+    elif logsum_tour_purpose:
         logsums = \
             compute_logsums(alt_tdd, tours, logsum_tour_purpose, model_settings, tour_trace_label)
     else:
@@ -433,7 +526,7 @@ def schedule_tours(
 
     result_list = []
     for i, num_chunks, chooser_chunk \
-            in chunk.chunked_choosers(tours, rows_per_chunk):
+            in chunk.chunked_choosers(tours, rows_per_chunk, tour_trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -8,9 +8,6 @@ install_aliases()  # noqa: E402
 from future.utils import iteritems
 
 import logging
-import time
-import multiprocessing
-import ctypes
 
 from collections import OrderedDict
 
@@ -21,6 +18,7 @@ from activitysim.core import inject
 from activitysim.core import util
 from activitysim.core import config
 from activitysim.core import tracing
+from activitysim.core import allreduce
 
 from activitysim.abm.tables.size_terms import tour_destination_size_terms
 
@@ -53,20 +51,6 @@ size_table: pandas.DataFrame
 """
 
 
-"""
-Artisanal reverse semaphores to synchronize concurrent access to shared data buffer
-
-we use the first two rows of the final column in numpy-wrapped shared data as 'reverse semaphores'
-(they synchronize concurrent access to shared data resource rather than throttling access)
-
-ShadowPriceCalculator.synchronize_choices coordinates access to the global aggregate zone counts
-(local_modeled_size summed across all sub-processes) using these two semaphores
-(which are really only tuples of indexes of locations in the shared data array.
-"""
-TALLY_CHECKIN = (0, -1)
-TALLY_CHECKOUT = (1, -1)
-
-
 def size_table_name(model_selector):
     """
     Returns canonical name of injected destination desired_size table
@@ -85,13 +69,12 @@ def size_table_name(model_selector):
 
 class ShadowPriceCalculator(object):
 
-    def __init__(self, model_settings, num_processes, shared_data=None, shared_data_lock=None):
+    def __init__(self, model_settings, num_processes, shared_data=None):
         """
 
         Presence of shared_data is used as a flag for multiprocessing
-        If we are multiprocessing, shared_data should be a multiprocessing.RawArray buffer
-        to aggregate modeled_size across all sub-processes, and shared_data_lock should be
-        a multiprocessing.Lock object to coordinate access to that buffer.
+        If we are multiprocessing, shared_data should be an allreduce.AllReduce
+        to aggregate modeled_size across all sub-processes.
 
         Optionally load saved shadow_prices from data_dir if config setting use_shadow_pricing
         and shadow_setting LOAD_SAVED_SHADOW_PRICES are both True
@@ -99,8 +82,7 @@ class ShadowPriceCalculator(object):
         Parameters
         ----------
         model_settings : dict
-        shared_data : multiprocessing.Array or None (if single process)
-        shared_data_lock : numpy array wrapping multiprocessing.RawArray or None (if single process)
+        shared_data : allreduce.AllReduce or None (if single process)
         """
 
         self.num_processes = num_processes
@@ -129,11 +111,8 @@ class ShadowPriceCalculator(object):
 
         # - shared_data
         if shared_data is not None:
-            assert shared_data.shape[0] == self.desired_size.shape[0]
-            assert shared_data.shape[1] == self.desired_size.shape[1] + 1  # tally column
-            assert shared_data_lock is not None
+            assert shared_data.shape == self.desired_size.shape
         self.shared_data = shared_data
-        self.shared_data_lock = shared_data_lock
 
         # - load saved shadow_prices (if available) and set max_iterations accordingly
         if self.use_shadow_pricing:
@@ -161,6 +140,10 @@ class ShadowPriceCalculator(object):
         else:
             self.max_iterations = 1
 
+        # reuse first iteration's location sample and logsums in later shadow price iterations
+        self.reuse_location_sample = \
+            self.use_shadow_pricing and self.shadow_settings.get('REUSE_LOCATION_SAMPLE', False)
+
         self.num_fail = pd.DataFrame(index=self.desired_size.columns)
         self.max_abs_diff = pd.DataFrame(index=self.desired_size.columns)
         self.max_rel_diff = pd.DataFrame(index=self.desired_size.columns)
@@ -198,26 +181,12 @@ class ShadowPriceCalculator(object):
     def synchronize_choices(self, local_modeled_size):
         """
         We have to wait until all processes have computed choices and aggregated them by segment
-        and zone before we can compute global aggregate zone counts (by segment). Since the global
-        zone counts are in shared data, we have to coordinate access to the data structure across
-        sub-processes.
-
-        Note that all access to self.shared_data has to be protected by acquiring shared_data_lock
-
-        ShadowPriceCalculator.synchronize_choices coordinates access to the global aggregate
-        zone counts (local_modeled_size summed across all sub-processes).
-
-        * All processes wait (in case we are iterating) until any stragglers from the previous
-          iteration have exited the building. (TALLY_CHECKOUT goes to zero)
+        and zone before we can compute global aggregate zone counts (by segment).
 
-        * Processes then add their local counts into the shared_data and increment TALLY_CHECKIN
-
-        * All processes wait until everybody has checked in (TALLY_CHECKIN == num_processes)
-
-        * Processes make local copy of shared_data and check out (increment TALLY_CHECKOUT)
-
-        * first_in process waits until all processes have checked out, then zeros shared_data
-          and clears semaphores
+        shared_data (an allreduce.AllReduce) adds each process's local counts into a shared
+        buffer and blocks until all num_processes processes have checked in, at which point
+        they are all woken with a copy of the sum. It is reusable, so we can call it again on
+        the next shadow pricing iteration without any further coordination.
 
         Parameters
         ----------
@@ -235,42 +204,11 @@ class ShadowPriceCalculator(object):
         assert self.shared_data is not None
         assert self.num_processes > 1
 
-        def get_tally(t):
-            with self.shared_data_lock:
-                return self.shared_data[t]
-
-        def wait(tally, target):
-            while get_tally(tally) != target:
-                time.sleep(1)
-
-        # - nobody checks in until checkout clears
-        wait(TALLY_CHECKOUT, 0)
-
-        # - add local_modeled_size data, increment TALLY_CHECKIN
-        with self.shared_data_lock:
-            first_in = self.shared_data[TALLY_CHECKIN] == 0
-            # add local data from df to shared data buffer
-            # final column is used for tallys, hence the negative index
-            self.shared_data[..., 0:-1] += local_modeled_size.values
-            self.shared_data[TALLY_CHECKIN] += 1
-
-        # - wait until everybody else has checked in
-        wait(TALLY_CHECKIN, self.num_processes)
-
-        # - copy shared data, increment TALLY_CHECKIN
-        with self.shared_data_lock:
-            logger.info("copy shared_data")
-            # numpy array with sum of local_modeled_size.values from all processes
-            global_modeled_size_array = self.shared_data[..., 0:-1].copy()
-            self.shared_data[TALLY_CHECKOUT] += 1
-
-        # - first in waits until all other processes have checked out, and cleans tub
-        if first_in:
-            wait(TALLY_CHECKOUT, self.num_processes)
-            with self.shared_data_lock:
-                # zero shared_data, clear TALLY_CHECKIN, and TALLY_CHECKOUT semaphores
-                self.shared_data[:] = 0
-            logger.info("first_in clearing shared_data")
+        # numpy array with sum of local_modeled_size.values from all processes
+        global_modeled_size_array = \
+            self.shared_data.sum(local_modeled_size.values, self.num_processes)
+        logger.info("synchronize_choices summed modeled_size across %s processes" %
+                    self.num_processes)
 
         # convert summed numpy array data to conform to original dataframe
         global_modeled_size_df = \
@@ -297,12 +235,21 @@ class ShadowPriceCalculator(object):
 
         assert 'dest_choice' in choices_df
 
-        modeled_size = pd.DataFrame(index=self.desired_size.index)
-        for c in self.desired_size:
-            segment_choices = \
-                choices_df[choices_df['segment_id'] == self.segment_ids[c]]
-            modeled_size[c] = segment_choices.groupby('dest_choice').size()
-        modeled_size = modeled_size.fillna(0).astype(int)
+        num_zones, num_segments = self.desired_size.shape
+
+        # row and column of each choice in modeled_size (-1 if zone or segment not in desired_size)
+        zone_idx = self.desired_size.index.get_indexer(choices_df['dest_choice'])
+        segment_idx = pd.Index([self.segment_ids[c] for c in self.desired_size.columns])\
+            .get_indexer(choices_df['segment_id'])
+        valid = (zone_idx >= 0) & (segment_idx >= 0)
+
+        # count choices of all segments in one pass by their position in flattened modeled_size
+        counts = np.bincount(zone_idx[valid] * num_segments + segment_idx[valid],
+                             minlength=num_zones * num_segments)
+
+        modeled_size = pd.DataFrame(data=counts.reshape(num_zones, num_segments),
+                                    index=self.desired_size.index,
+                                    columns=self.desired_size.columns)
 
         if self.num_processes == 1:
             # - not multiprocessing
@@ -569,7 +516,7 @@ def get_shadow_pricing_info():
     """
     return dict with info about dtype and shapes of desired and modeled size tables
 
-    block shape is (num_zones, num_segments + 1)
+    block shape is (num_zones, num_segments)
 
 
     Returns
@@ -593,8 +540,7 @@ def get_shadow_pricing_info():
         sp_rows = len(land_use)
         sp_cols = len(size_terms[size_terms.model_selector == model_selector])
 
-        # extra tally column for TALLY_CHECKIN and TALLY_CHECKOUT semaphores
-        blocks[block_name(model_selector)] = (sp_rows, sp_cols + 1)
+        blocks[block_name(model_selector)] = (sp_rows, sp_cols)
 
     sp_dtype = np.int64
 
@@ -616,11 +562,9 @@ def buffers_for_shadow_pricing(shadow_pricing_info):
     Allocates one buffer per model_selector.
     Buffer datatype and shape specified by shadow_pricing_info
 
-    buffers are multiprocessing.Array (RawArray protected by a multiprocessing.Lock wrapper)
-    We don't actually use the wrapped version as it slows access down and doesn't provide
-    protection for numpy-wrapped arrays, but it does provide a convenient way to bundle
-    RawArray and an associated lock. (ShadowPriceCalculator uses the lock to coordinate access to
-    the numpy-wrapped RawArray.)
+    buffers are allreduce.AllReduce objects, which bundle the shared memory with the
+    multiprocessing.Condition that ShadowPriceCalculator.synchronize_choices uses to sum
+    modeled_size across sub-processes.
 
     Parameters
     ----------
@@ -629,7 +573,7 @@ def buffers_for_shadow_pricing(shadow_pricing_info):
     Returns
     -------
         data_buffers : dict {<model_selector> : <shared_data_buffer>}
-        dict of multiprocessing.Array keyed by model_selector
+        dict of allreduce.AllReduce keyed by model_selector
     """
 
     dtype = shadow_pricing_info['dtype']
@@ -638,19 +582,11 @@ def buffers_for_shadow_pricing(shadow_pricing_info):
     data_buffers = {}
     for block_key, block_shape in iteritems(block_shapes):
 
-        # buffer_size must be int (or p2.7 long), not np.int64
-        buffer_size = int(np.prod(block_shape))
-
-        csz = buffer_size * np.dtype(dtype).itemsize
-        logger.info("allocating shared buffer %s %s buffer_size %s bytes %s (%s)" %
-                    (block_key, buffer_size, block_shape, csz, util.GB(csz)))
+        shared_data_buffer = allreduce.AllReduce(block_shape, dtype)
 
-        if np.issubdtype(dtype, np.int64):
-            typecode = ctypes.c_int64
-        else:
-            raise RuntimeError("buffer_for_shadow_pricing unrecognized dtype %s" % dtype)
-
-        shared_data_buffer = multiprocessing.Array(typecode, buffer_size)
+        csz = shared_data_buffer.nbytes
+        logger.info("allocating shared buffer %s %s bytes %s (%s)" %
+                    (block_key, block_shape, csz, util.GB(csz)))
 
         logger.info("buffer_for_shadow_pricing added block %s" % block_key)
 
@@ -664,30 +600,24 @@ def shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_sele
 
     Parameters
     ----------
-    data_buffers : dict of {<model_selector> : <multiprocessing.Array>}
-        multiprocessing.Array is simply a convenient way to bundle Array and Lock
-        we extract the lock and wrap the RawArray in a numpy array for convenience in indexing
-        The shared data buffer has shape (<num_zones, <num_segments> + 1)
-        extra column is for reverse semaphores with TALLY_CHECKIN and TALLY_CHECKOUT
+    data_buffers : dict of {<model_selector> : <allreduce.AllReduce>}
+        The shared data buffer has shape (<num_zones, <num_segments>)
     shadow_pricing_info : dict
         dict of useful info
            dtype: sp_dtype,
            block_shapes : OrderedDict({<model_selector>: <shape tuple>})
-           dict mapping model_selector to block shape (including extra column for semaphores)
-           e.g. {'school': (num_zones, num_segments + 1)
+           dict mapping model_selector to block shape
+           e.g. {'school': (num_zones, num_segments)
     model_selector : str
         location type model_selector (e.g. school or workplace)
 
     Returns
     -------
-    shared_data, shared_data_lock
-        shared_data : multiprocessing.Array or None (if single process)
-        shared_data_lock : numpy array wrapping multiprocessing.RawArray or None (if single process)
+    shared_data : allreduce.AllReduce
     """
 
     assert type(data_buffers) == dict
 
-    dtype = shadow_pricing_info['dtype']
     block_shapes = shadow_pricing_info['block_shapes']
 
     if model_selector not in block_shapes:
@@ -696,10 +626,10 @@ def shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_sele
     if block_name(model_selector) not in data_buffers:
         raise RuntimeError("Block %s not in data_buffers" % block_name(model_selector))
 
-    shape = block_shapes[model_selector]
     data = data_buffers[block_name(model_selector)]
+    assert data.shape == block_shapes[model_selector]
 
-    return np.frombuffer(data.get_obj(), dtype=dtype).reshape(shape), data.get_lock()
+    return data
 
 
 def load_shadow_price_calculator(model_settings):
@@ -733,18 +663,16 @@ def load_shadow_price_calculator(model_settings):
             shadow_pricing_info = get_shadow_pricing_info()
             inject.add_injectable('shadow_pricing_info', shadow_pricing_info)
 
-        # - extract data buffer and reshape as numpy array
-        data, lock = \
-            shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_selector)
+        # - extract data buffer
+        data = shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_selector)
     else:
         assert num_processes == 1
         data = None  # ShadowPriceCalculator will allocate its own data
-        lock = None
 
     # - ShadowPriceCalculator
     spc = ShadowPriceCalculator(
         model_settings,
-        num_processes, data, lock)
+        num_processes, data)
 
     return spc
 
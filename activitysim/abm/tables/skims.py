@@ -11,6 +11,7 @@ from future.utils import iteritems
 
 import sys
 import os
+import json
 import logging
 import multiprocessing
 
@@ -33,16 +34,61 @@ Read in the omx files and create the skim objects
 """
 
 
-def get_skim_info(omx_file_path, tags_to_load=None):
+def skim_storage_dtypes(skim_dtypes, skim_dtype):
+    """
+    parse skim_dtypes setting into key1 storage dtypes and quantization
+
+    skim_dtypes maps key1 to either a dtype name or a dict with dtype and optional scale and
+    offset (stored_value = round((value - offset) / scale), value = stored_value * scale + offset)
+
+    ::
+
+      skim_dtypes:
+        DIST: float16
+        DRV_LOC_WLK_BOARDS: int16
+        SOV_TIME:
+          dtype: int16
+          scale: 0.01
+
+    Returns
+    -------
+    key1_dtypes : dict {<key1>: <numpy type>}
+    key1_quantization : dict {<key1>: (<scale>, <offset>)} for key1s with scale or offset
+    """
+
+    key1_dtypes = {}
+    key1_quantization = {}
+
+    for key1, spec in iteritems(skim_dtypes or {}):
+
+        if not isinstance(spec, dict):
+            spec = {'dtype': spec}
+
+        dtype = np.dtype(spec.get('dtype', skim_dtype))
+        if dtype.kind not in 'fiu':
+            raise RuntimeError("skim_dtypes unsupported dtype %s for %s" % (dtype, key1))
+        key1_dtypes[key1] = dtype.type
+
+        scale = spec.get('scale', 1)
+        offset = spec.get('offset', 0)
+        if scale != 1 or offset != 0:
+            key1_quantization[key1] = (float(scale), float(offset))
+
+    return key1_dtypes, key1_quantization
+
+
+def get_skim_info(omx_file_path, tags_to_load=None, skim_dtypes=None):
 
     # this is sys.maxint for p2.7 but no limit for p3
     # windows sys.maxint =  2147483647
     MAX_BLOCK_BYTES = sys.maxint - 1 if sys.version_info < (3,) else sys.maxsize - 1
 
     # Note: we load all skims except those with key2 not in tags_to_load
-    # Note: we require all skims to be of same dtype so they can share buffer - is that ok?
-    # fixme is it ok to require skims be all the same type? if so, is this the right choice?
+    # Note: skims are stored as skim_dtype unless skim_dtypes specifies a (compact) storage dtype
+    # for their key1. Skims with the same storage dtype share blocks, and all skims with the same
+    # key1 are in the same block (so SkimStack can stack them). Lookups return skim_dtype values.
     skim_dtype = np.float32
+    key1_dtypes, key1_quantization = skim_storage_dtypes(skim_dtypes, skim_dtype)
     omx_name = os.path.splitext(os.path.basename(omx_file_path))[0]
 
     with omx.open_file(omx_file_path) as omx_file:
@@ -90,27 +136,47 @@ def get_skim_info(omx_file_path, tags_to_load=None):
     # DISTWALK: (0, 2),
     # DRV_COM_WLK_BOARDS: (0, 3), ...
 
-    if MAX_BLOCK_BYTES:
-        max_block_items = MAX_BLOCK_BYTES // np.dtype(skim_dtype).itemsize
-        max_skims_per_block = max_block_items // multiply_large_numbers(omx_shape)
-    else:
-        max_skims_per_block = num_skims
+    def max_skims_per_block(dtype):
+        if MAX_BLOCK_BYTES:
+            max_block_items = MAX_BLOCK_BYTES // np.dtype(dtype).itemsize
+            return max_block_items // multiply_large_numbers(omx_shape)
+        else:
+            return num_skims
 
     def block_name(block):
         return "skim_%s_%s" % (omx_name, block)
 
+    # - group key1s by storage dtype (skim_dtype first)
+    dtype_key1s = OrderedDict([(skim_dtype, [])])
+    for key1 in key1_subkeys:
+        dtype_key1s.setdefault(key1_dtypes.get(key1, skim_dtype), []).append(key1)
+
     key1_block_offsets = OrderedDict()
     blocks = OrderedDict()
-    block = offset = 0
-    for key1, v in iteritems(key1_subkeys):
-        num_subkeys = len(v)
-        if offset + num_subkeys > max_skims_per_block:  # next block
-            blocks[block_name(block)] = offset
-            block += 1
-            offset = 0
-        key1_block_offsets[key1] = (block, offset)
-        offset += num_subkeys
-    blocks[block_name(block)] = offset  # last block
+    block_dtypes = OrderedDict()
+    block = 0
+    for dtype, key1s in iteritems(dtype_key1s):
+
+        if not key1s:
+            continue
+
+        offset = 0
+        for key1 in key1s:
+            num_subkeys = len(key1_subkeys[key1])
+            if offset + num_subkeys > max_skims_per_block(dtype):  # next block
+                blocks[block_name(block)] = offset
+                block_dtypes[block_name(block)] = dtype
+                block += 1
+                offset = 0
+            key1_block_offsets[key1] = (block, offset)
+            offset += num_subkeys
+        blocks[block_name(block)] = offset  # last block of dtype
+        block_dtypes[block_name(block)] = dtype
+        block += 1
+
+    if not blocks:
+        blocks[block_name(0)] = 0
+        block_dtypes[block_name(0)] = skim_dtype
 
     # - block_offsets dict maps skim_key to (block, offset) of omx matrix
     # DIST: (0, 0),
@@ -143,20 +209,62 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         'key1_block_offsets': key1_block_offsets,
         'block_offsets': block_offsets,
         'blocks': blocks,
+        'block_dtypes': block_dtypes,
+        'key1_quantization':
+            {k: v for k, v in iteritems(key1_quantization) if k in key1_subkeys},
     }
 
     return skim_info
 
 
+def block_dtype(skim_info, block_name):
+    """
+    storage dtype of skim block
+    """
+    return skim_info.get('block_dtypes', {}).get(block_name, skim_info['dtype'])
+
+
+def skim_storage_values(skim_key, omx_data, skim_info, dtype):
+    """
+    convert skim values read from omx file to block storage dtype (applying any quantization)
+    """
+
+    key1 = skim_key[0] if isinstance(skim_key, tuple) else skim_key
+    quantization = skim_info.get('key1_quantization', {}).get(key1, None)
+
+    if quantization:
+        scale, offset = quantization
+        omx_data = (omx_data - offset) / scale
+
+    if np.issubdtype(dtype, np.integer):
+        omx_data = np.round(omx_data)
+        info = np.iinfo(dtype)
+        if np.isnan(omx_data).any() or \
+                omx_data.min() < info.min or omx_data.max() > info.max:
+            raise RuntimeError("skim %s values out of range for storage dtype %s" %
+                               (skim_key, np.dtype(dtype).name))
+    elif np.issubdtype(dtype, np.floating) and omx_data.size:
+        # finite values too large for a narrower float dtype would silently become inf
+        info = np.finfo(dtype)
+        finite_data = omx_data[np.isfinite(omx_data)]
+        if finite_data.size and \
+                (finite_data.min() < info.min or finite_data.max() > info.max):
+            raise RuntimeError("skim %s values out of range for storage dtype %s" %
+                               (skim_key, np.dtype(dtype).name))
+
+    return omx_data.astype(dtype, copy=False)
+
+
 def buffers_for_skims(skim_info, shared=False):
 
-    skim_dtype = skim_info['dtype']
     omx_shape = skim_info['omx_shape']
     blocks = skim_info['blocks']
 
     skim_buffers = {}
     for block_name, block_size in iteritems(blocks):
 
+        skim_dtype = block_dtype(skim_info, block_name)
+
         # buffer_size must be int (or p2.7 long), not np.int64
         buffer_size = int(multiply_large_numbers(omx_shape) * block_size)
 
@@ -165,11 +273,9 @@ def buffers_for_skims(skim_info, shared=False):
                     (block_name, buffer_size, omx_shape, util.GB(csz)))
 
         if shared:
-            if np.issubdtype(skim_dtype, np.float64):
-                typecode = 'd'
-            elif np.issubdtype(skim_dtype, np.float32):
-                typecode = 'f'
-            else:
+            # RawArray typecode with same itemsize (np.frombuffer reinterprets as skim_dtype)
+            typecode = {8: 'd', 4: 'f', 2: 'h', 1: 'b'}.get(np.dtype(skim_dtype).itemsize)
+            if typecode is None:
                 raise RuntimeError("buffers_for_skims unrecognized dtype %s" % skim_dtype)
 
             buffer = multiprocessing.RawArray(typecode, buffer_size)
@@ -186,7 +292,6 @@ def skim_data_from_buffers(skim_buffers, skim_info):
     assert type(skim_buffers) == dict
 
     omx_shape = skim_info['omx_shape']
-    skim_dtype = skim_info['dtype']
     blocks = skim_info['blocks']
 
     skim_data = []
@@ -194,7 +299,8 @@ def skim_data_from_buffers(skim_buffers, skim_info):
         skims_shape = omx_shape + (block_size,)
         block_buffer = skim_buffers[block_name]
         assert len(block_buffer) == int(multiply_large_numbers(skims_shape))
-        block_data = np.frombuffer(block_buffer, dtype=skim_dtype).reshape(skims_shape)
+        block_data = np.frombuffer(block_buffer, dtype=block_dtype(skim_info, block_name))
+        block_data = block_data.reshape(skims_shape)
         skim_data.append(block_data)
 
     return skim_data
@@ -222,44 +328,341 @@ def load_skims(omx_file_path, skim_info, skim_buffers):
 
             # this will trigger omx readslice to read and copy data to skim_data's buffer
             a = block_data[:, :, offset]
-            a[:] = omx_data[:]
+            a[:] = skim_storage_values(skim_key, omx_data[:], skim_info, block_data.dtype)
 
     logger.info("load_skims loaded skims from %s" % (omx_file_path, ))
 
 
+"""
+Memory-mapped skim store
+
+As an alternative to loading the OMX skims into (possibly shared) memory buffers at the start of
+every run, the skims can be written once to a native on-disk format: a raw (zones, zones, n_skims)
+file for each skim block, plus a small json manifest with the skim_info (e.g. block_offsets and
+key1_block_offsets) needed to find skims in the blocks. The block files are then np.memmap-ed
+read-only by every process, so the OS page cache shares them between sub-processes.
+
+The store is (re)built whenever the manifest doesn't match the current OMX file and tags_to_load.
+"""
+
+MEMMAP_MANIFEST_VERSION = 2
+
+
+def memmap_skims(settings):
+    return settings.get('memmap_skims', False)
+
+
+def memmap_dir(settings):
+
+    memmap_dir = settings.get('skim_memmap_dir', None)
+    if memmap_dir is None:
+        memmap_dir = os.path.join(inject.get_injectable('output_dir'), 'skim_memmap')
+
+    return memmap_dir
+
+
+def memmap_manifest_path(memmap_dir, omx_file_path):
+
+    omx_name = os.path.splitext(os.path.basename(omx_file_path))[0]
+    return os.path.join(memmap_dir, '%s.json' % omx_name)
+
+
+def memmap_block_path(memmap_dir, block_name):
+    return os.path.join(memmap_dir, '%s.mmap' % block_name)
+
+
+def omx_file_signature(omx_file_path, tags_to_load, skim_dtypes=None):
+    """
+    values identifying the skims selected from omx file (so we can tell if memmap store is stale)
+    """
+
+    stat = os.stat(omx_file_path)
+    return {
+        'omx_file_path': os.path.abspath(omx_file_path),
+        'omx_file_size': stat.st_size,
+        'omx_file_mtime': stat.st_mtime,
+        'tags_to_load': sorted(tags_to_load) if tags_to_load else None,
+        'skim_dtypes': skim_dtypes or None,
+    }
+
+
+def skim_info_to_manifest(skim_info, signature):
+    """
+    convert skim_info to json-friendly dict (skim_keys may be tuples, and dtype is a numpy type)
+    """
+
+    def encode_key(skim_key):
+        return list(skim_key) if isinstance(skim_key, tuple) else skim_key
+
+    return {
+        'version': MEMMAP_MANIFEST_VERSION,
+        'signature': signature,
+        'omx_name': skim_info['omx_name'],
+        'omx_shape': list(skim_info['omx_shape']),
+        'num_skims': skim_info['num_skims'],
+        'dtype': np.dtype(skim_info['dtype']).name,
+        'omx_keys': [[encode_key(k), v] for k, v in iteritems(skim_info['omx_keys'])],
+        'key1_block_offsets':
+            [[k, list(v)] for k, v in iteritems(skim_info['key1_block_offsets'])],
+        'block_offsets':
+            [[encode_key(k), list(v)] for k, v in iteritems(skim_info['block_offsets'])],
+        'blocks': [[k, v] for k, v in iteritems(skim_info['blocks'])],
+        'block_dtypes': [[k, np.dtype(v).name] for k, v in iteritems(skim_info['block_dtypes'])],
+        'key1_quantization': [[k, list(v)] for k, v in iteritems(skim_info['key1_quantization'])],
+    }
+
+
+def skim_info_from_manifest(manifest):
+
+    def decode_key(skim_key):
+        return tuple(skim_key) if isinstance(skim_key, list) else skim_key
+
+    skim_info = {
+        'omx_name': manifest['omx_name'],
+        'omx_shape': tuple(manifest['omx_shape']),
+        'num_skims': manifest['num_skims'],
+        'dtype': np.dtype(manifest['dtype']).type,
+        'omx_keys': OrderedDict((decode_key(k), v) for k, v in manifest['omx_keys']),
+        'key1_block_offsets':
+            OrderedDict((k, tuple(v)) for k, v in manifest['key1_block_offsets']),
+        'block_offsets':
+            OrderedDict((decode_key(k), tuple(v)) for k, v in manifest['block_offsets']),
+        'blocks': OrderedDict((k, v) for k, v in manifest['blocks']),
+        'block_dtypes': OrderedDict((k, np.dtype(v).type) for k, v in manifest['block_dtypes']),
+        'key1_quantization': {k: tuple(v) for k, v in manifest['key1_quantization']},
+    }
+
+    return skim_info
+
+
+def read_memmap_manifest(memmap_dir, omx_file_path, tags_to_load, skim_dtypes=None):
+    """
+    Read memmap store manifest and return skim_info, or None if store is missing or stale
+    """
+
+    manifest_path = memmap_manifest_path(memmap_dir, omx_file_path)
+
+    if not os.path.exists(manifest_path):
+        logger.info("memmap skim manifest %s not found" % manifest_path)
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != MEMMAP_MANIFEST_VERSION or \
+            manifest.get('signature') != \
+            omx_file_signature(omx_file_path, tags_to_load, skim_dtypes):
+        logger.info("memmap skim manifest %s is stale" % manifest_path)
+        return None
+
+    skim_info = skim_info_from_manifest(manifest)
+
+    for block_name in skim_info['blocks']:
+        if not os.path.exists(memmap_block_path(memmap_dir, block_name)):
+            logger.warning("memmap skim block %s missing" % block_name)
+            return None
+
+    return skim_info
+
+
+def build_memmap_skims(omx_file_path, tags_to_load, memmap_dir, skim_dtypes=None):
+    """
+    Write skims from omx file to raw block files and write json manifest
+
+    Manifest is written last, so a partially built store will be recognized as missing
+
+    Returns
+    -------
+    skim_info : dict
+    """
+
+    logger.info("build_memmap_skims from %s to %s" % (omx_file_path, memmap_dir))
+
+    skim_info = get_skim_info(omx_file_path, tags_to_load, skim_dtypes)
+
+    if not os.path.exists(memmap_dir):
+        os.makedirs(memmap_dir)
+
+    manifest_path = memmap_manifest_path(memmap_dir, omx_file_path)
+    if os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+
+    # flat memmap buffers, like buffers_for_skims, so load_skims can fill them
+    skim_buffers = {}
+    for block_name, block_size in iteritems(skim_info['blocks']):
+        buffer_size = int(multiply_large_numbers(skim_info['omx_shape']) * block_size)
+        block_path = memmap_block_path(memmap_dir, block_name)
+        skim_buffers[block_name] = \
+            np.memmap(block_path, dtype=block_dtype(skim_info, block_name), mode='w+',
+                      shape=(buffer_size,))
+
+    load_skims(omx_file_path, skim_info, skim_buffers)
+
+    for block_name, block_data in iteritems(skim_buffers):
+        block_data.flush()
+    del skim_buffers
+
+    manifest = skim_info_to_manifest(skim_info,
+                                     omx_file_signature(omx_file_path, tags_to_load, skim_dtypes))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return skim_info
+
+
+def setup_memmap_skims(omx_file_path, tags_to_load, memmap_dir, skim_dtypes=None):
+    """
+    Build memmap skim store if it is missing or stale
+
+    Returns
+    -------
+    skim_info : dict
+    """
+
+    skim_info = read_memmap_manifest(memmap_dir, omx_file_path, tags_to_load, skim_dtypes)
+
+    if skim_info is None:
+        skim_info = build_memmap_skims(omx_file_path, tags_to_load, memmap_dir, skim_dtypes)
+
+    return skim_info
+
+
+def skim_data_from_memmap(skim_info, memmap_dir):
+    """
+    Return list of read-only memmapped skim blocks
+    """
+
+    skim_data = []
+    for block_name, block_size in iteritems(skim_info['blocks']):
+        skims_shape = skim_info['omx_shape'] + (block_size,)
+        block_path = memmap_block_path(memmap_dir, block_name)
+        skim_data.append(np.memmap(block_path, dtype=block_dtype(skim_info, block_name),
+                                   mode='r', shape=skims_shape))
+
+    return skim_data
+
+
+"""
+Lazy skim loading
+
+With lazy_skims: True, no skim blocks are allocated. Instead, each skim is read from the omx file
+into its own contiguous (zones, zones) array the first time SkimDict or SkimStack use it, so
+skims that are never used take no memory. (A skim in a (zones, zones, n_skims) block is strided
+across every page of the block, so loading skims into blocks on demand would soon commit all of
+them.)
+
+track_skim_usage writes the skim keys used in a run to a usage manifest (skim_usage.yaml) which
+can be named in preload_skims setting to load those skims up front in subsequent runs.
+"""
+
+
+def lazy_skims(settings):
+    return settings.get('lazy_skims', False)
+
+
+class OmxSkimLoader(object):
+    """
+    skim_loader for lazy SkimDict - reads individual skims from omx file on demand
+    """
+
+    def __init__(self, omx_file_path, skim_info):
+
+        self.omx_file_path = omx_file_path
+        self.skim_info = skim_info
+
+    def __call__(self, skim_key):
+
+        omx_key = self.skim_info['omx_keys'][skim_key]
+        block, offset = self.skim_info['block_offsets'][skim_key]
+        block_name = list(self.skim_info['blocks'].keys())[block]
+        dtype = block_dtype(self.skim_info, block_name)
+
+        with omx.open_file(self.omx_file_path) as omx_file:
+            omx_data = omx_file[omx_key]
+            assert np.issubdtype(omx_data.dtype, np.floating)
+            data = skim_storage_values(skim_key, omx_data[:], self.skim_info, dtype)
+
+        return data
+
+
+def preload_skims(skim_dict, file_path):
+    """
+    load skims named in usage manifest from an earlier run into lazy skim_dict
+    """
+
+    skim_dict_keys, skim_stack_keys = skim.read_skim_usage_manifest(file_path)
+    skim_dict_keys = set(skim_dict_keys)
+
+    block_offsets = skim_dict.skim_info['block_offsets']
+    stack_keys = set(skim_stack_keys)
+    keys_to_load = [k for k in block_offsets
+                    if k in skim_dict_keys or (isinstance(k, tuple) and k[0] in stack_keys)]
+
+    logger.info("preload_skims loading %s skims from usage manifest %s" %
+                (len(keys_to_load), file_path))
+
+    for key in keys_to_load:
+        skim_dict.load(key)
+
+
 @inject.injectable(cache=True)
 def skim_dict(data_dir, settings):
 
     omx_file_path = config.data_file_path(settings["skims_file"])
     tags_to_load = settings['skim_time_periods']['labels']
 
+    if memmap_skims(settings):
+
+        logger.info("loading memmap skim_dict for %s" % (omx_file_path, ))
+
+        skim_memmap_dir = memmap_dir(settings)
+        skim_info = setup_memmap_skims(omx_file_path, tags_to_load, skim_memmap_dir,
+                                       settings.get('skim_dtypes', None))
+        skim_data = skim_data_from_memmap(skim_info, skim_memmap_dir)
+
+        skim_dict = skim.SkimDict(skim_data, skim_info)
+        skim_dict.offset_mapper.set_offset_int(-1)
+
+        return skim_dict
+
     logger.info("loading skim_dict from %s" % (omx_file_path, ))
 
     # select the skims to load
-    skim_info = get_skim_info(omx_file_path, tags_to_load)
+    skim_info = get_skim_info(omx_file_path, tags_to_load, settings.get('skim_dtypes', None))
 
     logger.debug("omx_shape %s skim_dtype %s" % (skim_info['omx_shape'], skim_info['dtype']))
 
+    skim_data = None
+    skim_loader = None
     skim_buffers = inject.get_injectable('data_buffers', None)
     if skim_buffers:
         logger.info('Using existing skim_buffers for skims')
+    elif lazy_skims(settings):
+        # no skim blocks - SkimDict keeps each skim it loads in its own array
+        logger.info('Lazy loading skims')
+        skim_loader = OmxSkimLoader(omx_file_path, skim_info)
     else:
         skim_buffers = buffers_for_skims(skim_info, shared=False)
         load_skims(omx_file_path, skim_info, skim_buffers)
 
-    skim_data = skim_data_from_buffers(skim_buffers, skim_info)
+    if skim_buffers:
+        skim_data = skim_data_from_buffers(skim_buffers, skim_info)
 
-    block_names = list(skim_info['blocks'].keys())
-    for i in range(len(skim_data)):
-        block_name = block_names[i]
-        block_data = skim_data[i]
-        logger.info("block_name %s bytes %s (%s)" %
-                    (block_name, block_data.nbytes, util.GB(block_data.nbytes)))
+        block_names = list(skim_info['blocks'].keys())
+        for i in range(len(skim_data)):
+            block_name = block_names[i]
+            block_data = skim_data[i]
+            logger.info("block_name %s bytes %s (%s)" %
+                        (block_name, block_data.nbytes, util.GB(block_data.nbytes)))
 
     # create skim dict
-    skim_dict = skim.SkimDict(skim_data, skim_info)
+    skim_dict = skim.SkimDict(skim_data, skim_info, skim_loader=skim_loader)
     skim_dict.offset_mapper.set_offset_int(-1)
 
+    usage_manifest = settings.get('preload_skims', None)
+    if skim_loader is not None and usage_manifest:
+        preload_skims(skim_dict, config.config_file_path(usage_manifest))
+
     return skim_dict
 
 
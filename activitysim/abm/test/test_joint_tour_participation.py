@@ -0,0 +1,37 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+from future.standard_library import install_aliases
+install_aliases()  # noqa: E402
+
+import pytest
+import numpy as np
+import pandas as pd
+
+from activitysim.abm.models import joint_tour_participation as jtp
+
+
+def test_satisfying_participation():
+
+    candidates = pd.DataFrame({
+        'tour_id': [1, 1, 1, 2, 2, 3, 3, 3],
+        'composition': ['mixed'] * 3 + ['adults'] * 2 + ['children'] * 3,
+        'adult': [True, False, True, True, True, False, False, False]},
+        index=pd.Index([101, 102, 103, 201, 202, 301, 302, 303], name='participant_id'))
+
+    # very unlikely to participate, so first choices wouldn't have satisfied any tours
+    probs = np.array([0.5, 0.001, 0.5, 0.001, 0.001, 0.2, 0.2, 0.2])
+
+    for rands in [np.zeros(8), np.full(8, 0.999), np.random.RandomState(0).rand(8)]:
+        participate = jtp.satisfying_participation(candidates, probs, rands)
+        assert jtp.get_tour_satisfaction(candidates, pd.Series(participate, candidates.index)).all()
+
+        # only child of mixed tour and both adults of two-adult tour have to participate
+        assert participate[[1, 3, 4]].all()
+
+    # a mixed tour without a child candidate can't be satisfied
+    with pytest.raises(RuntimeError) as excinfo:
+        jtp.satisfying_participation(candidates[candidates.tour_id == 1].iloc[[0, 2]],
+                                     probs[[0, 2]], np.zeros(2))
+    assert "can't be satisfied" in str(excinfo.value)
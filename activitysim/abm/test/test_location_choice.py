@@ -0,0 +1,30 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+from future.standard_library import install_aliases
+install_aliases()  # noqa: E402
+
+import pandas as pd
+
+from activitysim.abm.models.location_choice import changed_sample_choosers
+
+
+def test_changed_sample_choosers():
+
+    zones = pd.Index([1, 2, 3], name='TAZ')
+    last_size_terms = pd.DataFrame({'size_term': [10.0, 20.0, 30.0],
+                                    'shadow_price_size_term_adjustment': 1.0}, index=zones)
+
+    # zone 2 shadow price changed
+    size_terms = last_size_terms.copy()
+    size_terms.loc[2, 'shadow_price_size_term_adjustment'] = 1.5
+
+    location_sample = pd.DataFrame({'dest_TAZ': [1, 3, 2, 3, 1, 2]},
+                                   index=pd.Index([100, 100, 101, 101, 102, 102], name='person_id'))
+
+    changed = changed_sample_choosers(location_sample, size_terms, last_size_terms, 'dest_TAZ')
+    assert list(changed) == [101, 102]
+
+    assert len(changed_sample_choosers(location_sample, last_size_terms, last_size_terms,
+                                       'dest_TAZ')) == 0
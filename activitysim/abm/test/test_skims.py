@@ -1,9 +1,12 @@
+import os
+
 from collections import OrderedDict
 from future.utils import iteritems
 
 import numpy as np
 import pytest
 
+from activitysim.core import skim
 from activitysim.abm.tables import skims
 
 
@@ -65,3 +68,114 @@ def test_multiple_large_floats():
     calculated_value = skims.multiply_large_numbers([6205.1, 5423.2, 932.4, 15.4])
     actual_value = 483200518316.9472
     assert abs(calculated_value - actual_value) < 0.0001
+
+
+def test_memmap_skims(tmpdir):
+
+    omx_file_path = os.path.join(os.path.dirname(__file__), 'data', 'skims.omx')
+    tags_to_load = ['EA', 'AM', 'MD', 'PM', 'EV']
+    memmap_dir = str(tmpdir)
+
+    assert skims.read_memmap_manifest(memmap_dir, omx_file_path, tags_to_load) is None
+
+    memmap_info = skims.setup_memmap_skims(omx_file_path, tags_to_load, memmap_dir)
+
+    # manifest round-trips skim_info
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load)
+    assert skims.read_memmap_manifest(memmap_dir, omx_file_path, tags_to_load) == memmap_info
+    for k in ['omx_shape', 'num_skims', 'omx_keys', 'key1_block_offsets', 'block_offsets',
+              'blocks']:
+        assert memmap_info[k] == skim_info[k]
+
+    # stale if tags_to_load change
+    assert skims.read_memmap_manifest(memmap_dir, omx_file_path, ['AM']) is None
+
+    skim_buffers = skims.buffers_for_skims(skim_info, shared=False)
+    skims.load_skims(omx_file_path, skim_info, skim_buffers)
+    skim_data = skims.skim_data_from_buffers(skim_buffers, skim_info)
+
+    memmap_data = skims.skim_data_from_memmap(memmap_info, memmap_dir)
+
+    assert len(memmap_data) == len(skim_data)
+    for a, b in zip(memmap_data, skim_data):
+        assert not a.flags.writeable
+        np.testing.assert_array_equal(a, b)
+
+
+def test_skim_dtypes(tmpdir):
+
+    omx_file_path = os.path.join(os.path.dirname(__file__), 'data', 'skims.omx')
+    tags_to_load = ['EA', 'AM', 'MD', 'PM', 'EV']
+
+    skim_dtypes = {
+        'DIST': {'dtype': 'int16', 'scale': 0.01},
+        'DISTWALK': 'float16',
+        'DRV_COM_WLK_BOARDS': 'int8',
+    }
+
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load)
+    compact_info = skims.get_skim_info(omx_file_path, tags_to_load, skim_dtypes)
+
+    assert list(compact_info['block_dtypes'].values()) == \
+        [np.float32, np.int16, np.float16, np.int8]
+    assert compact_info['key1_quantization'] == {'DIST': (0.01, 0.0)}
+
+    def skim_dict_for(skim_info, shared):
+        skim_buffers = skims.buffers_for_skims(skim_info, shared=shared)
+        skims.load_skims(omx_file_path, skim_info, skim_buffers)
+        skim_data = skims.skim_data_from_buffers(skim_buffers, skim_info)
+        return skim.SkimDict(skim_data, skim_info)
+
+    skim_dict = skim_dict_for(skim_info, shared=False)
+    compact_dict = skim_dict_for(compact_info, shared=True)
+
+    compact_bytes = sum(d.nbytes for d in compact_dict.skim_data)
+    assert compact_bytes < sum(d.nbytes for d in skim_dict.skim_data)
+
+    orig = np.array([0, 5, 24, 11])
+    dest = np.array([3, 5, 0, 24])
+    for key, atol in [('DIST', 0.005), ('DISTWALK', 0.002), (('DRV_COM_WLK_BOARDS', 'AM'), 0),
+                      (('SOV_TIME', 'AM'), 0)]:
+        values = compact_dict.get(key).get(orig, dest)
+        assert values.dtype == np.float32
+        np.testing.assert_allclose(values, skim_dict.get(key).get(orig, dest), atol=atol)
+
+    compact_stack = skim.SkimStack(compact_dict)
+    values = compact_stack.lookup(orig, dest, np.array(['AM', 'PM', 'AM', 'MD']),
+                                  'DRV_COM_WLK_BOARDS')
+    expected = skim.SkimStack(skim_dict).lookup(orig, dest, np.array(['AM', 'PM', 'AM', 'MD']),
+                                                'DRV_COM_WLK_BOARDS')
+    np.testing.assert_array_equal(values, expected)
+
+    # memmap store round trips block_dtypes and quantization
+    memmap_dir = str(tmpdir)
+    memmap_info = skims.setup_memmap_skims(omx_file_path, tags_to_load, memmap_dir, skim_dtypes)
+    assert memmap_info['block_dtypes'] == compact_info['block_dtypes']
+    assert memmap_info['key1_quantization'] == compact_info['key1_quantization']
+    assert skims.read_memmap_manifest(memmap_dir, omx_file_path, tags_to_load) is None
+
+    memmap_data = skims.skim_data_from_memmap(memmap_info, memmap_dir)
+    for a, b in zip(memmap_data, compact_dict.skim_data):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+
+
+def test_skim_storage_values_range():
+
+    skim_info = {'key1_quantization': {'DIST': (0.01, 0.0)}}
+    omx_data = np.array([[0.0, 1.5], [70000.0, np.inf]])
+
+    np.testing.assert_array_equal(
+        skims.skim_storage_values('TIME', omx_data, skim_info, np.float32), omx_data)
+
+    # finite values above float16 max (65504) would become inf
+    with pytest.raises(RuntimeError) as excinfo:
+        skims.skim_storage_values('TIME', omx_data, skim_info, np.float16)
+    assert "out of range for storage dtype float16" in str(excinfo.value)
+
+    # quantized values (700 / 0.01 = 70000) would wrap in int16
+    np.testing.assert_array_equal(
+        skims.skim_storage_values('DIST', np.array([[300.0]]), skim_info, np.int16), [[30000]])
+    with pytest.raises(RuntimeError) as excinfo:
+        skims.skim_storage_values('DIST', np.array([[700.0]]), skim_info, np.int16)
+    assert "out of range for storage dtype int16" in str(excinfo.value)
@@ -0,0 +1,87 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+from future.standard_library import install_aliases
+install_aliases()  # noqa: E402
+
+import numpy as np
+
+from activitysim.abm.models import trip_scheduling
+
+
+def test_schedule_departs():
+
+    # five depart periods 5-9
+    uniform = [0.2] * 5
+    probs = np.array([
+        [1, 0, 0, 0, 0],  # leg 1 trip 1 must depart at 5
+        uniform,          # leg 1 trip 2 can only depart at 5 or 6 (cum probs 0.2, 0.4)
+        [0, 0, 1, 0, 0],  # leg 1 trip 3 must depart at 7
+        [0, 0, 0, 1, 0],  # leg 2 trip 1 can only depart at 8, after its latest
+    ], dtype=float)
+    earliest = np.array([5, 5, 5, 5])
+    latest = np.array([9, 6, 9, 6])
+    leg_length = np.array([3, 1])
+    rands = np.full(4, 0.5)
+
+    depart, failed = trip_scheduling.schedule_departs(
+        probs, earliest, latest, leg_length, rands, outbound=True, depart_alt_base=5)
+
+    # residual probs of trip 2 (0.6) are 'fail' as only first trip in leg is renormalized
+    assert list(depart) == [5, trip_scheduling.NO_DEPART, 7, trip_scheduling.NO_DEPART]
+    assert list(failed) == [False, True, False, True]
+
+    depart, failed = trip_scheduling.schedule_departs(
+        probs, earliest, latest, leg_length, rands, outbound=True, depart_alt_base=5,
+        choose_most_initial=True)
+
+    # failed outbound trips get their earliest depart
+    assert list(depart) == [5, 5, 7, 5]
+    assert list(failed) == [False, True, False, True]
+
+    depart, failed = trip_scheduling.schedule_departs(
+        probs[3:], earliest[3:], latest[3:], leg_length[1:], rands[3:], outbound=False,
+        depart_alt_base=5, choose_most_initial=True)
+
+    # failed inbound trips get their latest depart
+    assert list(depart) == [6]
+    assert list(failed) == [True]
+
+
+def test_schedule_departs_constrained_by_prior_trips():
+
+    # five depart periods 5-9, with every trip allowed to depart 5-9
+    uniform = [0.2] * 5
+    probs = np.array([
+        [0, 0, 1, 0, 0],  # trip 1 must depart at 7
+        uniform,          # trip 2 can't depart before trip 1
+        [1, 0, 0, 0, 0],  # trip 3 can only depart at 5, before trips 1 and 2
+    ], dtype=float)
+    earliest = np.full(3, 5)
+    latest = np.full(3, 9)
+    leg_length = np.array([3])
+    rands = np.full(3, 0.5)
+
+    depart, failed = trip_scheduling.schedule_departs(
+        probs, earliest, latest, leg_length, rands, outbound=True, depart_alt_base=5)
+
+    # trip 2 chooses from 7-9 (cum probs 0.2, 0.4, 0.6) and residual 0.4 is 'fail'
+    assert list(depart) == [7, 9, trip_scheduling.NO_DEPART]
+    assert list(failed) == [False, False, True]
+
+    depart, failed = trip_scheduling.schedule_departs(
+        probs, earliest, latest, leg_length, rands, outbound=True, depart_alt_base=5,
+        choose_most_initial=True)
+
+    # failed trip gets earliest depart allowed after prior trip
+    assert list(depart) == [7, 9, 9]
+
+    # inbound trips constrain the latest depart of the trip before them
+    depart, failed = trip_scheduling.schedule_departs(
+        probs[:2, ::-1], earliest[:2], latest[:2], np.array([2]), np.array([0.5, 0.5]),
+        outbound=False, depart_alt_base=5)
+
+    # trip 2 chooses from 5-7 (cum probs 0.2, 0.4, 0.6)
+    assert list(depart) == [7, 7]
+    assert not failed.any()
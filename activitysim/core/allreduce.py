@@ -0,0 +1,117 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+from future.standard_library import install_aliases
+install_aliases()  # noqa: E402
+
+from builtins import object
+
+import logging
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+"""
+Cross-process aggregation for multiprocessed models
+
+An AllReduce is allocated by the parent process and passed to sub-processes (e.g. in the
+shared data_buffers dict) which each call sum() with their local array. sum() is a barrier:
+it returns the element-wise sum of every process's local array, once all of them have arrived.
+Waiting processes block on a multiprocessing.Condition and are woken as soon as the last process
+arrives, rather than polling. The same AllReduce can be used for any number of rounds.
+"""
+
+# indexes of counters in AllReduce tally
+CHECKIN = 0
+GENERATION = 1
+
+CTYPES = {
+    np.dtype(np.int64): ctypes.c_int64,
+    np.dtype(np.float64): ctypes.c_double,
+}
+
+
+class AllReduce(object):
+
+    def __init__(self, shape, dtype=np.int64):
+        """
+        Allocate shared buffers (and condition to coordinate access to them) to sum an array
+        of the specified shape and dtype across processes.
+
+        Must be called by the parent process before the sub-processes are started.
+
+        Parameters
+        ----------
+        shape : tuple of int
+        dtype : numpy dtype (int64 or float64)
+        """
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        if self.dtype not in CTYPES:
+            raise RuntimeError("AllReduce unrecognized dtype %s" % self.dtype)
+
+        # buffer_size must be int (or p2.7 long), not np.int64
+        buffer_size = int(np.prod(self.shape))
+
+        # accumulator for current round and result of last completed round
+        self.data = multiprocessing.RawArray(CTYPES[self.dtype], 2 * buffer_size)
+        # count of processes checked in to current round and count of completed rounds
+        self.tally = multiprocessing.RawArray(ctypes.c_int64, 2)
+        self.condition = multiprocessing.Condition()
+
+    @property
+    def nbytes(self):
+        return ctypes.sizeof(self.data) + ctypes.sizeof(self.tally)
+
+    def sum(self, local_data, num_processes):
+        """
+        Add local_data to this round's total and wait until all num_processes processes have
+        done the same, then return the total.
+
+        The last process to arrive publishes the total, resets the accumulator for the next round,
+        and wakes the others. Since every process copies the total before it can check in to the
+        next round, the published total can't be overwritten until they all have their copy.
+
+        Parameters
+        ----------
+        local_data : numpy.ndarray
+            this process's contribution, with same shape as AllReduce
+        num_processes : int
+            number of processes participating in this round
+
+        Returns
+        -------
+        total : numpy.ndarray
+            (copy of) element-wise sum of local_data from all processes
+        """
+
+        assert local_data.shape == self.shape
+
+        data = np.frombuffer(self.data, dtype=self.dtype).reshape((2,) + self.shape)
+        accumulator, result = data[0], data[1]
+        tally = np.frombuffer(self.tally, dtype=np.int64)
+
+        with self.condition:
+
+            generation = tally[GENERATION]
+
+            accumulator += local_data
+            tally[CHECKIN] += 1
+
+            if tally[CHECKIN] == num_processes:
+                result[...] = accumulator
+                accumulator[...] = 0
+                tally[CHECKIN] = 0
+                tally[GENERATION] += 1
+                self.condition.notify_all()
+            else:
+                while tally[GENERATION] == generation:
+                    self.condition.wait()
+
+            return result.copy()
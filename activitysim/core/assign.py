@@ -17,6 +17,7 @@ import pandas as pd
 from activitysim.core import util
 from activitysim.core import config
 from activitysim.core import pipeline
+from activitysim.core import spec_compiler
 
 logger = logging.getLogger(__name__)
 
@@ -236,8 +237,12 @@ def assign_variables(assignment_expressions, df, locals_dict, df_alias=None, tra
 
     # need to be able to identify which variables causes an error, which keeps
     # this from being expressed more parsimoniously
-    for e in zip(assignment_expressions.target, assignment_expressions.expression):
-        target, expression = e
+    # assignment expressions are python expressions, compiled once and cached
+    compiled_spec = \
+        spec_compiler.compile_spec(assignment_expressions.expression, python=True)
+
+    for target, compiled_expr in zip(assignment_expressions.target, compiled_spec):
+        expression = compiled_expr.expr
 
         assert isinstance(target, str), \
             "expected target '%s' for expression '%s' to be string not %s" % \
@@ -248,7 +253,7 @@ def assign_variables(assignment_expressions, df, locals_dict, df_alias=None, tra
 
         if is_temp_scalar(target) or is_throwaway(target):
             try:
-                x = eval(expression, globals(), _locals_dict)
+                x = compiled_expr.evaluate(df, globals(), _locals_dict)
             except Exception as err:
                 logger.error("assign_variables error: %s: %s", type(err).__name__, str(err))
                 logger.error("assign_variables expression: %s = %s", str(target), str(expression))
@@ -270,7 +275,7 @@ def assign_variables(assignment_expressions, df, locals_dict, df_alias=None, tra
 
             # FIXME should whitelist globals for security?
             globals_dict = {}
-            expr_values = to_series(eval(expression, globals_dict, _locals_dict))
+            expr_values = to_series(compiled_expr.evaluate(df, globals_dict, _locals_dict))
 
             np.seterr(**save_err)
             np.seterrcall(saved_handler)
@@ -0,0 +1,218 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+from future.standard_library import install_aliases
+install_aliases()  # noqa: E402
+
+from builtins import object
+
+import os
+import shutil
+import logging
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from activitysim.core import config
+
+logger = logging.getLogger(__name__)
+
+HDF5_FORMAT = 'hdf5'
+PARQUET_FORMAT = 'parquet'
+
+# suffix of directory holding parquet checkpoint files (in place of pipeline file name extension)
+PARQUET_DIR_SUFFIX = '_parquet'
+
+
+class HdfCheckpointStore(object):
+    """
+    Pipeline checkpoint store with every (table, checkpoint) stored as an hdf5 key in a single file
+
+    This is the original (and default) pipeline store format.
+    """
+
+    def __init__(self, path, mode='a'):
+
+        self.path = path
+        self.store = pd.HDFStore(path, mode=mode)
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __setitem__(self, key, df):
+        self.store[key] = df
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, key, columns=None):
+        """
+        Read df stored under key, optionally only returning the specified columns
+
+        (fixed format hdf5 can't read a subset of columns, so this reads the whole df)
+        """
+        df = self.store[key]
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def write(self, key, df):
+        self.store[key] = df
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+class ParquetCheckpointStore(object):
+    """
+    Pipeline checkpoint store with every (table, checkpoint) stored as a separate parquet file
+    in a directory named for the pipeline file.
+
+    Categorical columns are stored dictionary encoded, and files are compressed. Since parquet is
+    columnar, reading a subset of a table's columns only reads those columns from disk.
+
+    Requires pyarrow.
+    """
+
+    def __init__(self, path, mode='a', compression='snappy'):
+
+        if pyarrow is None:
+            raise RuntimeError("checkpoint_format '%s' requires pyarrow" % PARQUET_FORMAT)
+
+        if mode == 'r' and not os.path.isdir(path):
+            raise RuntimeError("parquet checkpoint store %s not found" % path)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.mode = mode
+        self.compression = compression
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def __setitem__(self, key, df):
+        self.write(key, df)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.file_path(key))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def file_path(self, key):
+        return os.path.join(self.path, *key.split('/')) + '.parquet'
+
+    def read(self, key, columns=None):
+        """
+        Read df stored under key, optionally only reading the specified columns (and the index)
+        """
+
+        file_path = self.file_path(key)
+        if not os.path.isfile(file_path):
+            raise KeyError("No object named %s in the checkpoint store" % key)
+
+        table = pyarrow.parquet.read_table(file_path, columns=columns, use_pandas_metadata=True)
+        return table.to_pandas()
+
+    def write(self, key, df):
+
+        assert self.mode != 'r'
+
+        file_path = self.file_path(key)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+
+        table = pyarrow.Table.from_pandas(df, preserve_index=True)
+        pyarrow.parquet.write_table(table, file_path,
+                                    use_dictionary=True, compression=self.compression)
+
+    def close(self):
+        pass
+
+
+def checkpoint_format():
+    """
+    Return checkpoint_format setting (hdf5 or parquet)
+    """
+
+    store_format = config.setting('checkpoint_format', HDF5_FORMAT)
+
+    if store_format not in [HDF5_FORMAT, PARQUET_FORMAT]:
+        raise RuntimeError("unrecognized checkpoint_format '%s'" % store_format)
+
+    return store_format
+
+
+def store_path(pipeline_path):
+    """
+    Return path of the checkpoint store for pipeline_path in the configured checkpoint_format
+
+    Parquet stores are directories named for the pipeline file (without extension.)
+    """
+
+    if checkpoint_format() == PARQUET_FORMAT:
+        return os.path.splitext(pipeline_path)[0] + PARQUET_DIR_SUFFIX
+
+    return pipeline_path
+
+
+def store_exists(pipeline_path):
+
+    return os.path.exists(store_path(pipeline_path))
+
+
+def remove_store(pipeline_path):
+    """
+    Remove checkpoint store for pipeline_path (if it exists)
+    """
+
+    path = store_path(pipeline_path)
+
+    if os.path.isdir(path):
+        logger.debug("removing checkpoint store: %s" % path)
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        logger.debug("removing checkpoint store: %s" % path)
+        os.unlink(path)
+
+
+def open_store(pipeline_path, mode='a'):
+    """
+    Open checkpoint store for pipeline_path in the format specified by checkpoint_format setting
+
+    Parameters
+    ----------
+    pipeline_path : str
+        path of pipeline file (e.g. output/pipeline.h5)
+    mode : str
+        'r' or 'a'
+
+    Returns
+    -------
+    store : HdfCheckpointStore or ParquetCheckpointStore
+    """
+
+    path = store_path(pipeline_path)
+
+    if checkpoint_format() == PARQUET_FORMAT:
+        return ParquetCheckpointStore(path, mode=mode)
+
+    return HdfCheckpointStore(path, mode=mode)
@@ -7,6 +7,7 @@ install_aliases()  # noqa: E402
 
 from builtins import input
 
+import os
 import logging
 from collections import OrderedDict
 
@@ -15,6 +16,7 @@ import pandas as pd
 
 from . import util
 from . import mem
+from . import config
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +30,36 @@ EFFECTIVE_CHUNK_SIZE = []
 
 HWM = [{}]
 
+"""
+Adaptive chunking
+
+If the adaptive_chunking setting is True, chunk_size is treated as a memory budget (in bytes)
+rather than a number of elements, and rows_per_chunk is based on the bytes per chooser row that
+were actually used rather than on the (hand written) row_size estimates of calc_rows_per_chunk.
+
+The chunked_choosers generators measure the bytes used by the first chunk of each trace_label
+(the larger of the CHUNK_LOG bytes and the growth in RSS while the chunk was open) and resize
+the remaining chunks to fit the budget. Calibrated bytes per row are saved to CHUNK_CACHE_FILE
+in the output directory (with process name prefix when multiprocessing) so that rows_per_chunk
+of the next run can start with the calibrated values.
+"""
+
+CHUNK_CACHE_FILE = 'chunk_cache.csv'
+
+# row_size estimates are number of elements (mostly float64)
+BYTES_PER_ELEMENT = 8
+
+# dict of calibrated bytes_per_row keyed by trace_label (lazy loaded from CHUNK_CACHE_FILE)
+CALIBRATED_ROW_BYTES = {}
+CALIBRATION_LOADED = []
+
+# dict of chunk_size (memory budget) keyed by trace_label of adaptive chunkers
+ADAPTIVE_CHUNK_SIZE = {}
+
+# memory measurements for base chunker: bytes and rss at log_open, high water marks, and
+# peak bytes used by last closed base chunker
+CHUNK_MEASURE = {}
+
 
 def GB(bytes):
     # symbols = ('', 'K', 'M', 'G', 'T')
@@ -60,6 +92,12 @@ def log_open(trace_label, chunk_size, effective_chunk_size):
     logger.debug("log_open chunker %s chunk_size %s effective_chunk_size %s" %
                  (trace_label, commas(chunk_size), commas(effective_chunk_size)))
 
+    # - start measuring memory used by base chunker
+    if len(CHUNK_LOG) == 0:
+        CHUNK_MEASURE['rss'] = CHUNK_MEASURE['peak_rss'] = mem.get_memory_info()
+        CHUNK_MEASURE['peak_bytes'] = 0
+        CHUNK_MEASURE.pop('last_chunk_bytes', None)
+
     CHUNK_LOG[trace_label] = OrderedDict()
     CHUNK_SIZE.append(chunk_size)
     EFFECTIVE_CHUNK_SIZE.append(effective_chunk_size)
@@ -77,6 +115,10 @@ def log_close(trace_label):
     if len(CHUNK_LOG) == 1:
         log_write_hwm()
 
+        # bytes used by chunk for adaptive chunking
+        CHUNK_MEASURE['last_chunk_bytes'] = \
+            max(CHUNK_MEASURE['peak_bytes'], CHUNK_MEASURE['peak_rss'] - CHUNK_MEASURE['rss'])
+
     label, _ = CHUNK_LOG.popitem(last=True)
     assert label == trace_label
     CHUNK_SIZE.pop()
@@ -130,6 +172,9 @@ def log_df(trace_label, table_name, df):
 
     mem.trace_memory_info(hwm_trace_label)
 
+    CHUNK_MEASURE['peak_bytes'] = max(CHUNK_MEASURE.get('peak_bytes', 0), total_bytes)
+    CHUNK_MEASURE['peak_rss'] = max(CHUNK_MEASURE.get('peak_rss', 0), cur_mem)
+
     # - check high_water_marks
 
     info = "elements: %s bytes: %s mem: %s chunk_size: %s effective_chunk_size: %s" % \
@@ -175,26 +220,115 @@ def log_write_hwm():
         logger.debug("#chunk_hwm high_water_mark %s: %s (%s) in %s" %
                      (tag, hwm['mark'], hwm['info'], hwm['trace_label']), )
 
-    # - elements shouldn't exceed chunk_size or effective_chunk_size of base chunker
-    def check_chunk_size(hwm, chunk_size, label, max_leeway):
-        elements = hwm['mark']
-        if chunk_size and max_leeway and elements > chunk_size * max_leeway:  # too high
+    # - elements (or bytes, if adaptive chunking) shouldn't exceed chunk_size or
+    # effective_chunk_size of base chunker
+    def check_chunk_size(hwm, tag, chunk_size, label, max_leeway):
+        mark = hwm['mark']
+        if chunk_size and max_leeway and mark > chunk_size * max_leeway:  # too high
             # FIXME check for #warning in log - there is nothing the user can do about this
-            logger.debug("#chunk_hwm #warning total_elements (%s) > %s (%s) %s : %s " %
-                         (commas(elements), label, commas(chunk_size),
+            logger.debug("#chunk_hwm #warning total_%s (%s) > %s (%s) %s : %s " %
+                         (tag, commas(mark), label, commas(chunk_size),
                           hwm['info'], hwm['trace_label']))
 
     # if we are in a chunker
     if len(HWM) > 1 and HWM[1]:
-        assert 'elements' in HWM[1]  # expect an 'elements' hwm dict for base chunker
-        hwm = HWM[1].get('elements')
-        check_chunk_size(hwm, EFFECTIVE_CHUNK_SIZE[0],  'effective_chunk_size', max_leeway=1.1)
-        check_chunk_size(hwm, CHUNK_SIZE[0], 'chunk_size', max_leeway=1)
+        # adaptive chunk_size is a memory budget in bytes rather than a number of elements
+        tag = 'bytes' if adaptive_chunking() else 'elements'
+        assert tag in HWM[1]  # expect a hwm dict for base chunker
+        hwm = HWM[1].get(tag)
+        check_chunk_size(hwm, tag, EFFECTIVE_CHUNK_SIZE[0], 'effective_chunk_size',
+                         max_leeway=1.1)
+        check_chunk_size(hwm, tag, CHUNK_SIZE[0], 'chunk_size', max_leeway=1)
+
+
+def adaptive_chunking():
+    return config.setting('adaptive_chunking', False)
+
+
+def chunk_cache_path():
+    return config.log_file_path(CHUNK_CACHE_FILE)
+
+
+def calibrated_row_bytes(trace_label):
+    """
+    Return calibrated bytes_per_row for trace_label from this or a previous run (or None)
+    """
+
+    if not CALIBRATION_LOADED:
+        CALIBRATION_LOADED.append(True)
+        file_path = chunk_cache_path()
+        if os.path.isfile(file_path):
+            df = pd.read_csv(file_path, index_col='trace_label')
+            CALIBRATED_ROW_BYTES.update(df.bytes_per_row.to_dict())
+            logger.info("read %s calibrated chunk row sizes from %s" % (len(df), file_path))
+
+    return CALIBRATED_ROW_BYTES.get(trace_label)
+
+
+def write_chunk_cache():
+
+    df = pd.DataFrame({'bytes_per_row': pd.Series(CALIBRATED_ROW_BYTES)})
+    df.index.name = 'trace_label'
+    df['rows_per_chunk'] = \
+        [max(int(ADAPTIVE_CHUNK_SIZE.get(t, 0) / b), 1) if b else 0 for t, b in
+         zip(df.index, df.bytes_per_row)]
+    df.sort_index().to_csv(chunk_cache_path())
+
+
+def adapt_rows_per_chunk(trace_label, i, rows_per_chunk, chunk_rows):
+    """
+    Called by chunked_choosers generators after the caller is finished with chunk i.
+
+    If adaptive chunking trace_label, measure the bytes per row actually used by the first chunk,
+    save it to chunk cache, and return rows_per_chunk to fit chunk_size for the remaining chunks.
+
+    Parameters
+    ----------
+    trace_label : str or None
+        trace_label passed to rows_per_chunk
+    i : int
+        one-based index of chunk just finished
+    rows_per_chunk : int
+        current rows_per_chunk
+    chunk_rows : int
+        number of rows in chunk just finished
+
+    Returns
+    -------
+    rows_per_chunk : int
+    """
+
+    if i != 1 or trace_label not in ADAPTIVE_CHUNK_SIZE:
+        return rows_per_chunk
+
+    chunk_bytes = CHUNK_MEASURE.get('last_chunk_bytes')
+    if not chunk_bytes or not chunk_rows:
+        return rows_per_chunk
+
+    bytes_per_row = chunk_bytes / float(chunk_rows)
+    CALIBRATED_ROW_BYTES[trace_label] = bytes_per_row
+    write_chunk_cache()
+
+    rpc = max(int(ADAPTIVE_CHUNK_SIZE[trace_label] / bytes_per_row), 1)
+
+    logger.debug("#chunk_calc adapt rows_per_chunk from %s to %s (bytes_per_row %s) : %s" %
+                 (rows_per_chunk, rpc, commas(bytes_per_row), trace_label))
+
+    return rpc
 
 
 def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
 
-    if chunk_size > 0:
+    if chunk_size > 0 and adaptive_chunking():
+        # chunk_size is memory budget in bytes
+        ADAPTIVE_CHUNK_SIZE[trace_label] = chunk_size
+        bytes_per_row = calibrated_row_bytes(trace_label)
+        if bytes_per_row is None:
+            bytes_per_row = row_size * BYTES_PER_ELEMENT
+        rpc = int(chunk_size / float(bytes_per_row))
+        # effective_chunk_size (row_size * rows_per_chunk) is in bytes too
+        row_size = bytes_per_row
+    elif chunk_size > 0:
         # closest number of chooser rows to achieve chunk_size without exceeding
         rpc = int(chunk_size / float(row_size))
     else:
@@ -214,22 +348,34 @@ def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
     return rpc, effective_chunk_size
 
 
-def chunked_choosers(choosers, rows_per_chunk):
+def num_chunks_remaining(num_choosers, offset, rows_per_chunk):
+    num_choosers = num_choosers - offset
+    return (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+
+
+def chunked_choosers(choosers, rows_per_chunk, trace_label=None):
 
     assert choosers.shape[0] > 0
 
     # generator to iterate over choosers in chunk_size chunks
+    # (with trace_label for adaptive chunking, num_chunks may change after the first chunk)
     num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+    num_chunks = num_chunks_remaining(num_choosers, 0, rows_per_chunk)
 
     i = offset = 0
     while offset < num_choosers:
-        yield i+1, num_chunks, choosers.iloc[offset: offset+rows_per_chunk]
+        chooser_chunk = choosers.iloc[offset: offset+rows_per_chunk]
+        yield i+1, num_chunks, chooser_chunk
         offset += rows_per_chunk
         i += 1
 
+        rpc = adapt_rows_per_chunk(trace_label, i, rows_per_chunk, len(chooser_chunk))
+        if rpc != rows_per_chunk:
+            rows_per_chunk = rpc
+            num_chunks = i + num_chunks_remaining(num_choosers, offset, rows_per_chunk)
+
 
-def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
+def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk, trace_label=None):
     """
     generator to iterate over choosers and alternatives in chunk_size chunks
 
@@ -250,6 +396,8 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     alternatives : pandas DataFrame
         sample alternatives including pick_count column in same order as choosers
     rows_per_chunk : int
+    trace_label : str or None
+        trace_label passed to rows_per_chunk (for adaptive chunking)
 
     Yields
     -------
@@ -277,37 +425,40 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     assert 'pick_count' in alternatives.columns or choosers.index.name == alternatives.index.name
 
     num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+    num_chunks = num_chunks_remaining(num_choosers, 0, rows_per_chunk)
 
     assert choosers.index.name == alternatives.index.name
 
     # alt chunks boundaries are where index changes
     alt_ids = alternatives.index.values
-    alt_chunk_end = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
-    alt_chunk_end = np.append([0], alt_chunk_end)  # including the first...
-    alt_chunk_end = alt_chunk_end[rows_per_chunk::rows_per_chunk]
+    alt_chooser_start = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
+    alt_chooser_start = np.append([0], alt_chooser_start)  # including the first...
 
     # add index to end of array to capture any final partial chunk
-    alt_chunk_end = np.append(alt_chunk_end, [len(alternatives.index)])
+    alt_chooser_start = np.append(alt_chooser_start, [len(alternatives.index)])
 
-    i = offset = alt_offset = 0
+    i = offset = 0
     while offset < num_choosers:
 
-        alt_end = alt_chunk_end[i]
+        end = min(offset + rows_per_chunk, num_choosers)
 
-        chooser_chunk = choosers[offset: offset + rows_per_chunk]
-        alternative_chunk = alternatives[alt_offset: alt_end]
+        chooser_chunk = choosers[offset: end]
+        alternative_chunk = alternatives[alt_chooser_start[offset]: alt_chooser_start[end]]
 
         assert len(chooser_chunk.index) == len(np.unique(alternative_chunk.index.values))
 
         yield i+1, num_chunks, chooser_chunk, alternative_chunk
 
         i += 1
-        offset += rows_per_chunk
-        alt_offset = alt_end
+        offset = end
+
+        rpc = adapt_rows_per_chunk(trace_label, i, rows_per_chunk, len(chooser_chunk))
+        if rpc != rows_per_chunk:
+            rows_per_chunk = rpc
+            num_chunks = i + num_chunks_remaining(num_choosers, offset, rows_per_chunk)
 
 
-def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
+def chunked_choosers_by_chunk_id(choosers, rows_per_chunk, trace_label=None):
     # generator to iterate over choosers in chunk_size chunks
     # like chunked_choosers but based on chunk_id field rather than dataframe length
     # (the presumption is that choosers has multiple rows with the same chunk_id that
@@ -317,7 +468,7 @@ def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
     assert choosers.shape[0] > 0
 
     num_choosers = choosers['chunk_id'].max() + 1
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+    num_chunks = num_chunks_remaining(num_choosers, 0, rows_per_chunk)
 
     i = offset = 0
     while offset < num_choosers:
@@ -325,3 +476,10 @@ def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
         yield i+1, num_chunks, chooser_chunk
         offset += rows_per_chunk
         i += 1
+
+        # rows_per_chunk is number of chunk_ids (e.g. households) so chunk_rows is too
+        rpc = adapt_rows_per_chunk(trace_label, i, rows_per_chunk,
+                                   chooser_chunk['chunk_id'].nunique())
+        if rpc != rows_per_chunk:
+            rows_per_chunk = rpc
+            num_chunks = i + num_chunks_remaining(num_choosers, offset, rows_per_chunk)
@@ -66,6 +66,12 @@ def rng_base_seed():
     return 0
 
 
+@inject.injectable(cache=True)
+def rng_channel_type(settings):
+    # 'simple' (default) or 'counter' - see random.Random.set_channel_type
+    return settings.get('rng_channel_type', None)
+
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -8,6 +8,8 @@ install_aliases()  # noqa: E402
 
 from builtins import range
 
+from future.utils import iteritems
+
 import logging
 
 from math import ceil
@@ -19,10 +21,15 @@ from activitysim.core.mem import force_garbage_collect
 from . import logit
 from . import tracing
 from . import chunk
+from . import config
+from . import spec_compiler
 from .simulate import set_skim_wrapper_targets
+from .simulate import skim_wrapper_columns
 
 
 from .interaction_simulate import eval_interaction_utilities
+from .interaction_simulate import interaction_dataset_columns
+from .interaction_simulate import interaction_dataset_row_sizes
 from . import pipeline
 
 logger = logging.getLogger(__name__)
@@ -130,89 +137,26 @@ def make_sample_choices(
     return choices_df
 
 
-def _interaction_sample(
-        choosers, alternatives,
-        spec, sample_size, alt_col_name, allow_zero_probs,
-        skims=None, locals_d=None,
-        trace_label=None):
+def _sample_choices(
+        choosers, alternatives, spec, sample_size, alt_col_name, allow_zero_probs,
+        skims, locals_d, have_trace_targets, trace_label):
     """
-    Run a MNL simulation in the situation in which alternatives must
-    be merged with choosers because there are interaction terms or
-    because alternatives are being sampled.
-
-    Parameters are same as for public function interaction_sa,ple
-
-    spec : dataframe
-        one row per spec expression and one col with utility coefficient
-
-    interaction_df : dataframe
-        cross join (cartesian product) of choosers with alternatives
-        combines columns of choosers and alternatives
-        len(df) == len(choosers) * len(alternatives)
-        index values (non-unique) are index values from alternatives df
-
-    interaction_utilities : dataframe
-        the utility of each alternative is sum of the partial utilities determined by the
-        various spec expressions and their corresponding coefficients
-        yielding a dataframe  with len(interaction_df) rows and one utility column
-        having the same index as interaction_df (non-unique values from alternatives df)
-
-    utilities : dataframe
-        dot product of model_design.dot(spec)
-        yields utility value for element in the cross product of choosers and alternatives
-        this is then reshaped as a dataframe with one row per chooser and one column per alternative
-
-    probs : dataframe
-        utilities exponentiated and converted to probabilities
-        same shape as utilities, one row per chooser and one column per alternative
-
-    positions : series
-        choices among alternatives with the chosen alternative represented
-        as the integer index of the selected alternative column in probs
-
-    choices : series
-        series with the alternative chosen for each chooser
-        the index is same as choosers
-        and the series value is the alternative df index of chosen alternative
+    evaluate spec on cross join of choosers and alternatives and sample alternatives
 
     Returns
     -------
     choices_df : pandas.DataFrame
-
-        A DataFrame where index should match the index of the choosers DataFrame
-        and columns alt_col_name, prob, rand, pick_count
-
-        prob: float
-            the probability of the chosen alternative
-        rand: float
-            the rand that did the choosing
-        pick_count : int
-            number of duplicate picks for chooser, alt
+        as returned by make_sample_choices (one row per sample pick)
     """
 
-    have_trace_targets = tracing.has_trace_targets(choosers)
-
-    assert len(choosers.index) > 0
-
-    if have_trace_targets:
-        tracing.trace_df(choosers, tracing.extend_trace_label(trace_label, 'choosers'))
-        tracing.trace_df(alternatives, tracing.extend_trace_label(trace_label, 'alternatives'),
-                         slicer='NONE', transpose=False)
-
-    if len(spec.columns) > 1:
-        raise RuntimeError('spec must have only one column')
-
-    # if using skims, copy index into the dataframe, so it will be
-    # available as the "destination" for the skims dereference below
-    if skims is not None:
-        alternatives[alternatives.index.name] = alternatives.index
-
     # - cross join choosers and alternatives (cartesian product)
     # for every chooser, there will be a row for each alternative
     # index values (non-unique) are from alternatives df
     alternative_count = alternatives.shape[0]
+    # only columns referenced by spec or skims are included in interaction_df
     interaction_df = \
-        logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count)
+        logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count,
+                                  columns=interaction_dataset_columns(spec, choosers, skims))
 
     chunk.log_df(trace_label, 'interaction_df', interaction_df)
 
@@ -294,6 +238,225 @@ def _interaction_sample(
     del probs
     chunk.log_df(trace_label, 'probs', None)
 
+    return choices_df
+
+
+def sample_group_columns(spec, choosers, alternatives, skims):
+    """
+    Return list of the choosers columns that sample utilities can depend on, or None if
+    utilities might depend on other chooser attributes (or we can't tell)
+
+    Choosers with the same values in these columns (e.g. origin zone and segment) have the
+    same sample utilities, so they only need to be computed once per group.
+    """
+
+    names = spec_compiler.compile_spec(spec.index).referenced_names()
+
+    if names is None or choosers.index.name in names:
+        return None
+
+    names = names | skim_wrapper_columns(skims)
+
+    return [c for c in choosers.columns
+            if ((c + '_chooser') if c in alternatives.columns else c) in names]
+
+
+def _grouped_sample_choices(
+        choosers, alternatives, spec, sample_size, alt_col_name, allow_zero_probs,
+        group_columns, skims, locals_d, trace_label):
+    """
+    Like _sample_choices, but evaluate spec once for each group of choosers with the same
+    group_columns values (rather than for each chooser) and sample alternatives for each chooser
+    from its group's cumulative probabilities.
+
+    Given the same rands, the choices are the same as those made by make_sample_choices.
+
+    Returns
+    -------
+    choices_df : pandas.DataFrame
+        as returned by make_sample_choices (one row per sample pick)
+    """
+
+    if group_columns:
+        group_ids = choosers.groupby(group_columns, sort=False).ngroup().values
+    else:
+        group_ids = np.zeros(len(choosers), dtype=int)
+
+    if (group_ids < 0).any():
+        # groupby drops choosers with null group values
+        logger.debug("%s null group values - sampling without grouping" % trace_label)
+        return _sample_choices(
+            choosers, alternatives, spec, sample_size, alt_col_name, allow_zero_probs,
+            skims, locals_d, False, trace_label)
+
+    group_count = group_ids.max() + 1
+    alternative_count = alternatives.shape[0]
+
+    logger.info("%s grouped %s choosers into %s groups" %
+                (trace_label, len(choosers), group_count))
+
+    # one representative chooser per group
+    _, first_rows = np.unique(group_ids, return_index=True)
+    group_choosers = choosers[group_columns].iloc[first_rows]
+    group_choosers.index = pd.Index(np.arange(group_count), name=choosers.index.name)
+
+    interaction_df = \
+        logit.interaction_dataset(group_choosers, alternatives, sample_size=alternative_count,
+                                  columns=interaction_dataset_columns(spec, group_choosers, skims))
+    chunk.log_df(trace_label, 'interaction_df', interaction_df)
+
+    if skims is not None:
+        set_skim_wrapper_targets(interaction_df, skims)
+
+    interaction_utilities, _ = \
+        eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, None)
+    chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
+
+    del interaction_df
+    chunk.log_df(trace_label, 'interaction_df', None)
+
+    # one row per group and one column per alternative
+    utilities = pd.DataFrame(
+        interaction_utilities.values.reshape(group_count, alternative_count),
+        index=group_choosers.index)
+
+    del interaction_utilities
+    chunk.log_df(trace_label, 'interaction_utilities', None)
+
+    probs = logit.utils_to_probs(utilities, allow_zero_probs=allow_zero_probs,
+                                 trace_label=trace_label, trace_choosers=group_choosers)
+    chunk.log_df(trace_label, 'probs', probs)
+
+    del utilities
+
+    probs = probs.values
+
+    if allow_zero_probs:
+        zero_probs = (probs.sum(axis=1) == 0)[group_ids]
+        if zero_probs.all():
+            return pd.DataFrame(columns=[alt_col_name, 'rand', 'prob', choosers.index.name])
+        if zero_probs.any():
+            # remove from sample
+            choosers = choosers[~zero_probs]
+            group_ids = group_ids[~zero_probs]
+
+    cum_probs = probs.cumsum(axis=1)
+
+    # sample_size rands for each chooser (same rands as make_sample_choices)
+    rands = pipeline.get_rn_generator().random_for_df(choosers, n=sample_size)
+
+    # position of first cum_prob greater than rand (i.e. argmax(cum_probs > rand))
+    positions = np.empty(rands.shape, dtype=int)
+    for group_id, rows in iteritems(pd.Series(group_ids).groupby(group_ids).indices):
+        positions[rows] = np.searchsorted(cum_probs[group_id], rands[rows], side='right')
+
+    # as with argmax, if rand exceeds (rounded) cum_probs, choose first alternative
+    positions[positions == alternative_count] = 0
+
+    choices_df = pd.DataFrame(
+        {alt_col_name: alternatives.index.values[positions].ravel(),
+         'rand': rands.ravel(),
+         'prob': probs[group_ids[:, None], positions].ravel(),
+         choosers.index.name: np.repeat(np.asanyarray(choosers.index), sample_size)
+         })
+
+    chunk.log_df(trace_label, 'choices_df', choices_df)
+    chunk.log_df(trace_label, 'probs', None)
+
+    return choices_df
+
+
+def _interaction_sample(
+        choosers, alternatives,
+        spec, sample_size, alt_col_name, allow_zero_probs,
+        skims=None, locals_d=None,
+        trace_label=None):
+    """
+    Run a MNL simulation in the situation in which alternatives must
+    be merged with choosers because there are interaction terms or
+    because alternatives are being sampled.
+
+    Parameters are same as for public function interaction_sa,ple
+
+    spec : dataframe
+        one row per spec expression and one col with utility coefficient
+
+    interaction_df : dataframe
+        cross join (cartesian product) of choosers with alternatives
+        combines columns of choosers and alternatives
+        len(df) == len(choosers) * len(alternatives)
+        index values (non-unique) are index values from alternatives df
+
+    interaction_utilities : dataframe
+        the utility of each alternative is sum of the partial utilities determined by the
+        various spec expressions and their corresponding coefficients
+        yielding a dataframe  with len(interaction_df) rows and one utility column
+        having the same index as interaction_df (non-unique values from alternatives df)
+
+    utilities : dataframe
+        dot product of model_design.dot(spec)
+        yields utility value for element in the cross product of choosers and alternatives
+        this is then reshaped as a dataframe with one row per chooser and one column per alternative
+
+    probs : dataframe
+        utilities exponentiated and converted to probabilities
+        same shape as utilities, one row per chooser and one column per alternative
+
+    positions : series
+        choices among alternatives with the chosen alternative represented
+        as the integer index of the selected alternative column in probs
+
+    choices : series
+        series with the alternative chosen for each chooser
+        the index is same as choosers
+        and the series value is the alternative df index of chosen alternative
+
+    Returns
+    -------
+    choices_df : pandas.DataFrame
+
+        A DataFrame where index should match the index of the choosers DataFrame
+        and columns alt_col_name, prob, rand, pick_count
+
+        prob: float
+            the probability of the chosen alternative
+        rand: float
+            the rand that did the choosing
+        pick_count : int
+            number of duplicate picks for chooser, alt
+    """
+
+    have_trace_targets = tracing.has_trace_targets(choosers)
+
+    assert len(choosers.index) > 0
+
+    if have_trace_targets:
+        tracing.trace_df(choosers, tracing.extend_trace_label(trace_label, 'choosers'))
+        tracing.trace_df(alternatives, tracing.extend_trace_label(trace_label, 'alternatives'),
+                         slicer='NONE', transpose=False)
+
+    if len(spec.columns) > 1:
+        raise RuntimeError('spec must have only one column')
+
+    # if using skims, copy index into the dataframe, so it will be
+    # available as the "destination" for the skims dereference below
+    if skims is not None:
+        alternatives[alternatives.index.name] = alternatives.index
+
+    # sample utilities only depend on group_columns, so compute them once per group
+    group_columns = None
+    if config.setting('grouped_interaction_sample', False) and not have_trace_targets:
+        group_columns = sample_group_columns(spec, choosers, alternatives, skims)
+
+    if group_columns is not None:
+        choices_df = _grouped_sample_choices(
+            choosers, alternatives, spec, sample_size, alt_col_name, allow_zero_probs,
+            group_columns, skims, locals_d, trace_label)
+    else:
+        choices_df = _sample_choices(
+            choosers, alternatives, spec, sample_size, alt_col_name, allow_zero_probs,
+            skims, locals_d, have_trace_targets, trace_label)
+
     # make_sample_choices should return choosers index as choices_df column
     assert choosers.index.name in choices_df.columns
 
@@ -337,7 +500,7 @@ def _interaction_sample(
     return choices_df
 
 
-def calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label):
+def calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label, spec=None, skims=None):
 
     num_choosers = choosers.shape[0]
 
@@ -345,11 +508,12 @@ def calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label):
     # if chunk_size == 0:
     #     return num_choosers, 0
 
-    # all columns from choosers
-    chooser_row_size = choosers.shape[1]
+    # interaction_df only includes the chooser and alternative columns spec references
+    chooser_row_size, alt_row_size = \
+        interaction_dataset_row_sizes(spec, choosers, alternatives, skims)
 
     # interaction_df has one column per alternative plus a skim column and a join column
-    alt_row_size = alternatives.shape[1] + 2
+    alt_row_size += 2
 
     # interaction_utilities
     alt_row_size += 1
@@ -440,10 +604,12 @@ def interaction_sample(
     sample_size = min(sample_size, len(alternatives.index))
 
     rows_per_chunk, effective_chunk_size = \
-        calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label)
+        calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label,
+                            spec=spec, skims=skims)
 
     result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk \
+            in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -16,10 +16,12 @@ from . import logit
 from . import tracing
 from . import config
 from .simulate import set_skim_wrapper_targets
+from .simulate import skim_wrapper_columns
 from . import chunk
 from . import mem
 
 from . import assign
+from . import spec_compiler
 
 from activitysim.core.mem import force_garbage_collect
 
@@ -29,6 +31,36 @@ logger = logging.getLogger(__name__)
 DUMP = False
 
 
+def interaction_dataset_columns(spec, choosers, skims):
+    """
+    Return the set of interaction_dataset columns that might be needed to evaluate spec
+    (or None if that can't be determined and all columns should be included)
+
+    This is the set of names referenced by spec expressions, plus the skim wrapper
+    orig/dest/dim3 columns and the columns interaction_trace_rows may slice on.
+
+    Parameters
+    ----------
+    spec : pandas.DataFrame
+    choosers : pandas.DataFrame
+    skims : skim wrapper, or list or dict of skim wrappers, or None
+
+    Returns
+    -------
+    columns : set of str or None
+    """
+
+    columns = spec_compiler.compile_spec(spec.index).referenced_names()
+
+    if columns is None:
+        return None
+
+    columns = columns | skim_wrapper_columns(skims)
+    columns.update(['person_id', 'household_id', choosers.index.name])
+
+    return columns
+
+
 def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows):
     """
     Compute the utilities for a single-alternative spec evaluated in the context of df
@@ -80,6 +112,8 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows):
     def to_series(x):
         if np.isscalar(x):
             return pd.Series([x] * len(df), index=df.index)
+        if isinstance(x, np.ndarray):
+            return pd.Series(x, index=df.index)
         return x
 
     if trace_rows is not None and trace_rows.any():
@@ -98,17 +132,19 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows):
     utilities = pd.DataFrame({'utility': 0.0}, index=df.index)
     no_variability = has_missing_vals = 0
 
-    for expr, coefficient in zip(spec.index, spec.iloc[:, 0]):
+    # spec expressions are parsed once and cached, so we just evaluate the compiled plan
+    compiled_spec = spec_compiler.compile_spec(spec.index)
+
+    for compiled_expr, coefficient in zip(compiled_spec, spec.iloc[:, 0]):
+        expr = compiled_expr.expr
         try:
 
             # - allow temps of form _od_DIST@od_skim['DIST']
-            if expr.startswith('_'):
-                target = expr[:expr.index('@')]
-                rhs = expr[expr.index('@') + 1:]
-                v = to_series(eval(rhs, globals(), locals_d))
+            if compiled_expr.kind == spec_compiler.TEMP:
+                v = to_series(compiled_expr.evaluate(df, globals(), locals_d))
 
                 # update locals to allows us to ref previously assigned targets
-                locals_d[target] = v
+                locals_d[compiled_expr.target] = v
 
                 if trace_eval_results is not None:
                     trace_eval_results[expr] = v[trace_rows]
@@ -116,10 +152,7 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows):
                 # mem.trace_memory_info("eval_interaction_utilities TEMP: %s" % expr)
                 continue
 
-            if expr.startswith('@'):
-                v = to_series(eval(expr[1:], globals(), locals_d))
-            else:
-                v = df.eval(expr)
+            v = to_series(compiled_expr.evaluate(df, globals(), locals_d))
 
             if check_for_variability and v.std() == 0:
                 logger.info("%s: no variability (%s) in: %s" % (trace_label, v.iloc[0], expr))
@@ -245,7 +278,10 @@ def _interaction_simulate(
     # cross join choosers and alternatives (cartesian product)
     # for every chooser, there will be a row for each alternative
     # index values (non-unique) are from alternatives df
-    interaction_df = logit.interaction_dataset(choosers, alternatives, sample_size)
+    # only columns referenced by spec or skims are included in interaction_df
+    interaction_df = logit.interaction_dataset(
+        choosers, alternatives, sample_size,
+        columns=interaction_dataset_columns(spec, choosers, skims))
     chunk.log_df(trace_label, 'interaction_df', interaction_df)
 
     if skims is not None:
@@ -328,7 +364,31 @@ def _interaction_simulate(
     return choices
 
 
-def calc_rows_per_chunk(chunk_size, choosers, alternatives, sample_size, skims, trace_label=None):
+def interaction_dataset_row_sizes(spec, choosers, alternatives, skims):
+    """
+    Return number of chooser and alternative columns logit.interaction_dataset will include
+
+    Returns
+    -------
+    chooser_row_size : int
+    alt_row_size : int
+    """
+
+    columns = None if spec is None else interaction_dataset_columns(spec, choosers, skims)
+
+    if columns is None:
+        return len(choosers.columns), len(alternatives.columns)
+
+    chooser_row_size = \
+        len([c for c in choosers.columns
+             if ((c + '_chooser') if c in alternatives.columns else c) in columns])
+    alt_row_size = len([c for c in alternatives.columns if c in columns])
+
+    return chooser_row_size, alt_row_size
+
+
+def calc_rows_per_chunk(chunk_size, choosers, alternatives, sample_size, skims, trace_label=None,
+                        spec=None):
 
     num_choosers = len(choosers.index)
 
@@ -336,10 +396,12 @@ def calc_rows_per_chunk(chunk_size, choosers, alternatives, sample_size, skims,
     # if chunk_size == 0:
     #     return num_choosers, 0
 
-    chooser_row_size = len(choosers.columns)
+    # interaction_df only includes the chooser and alternative columns spec references
+    chooser_row_size, alt_row_size = \
+        interaction_dataset_row_sizes(spec, choosers, alternatives, skims)
 
     # alternative columns plus join column
-    alt_row_size = alternatives.shape[1] + 1
+    alt_row_size += 1
 
     if skims is not None:
         alt_row_size += 1
@@ -417,10 +479,11 @@ def interaction_simulate(
     rows_per_chunk, effective_chunk_size = \
         calc_rows_per_chunk(chunk_size, choosers, alternatives=alternatives,
                             sample_size=sample_size, skims=skims,
-                            trace_label=trace_label)
+                            trace_label=trace_label, spec=spec)
 
     result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk \
+            in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
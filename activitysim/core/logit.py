@@ -8,6 +8,8 @@ from builtins import object
 
 import logging
 
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
@@ -206,13 +208,13 @@ def make_choices(probs, trace_label=None, trace_choosers=None):
     return choices, rands
 
 
-def interaction_dataset(choosers, alternatives, sample_size=None):
+def interaction_dataset(choosers, alternatives, sample_size=None, columns=None):
     """
     Combine choosers and alternatives into one table for the purposes
     of creating interaction variables and/or sampling alternatives.
 
-    Any duplicate column names in alternatives table will be renamed with an '_r' suffix.
-    (e.g. TAZ field in alternatives will appear as TAZ_r so that it can be targeted in a skim)
+    Any duplicate column names in choosers table will be renamed with an '_chooser' suffix.
+    (e.g. TAZ field in choosers will appear as TAZ_chooser so that it can be targeted in a skim)
 
     Parameters
     ----------
@@ -221,6 +223,10 @@ def interaction_dataset(choosers, alternatives, sample_size=None):
     sample_size : int, optional
         If sampling from alternatives for each chooser, this is
         how many to sample.
+    columns : set of str, optional
+        If specified, only these columns (by their name in the merged table) are included,
+        so unused chooser columns aren't repeated for every alternative (and unused
+        alternative columns aren't repeated for every chooser)
 
     Returns
     -------
@@ -251,15 +257,27 @@ def interaction_dataset(choosers, alternatives, sample_size=None):
     else:
         sample = np.tile(alts_idx, numchoosers)
 
-    alts_sample = alternatives.take(sample).copy()
+    # chooser columns with same name as an alternatives column get '_chooser' suffix
+    chooser_columns = [(c, (c + '_chooser') if c in alternatives.columns else c)
+                       for c in choosers.columns]
+    alt_columns = list(alternatives.columns)
+
+    if columns is not None:
+        chooser_columns = [(c, c_chooser) for c, c_chooser in chooser_columns
+                           if c_chooser in columns]
+        alt_columns = [c for c in alt_columns if c in columns]
+
+    # build alts_sample column by column (rather than take().copy() of the whole table)
+    alts_sample = pd.DataFrame(
+        OrderedDict([(c, alternatives[c].values.take(sample)) for c in alt_columns]),
+        index=alternatives.index.take(sample))
 
     logger.debug("interaction_dataset pre-merge choosers %s alternatives %s alts_sample %s" %
                  (choosers.shape, alternatives.shape, alts_sample.shape))
 
     # no need to do an expensive merge of alts and choosers
     # we can simply assign repeated chooser values
-    for c in choosers.columns:
-        c_chooser = (c + '_chooser') if c in alts_sample.columns else c
+    for c, c_chooser in chooser_columns:
         alts_sample[c_chooser] = np.repeat(choosers[c].values, sample_size)
 
     logger.debug("interaction_dataset merged alts_sample %s" % (alts_sample.shape, ))
@@ -20,9 +20,15 @@ import yaml
 import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 from activitysim.core import inject
 from activitysim.core import tracing
 from activitysim.core import pipeline
+from activitysim.core import checkpoint_store
 from activitysim.core import config
 
 from activitysim.core import chunk
@@ -41,6 +47,9 @@ logger = logging.getLogger(__name__)
 
 LAST_CHECKPOINT = '_'
 
+# prefix of names of shared apportion table buffers (to distinguish them from other data_buffers)
+APPORTION_BUFFER_PREFIX = 'apportion:'
+
 """
 mp_tasks - activitysim multiprocessing overview
 
@@ -198,13 +207,21 @@ influenced or constrained in light of aggregate choices.
 Currently school and workplace location choice are the only such aggregate constraints.
 The details of these are handled by the shadow_pricing module (q.v.), and our only concern here
 is the need to provide shared read-write data buffers for communication between processes.
-It is worth noting here that the shared buffers are instances of multiprocessing.Array which
-incorporates a multiprocessing.Lock object to mediate access of the underlying data. You might
-think that the existence of such a lock would make shared access pretty straightforward, but
-this is not the case as the level of locking is very low, reportedly not very performant, and
-essentially useless in any event since we want to use numpy.frombuffer to wrap and handle them
-as numpy arrays. The Lock is a convenient bundled locking primative, but shadow_pricing rolls
-its own semaphore system using the Lock.
+The shadow pricing buffers are allreduce.AllReduce objects, which bundle a shared memory buffer
+with a multiprocessing.Condition, so that each sub-process can add its local counts and block
+until all of them have done so, at which point they are all woken with the sum. Any other model
+needing cross-process aggregates can allocate one the same way.
+
+If the shared_memory_apportion setting is True, the parent reads the last checkpoint tables from
+the pipeline once, copies their columns into shared buffers and computes which rows belong to each
+sub-process. Rather than the parent serially writing an apportioned pipeline file for every
+sub-process, each sub-process takes its slice of the shared buffers and opens its pipeline with
+those tables in memory. (The apportioned pipeline file is only built if resuming within the step.)
+Mirrored tables aren't sliced, so sub-processes use read-only views of the shared buffers rather
+than copies of their own. At the end of the step, sub-processes write their last checkpoint
+tables to one file per table (feather if pyarrow is installed, otherwise pickle) which the
+coalesce task reads in place of the sub-process pipeline files. Only the coalesce task writes the
+final pipeline.
 
 FIXME - The code below knows that it need to allocate skim and shadow price buffers by calling
 the appropriate methods in abm.tables.skims and abm.tables.shadow_pricing to allocate shared
@@ -225,7 +242,7 @@ def pipeline_table_keys(pipeline_store):
     return dict of current (as of last checkpoint) pipeline tables
     and their checkpoint-specific hdf5_keys
 
-    This facilitates reading pipeline tables directly from a 'raw' open pandas.HDFStore without
+    This facilitates reading pipeline tables directly from a 'raw' open checkpoint store without
     opening it as a pipeline (e.g. when apportioning and coalescing pipelines)
 
     We currently only ever need to do this from the last checkpoint, so the ability to specify
@@ -233,7 +250,7 @@ def pipeline_table_keys(pipeline_store):
 
     Parameters
     ----------
-    pipeline_store : open hdf5 pipeline_store
+    pipeline_store : open checkpoint_store
 
     Returns
     -------
@@ -411,25 +428,83 @@ def build_slice_rules(slice_info, pipeline_tables):
     return slice_rules
 
 
-def apportion_pipeline(sub_proc_names, slice_info):
+def apportion_slices(slice_rules, tables, num_sub_procs):
     """
-    apportion pipeline for multiprocessing step
+    Compute the rows of each table that belong to each sub_proc, based on slice_rules
 
-    create pipeline files for sub_procs, apportioning data based on slice_rules
+    The primary table is sliced by num_sub_procs strides (this hopefully yields a more random
+    distribution - e.g. households are ordered by size in input store) and dependent tables are
+    sliced by index or ref_col to their (already sliced) source table.
 
-    Called at the beginning of a multiprocess step prior to launching the sub-processes
-    Pipeline files have well known names (pipeline file name prefixed by subjob name)
+    Parameters
+    ----------
+    slice_rules : dict
+        slice_rules from build_slice_rules
+    tables : dict {<table_name>, <pandas.DataFrame>}
+    num_sub_procs : int
+
+    Returns
+    -------
+    slices : list of dict {<table_name>: <numpy.ndarray of row positions or None>}
+        one dict per sub_proc, None for mirrored (unsliced) tables
+    """
+
+    slices = []
+    for i in range(num_sub_procs):
+
+        # remember sliced index so we can cascade slicing to other tables
+        sliced_index = {}
+        positions = OrderedDict()
+
+        for table_name, rule in iteritems(slice_rules):
+
+            df = tables[table_name]
+
+            if rule['slice_by'] == 'primary':
+                # slice primary apportion table by num_sub_procs strides
+                p = np.arange(i, df.shape[0], num_sub_procs)
+            elif rule['slice_by'] == 'index':
+                # slice a table with same index name as a known slicer
+                p = df.index.get_indexer(sliced_index[rule['source']])
+                if (p < 0).any():
+                    raise RuntimeError("apportion table %s index missing %s values from %s" %
+                                       (table_name, (p < 0).sum(), rule['source']))
+            elif rule['slice_by'] == 'column':
+                # slice a table with a recognized slicer_column
+                p = np.flatnonzero(df[rule['column']].isin(sliced_index[rule['source']]).values)
+            elif rule['slice_by'] is None:
+                # don't slice mirrored tables
+                p = None
+            else:
+                raise RuntimeError("Unrecognized slice rule '%s' for table %s" %
+                                   (rule['slice_by'], table_name))
+
+            if p is not None:
+                sliced_index[table_name] = df.index[p]
+
+            positions[table_name] = p
+
+        slices.append(positions)
+
+    return slices
+
+
+def read_last_checkpoint_tables(slice_info):
+    """
+    Read all tables in the last checkpoint of the (main) pipeline
 
     Parameters
     ----------
-    sub_proc_names : list of str
-        names of the sub processes to apportion
     slice_info : dict
         slice_info from multiprocess_steps
 
     Returns
     -------
-    creates apportioned pipeline files for each sub job
+    checkpoint_name : str
+        name of last checkpoint
+    checkpoints_df : pandas.DataFrame
+        single row checkpoints table for apportioned pipelines
+    tables : dict {<table_name>, <pandas.DataFrame>}
     """
 
     pipeline_file_name = inject.get_injectable('pipeline_file_name')
@@ -437,11 +512,11 @@ def apportion_pipeline(sub_proc_names, slice_info):
     # get last checkpoint from first job pipeline
     pipeline_path = config.build_output_file_path(pipeline_file_name)
 
-    logger.debug("apportion_pipeline pipeline_path: %s", pipeline_path)
+    logger.debug("read_last_checkpoint_tables pipeline_path: %s", pipeline_path)
 
     # - load all tables from pipeline
     tables = {}
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+    with checkpoint_store.open_store(pipeline_path, mode='r') as pipeline_store:
 
         checkpoints_df = pipeline_store[pipeline.CHECKPOINT_TABLE_NAME]
 
@@ -458,7 +533,7 @@ def apportion_pipeline(sub_proc_names, slice_info):
             # new checkpoint for all tables the same
             checkpoints_df[table_name] = checkpoint_name
             # load the dataframe
-            tables[table_name] = pipeline_store[hdf5_key]
+            tables[table_name] = pipeline.read_table_key(pipeline_store, hdf5_key)
 
             logger.debug("loaded table %s %s", table_name, tables[table_name].shape)
 
@@ -466,61 +541,377 @@ def apportion_pipeline(sub_proc_names, slice_info):
     checkpoints_df = checkpoints_df.tail(1).copy()
     checkpoints_df[list(tables.keys())] = checkpoint_name
 
+    return checkpoint_name, checkpoints_df, tables
+
+
+def write_apportioned_pipeline(pipeline_path, tables, checkpoint_name, checkpoints_df):
+    """
+    Write apportioned tables to a new sub_proc pipeline file with a single checkpoint
+
+    Parameters
+    ----------
+    pipeline_path : str
+    tables : dict {<table_name>, <pandas.DataFrame>}
+        sliced (or mirrored) tables for this sub_proc
+    checkpoint_name : str
+    checkpoints_df : pandas.DataFrame
+    """
+
+    # remove existing file
+    try:
+        checkpoint_store.remove_store(pipeline_path)
+    except OSError:
+        pass
+
+    with checkpoint_store.open_store(pipeline_path, mode='a') as pipeline_store:
+
+        for table_name, df in iteritems(tables):
+            hdf5_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
+            pipeline_store[hdf5_key] = df
+
+        logger.debug("writing checkpoints (%s) to %s in %s",
+                     checkpoints_df.shape, pipeline.CHECKPOINT_TABLE_NAME, pipeline_path)
+        pipeline_store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints_df
+
+
+def apportion_pipeline(sub_proc_names, slice_info):
+    """
+    apportion pipeline for multiprocessing step
+
+    create pipeline files for sub_procs, apportioning data based on slice_rules
+
+    Called at the beginning of a multiprocess step prior to launching the sub-processes
+    Pipeline files have well known names (pipeline file name prefixed by subjob name)
+
+    Parameters
+    ----------
+    sub_proc_names : list of str
+        names of the sub processes to apportion
+    slice_info : dict
+        slice_info from multiprocess_steps
+
+    Returns
+    -------
+    creates apportioned pipeline files for each sub job
+    """
+
+    pipeline_file_name = inject.get_injectable('pipeline_file_name')
+
+    checkpoint_name, checkpoints_df, tables = read_last_checkpoint_tables(slice_info)
+
     # - build slice rules for loaded tables
     slice_rules = build_slice_rules(slice_info, tables)
 
     # - allocate sliced tables for each sub_proc
-    num_sub_procs = len(sub_proc_names)
-    for i in range(num_sub_procs):
+    slices = apportion_slices(slice_rules, tables, len(sub_proc_names))
+    for process_name, positions in zip(sub_proc_names, slices):
 
         # use well-known pipeline file name
-        process_name = sub_proc_names[i]
         pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
 
-        # remove existing file
-        try:
-            os.unlink(pipeline_path)
-        except OSError:
-            pass
-
-        with pd.HDFStore(pipeline_path, mode='a') as pipeline_store:
-
-            # remember sliced_tables so we can cascade slicing to other tables
-            sliced_tables = {}
-
-            # - for each table in pipeline
-            for table_name, rule in iteritems(slice_rules):
-
-                df = tables[table_name]
-
-                if rule['slice_by'] == 'primary':
-                    # slice primary apportion table by num_sub_procs strides
-                    # this hopefully yields a more random distribution
-                    # (e.g.) households are ordered by size in input store
-                    primary_df = df[np.asanyarray(list(range(df.shape[0]))) % num_sub_procs == i]
-                    sliced_tables[table_name] = primary_df
-                elif rule['slice_by'] == 'index':
-                    # slice a table with same index name as a known slicer
-                    source_df = sliced_tables[rule['source']]
-                    sliced_tables[table_name] = df.loc[source_df.index]
-                elif rule['slice_by'] == 'column':
-                    # slice a table with a recognized slicer_column
-                    source_df = sliced_tables[rule['source']]
-                    sliced_tables[table_name] = df[df[rule['column']].isin(source_df.index)]
-                elif rule['slice_by'] is None:
-                    # don't slice mirrored tables
-                    sliced_tables[table_name] = df
-                else:
-                    raise RuntimeError("Unrecognized slice rule '%s' for table %s" %
-                                       (rule['slice_by'], table_name))
+        sliced_tables = OrderedDict()
+        for table_name, p in iteritems(positions):
+            df = tables[table_name]
+            sliced_tables[table_name] = df if p is None else df.iloc[p]
+
+        write_apportioned_pipeline(pipeline_path, sliced_tables, checkpoint_name, checkpoints_df)
+
+
+def shared_memory_apportion():
+    """
+    Should multiprocess steps be apportioned via shared memory rather than by having the parent
+    write an apportioned pipeline file for each sub-process (see apportion_pipeline)
+    """
+    return setting('shared_memory_apportion', False)
+
+
+def buffers_for_apportion_tables(tables):
+    """
+    Copy the index and columns of tables into shared memory buffers
+
+    numeric, boolean and datetime columns are copied as is. Categoricals are stored as their
+    codes and other (e.g. string) columns are factorized, with the categories (or uniques)
+    stored in table_info to be passed to sub-processes along with the buffers.
+
+    Parameters
+    ----------
+    tables : dict {<table_name>, <pandas.DataFrame>}
+
+    Returns
+    -------
+    table_info : OrderedDict {<table_name>: dict}
+        index name, length and column info (name, dtype, categories) for each table
+    buffers : dict {<buffer_name>: <multiprocessing.RawArray>}
+    """
+
+    table_info = OrderedDict()
+    buffers = {}
+    for table_name, df in iteritems(tables):
+
+        columns = []
+        for i, (column_name, series) in enumerate([(None, pd.Series(df.index))] +
+                                                  [(c, df[c]) for c in df.columns]):
+
+            column_info = {'name': column_name}
+            if isinstance(series.dtype, pd.api.types.CategoricalDtype):
+                values = series.cat.codes.values
+                column_info['categories'] = series.cat.categories
+                column_info['ordered'] = series.cat.ordered
+            elif series.dtype.kind in 'biufcmM':
+                values = series.values
+            else:
+                values, column_info['uniques'] = pd.factorize(series)
+
+            values = np.ascontiguousarray(values)
+            column_info['dtype'] = values.dtype
+
+            buffer_name = '%s%s.%s' % (APPORTION_BUFFER_PREFIX, table_name, i)
+            buffer = multiprocessing.RawArray('b', max(values.nbytes, 1))
+            np.frombuffer(buffer, dtype=values.dtype, count=len(values))[:] = values
+            buffers[buffer_name] = buffer
+
+            columns.append(column_info)
+
+        table_info[table_name] = {
+            'index_name': df.index.name,
+            'length': len(df),
+            'columns': columns,
+        }
+
+        logger.debug("buffers_for_apportion_tables %s %s", table_name, df.shape)
+
+    return table_info, buffers
+
+
+def apportioned_table(table_name, table_info, buffers, positions):
+    """
+    Return the rows at positions of a table in shared memory buffers
+
+    Parameters
+    ----------
+    table_name : str
+    table_info : dict
+        table_info for this table from buffers_for_apportion_tables
+    buffers : dict {<buffer_name>: <multiprocessing.RawArray>}
+    positions : numpy.ndarray or None
+        row positions of sliced table rows or None if table is mirrored
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        for mirrored tables, numeric columns are read-only views of the shared buffers
+    """
+
+    columns = []
+    for i, column_info in enumerate(table_info['columns']):
+
+        buffer = buffers['%s%s.%s' % (APPORTION_BUFFER_PREFIX, table_name, i)]
+        values = np.frombuffer(buffer, dtype=column_info['dtype'], count=table_info['length'])
+        if positions is not None:
+            values = values.take(positions)
+        else:
+            # mirrored table columns are shared by all sub_procs, so mustn't be modified in place
+            values.flags.writeable = False
+
+        if 'categories' in column_info:
+            values = pd.Categorical.from_codes(values, column_info['categories'],
+                                               ordered=column_info['ordered'])
+        elif 'uniques' in column_info:
+            codes = values
+            values = np.full(len(codes), np.nan, dtype=object)
+            values[codes >= 0] = np.asarray(column_info['uniques'], dtype=object)[codes[codes >= 0]]
+
+        columns.append(values)
+
+    # copy=False so columns aren't consolidated into (copied) blocks
+    index = pd.Index(columns[0], name=table_info['index_name'])
+    df = pd.DataFrame(OrderedDict([(c['name'], v)
+                                   for c, v in zip(table_info['columns'][1:], columns[1:])]),
+                      index=index, copy=False)
+
+    return df
+
+
+def allocate_shared_apportion_buffers(sub_proc_names, slice_info):
+    """
+    This is called by the main process to copy the last checkpoint tables into shared memory
+    buffers and compute the rows that each sub_proc should get
+
+    Parameters
+    ----------
+    sub_proc_names : list of str
+        names of the sub processes to apportion
+    slice_info : dict
+        slice_info from multiprocess_steps
+
+    Returns
+    -------
+    apportion_info : dict
+        checkpoint_name, checkpoints, table_info and slices (keyed by sub_proc name)
+    buffers : dict {<buffer_name>: <multiprocessing.RawArray>}
+    """
+
+    checkpoint_name, checkpoints_df, tables = read_last_checkpoint_tables(slice_info)
+
+    slice_rules = build_slice_rules(slice_info, tables)
+    slices = apportion_slices(slice_rules, tables, len(sub_proc_names))
 
-                # - write table to pipeline
-                hdf5_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
-                pipeline_store[hdf5_key] = sliced_tables[table_name]
+    table_info, buffers = buffers_for_apportion_tables(tables)
 
-            logger.debug("writing checkpoints (%s) to %s in %s",
-                         checkpoints_df.shape, pipeline.CHECKPOINT_TABLE_NAME, pipeline_path)
-            pipeline_store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints_df
+    apportion_info = {
+        'checkpoint_name': checkpoint_name,
+        'checkpoints': checkpoints_df,
+        'tables': table_info,
+        'slices': dict(zip(sub_proc_names, slices)),
+    }
+
+    return apportion_info, buffers
+
+
+def setup_apportioned_pipeline(apportion_info, buffers, step_info):
+    """
+    Get this sub_proc's apportioned tables from the tables in shared memory buffers
+
+    Called within sub process (in place of apportion_pipeline in the parent). Unless we are
+    resuming within this step, the tables are returned so run_simulation can open the pipeline
+    with them in memory, and no apportioned pipeline file is written. If resuming, the apportioned
+    pipeline file is (re)built so the resume checkpoint can be loaded from it: written from
+    scratch if missing, or if left by the previous run, by adding any apportioned tables it
+    lacks (since pipelines opened with tables in memory don't write unchanged tables).
+
+    Parameters
+    ----------
+    apportion_info : dict
+        apportion_info from allocate_shared_apportion_buffers with slices for this sub_proc only
+    buffers : dict {<buffer_name>: <multiprocessing.RawArray>}
+    step_info : dict
+        step_info for current step from multiprocess_steps
+
+    Returns
+    -------
+    tables : OrderedDict {<table_name>, <pandas.DataFrame>} or None
+        apportioned tables to open pipeline with, or None if resuming from pipeline file
+    """
+
+    tables = OrderedDict()
+    for table_name, table_info in iteritems(apportion_info['tables']):
+        positions = apportion_info['slices'][table_name]
+        tables[table_name] = apportioned_table(table_name, table_info, buffers, positions)
+
+    if not step_info.get('resume_after', None):
+        return tables
+
+    pipeline_file_name = inject.get_injectable('pipeline_file_name')
+    pipeline_prefix = inject.get_injectable('pipeline_file_prefix')
+    pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=pipeline_prefix)
+    checkpoint_name = apportion_info['checkpoint_name']
+
+    if not checkpoint_store.store_exists(pipeline_path):
+        write_apportioned_pipeline(pipeline_path, tables,
+                                   checkpoint_name, apportion_info['checkpoints'])
+        return None
+
+    logger.info("setup_apportioned_pipeline: resuming with existing %s", pipeline_path)
+    with checkpoint_store.open_store(pipeline_path, mode='a') as pipeline_store:
+        for table_name, df in iteritems(tables):
+            hdf5_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
+            if hdf5_key not in pipeline_store:
+                logger.debug("setup_apportioned_pipeline: adding %s to %s",
+                             hdf5_key, pipeline_path)
+                pipeline_store[hdf5_key] = df
+
+    return None
+
+
+def sub_proc_result_path(process_name, table_name):
+    """
+    path of file with last checkpoint version of table written by sub process for coalescing
+    """
+    file_type = 'feather' if pyarrow is not None else 'pkl'
+    return config.build_output_file_path('%s.%s' % (table_name, file_type), use_prefix=process_name)
+
+
+def write_sub_proc_results():
+    """
+    Write current version of all checkpointed tables to one file per table for coalescing
+
+    Called within sub process before closing the pipeline when shared_memory_apportion so that
+    coalesce_pipelines doesn't have to read them back from the sub_proc pipeline file.
+    Tables are written as feather files if pyarrow is installed, otherwise as pickles.
+    """
+
+    process_name = inject.get_injectable('pipeline_file_prefix')
+
+    for table_name in pipeline.checkpointed_tables():
+        df = pipeline.get_table(table_name)
+        file_path = sub_proc_result_path(process_name, table_name)
+        logger.debug("write_sub_proc_results %s %s to %s", table_name, df.shape, file_path)
+        if pyarrow is not None:
+            df.reset_index().to_feather(file_path)
+        else:
+            df.to_pickle(file_path)
+
+
+def read_sub_proc_results(process_name, hdf5_keys):
+    """
+    Read last checkpoint tables of sub_proc pipeline
+
+    When shared_memory_apportion, tables are read from the files written by write_sub_proc_results
+    (and then deleted). Otherwise, or if no such file, they are read from the sub_proc pipeline.
+
+    Parameters
+    ----------
+    process_name : str
+    hdf5_keys : dict {<table_name>: <hdf5_key>}
+        tables to read
+
+    Returns
+    -------
+    tables : dict {<table_name>, <pandas.DataFrame>}
+    """
+
+    pipeline_file_name = inject.get_injectable('pipeline_file_name')
+    pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
+
+    tables = {}
+    pipeline_keys = {}
+    for table_name, hdf5_key in iteritems(hdf5_keys):
+
+        file_path = sub_proc_result_path(process_name, table_name)
+        if not (shared_memory_apportion() and os.path.isfile(file_path)):
+            pipeline_keys[table_name] = hdf5_key
+            continue
+
+        logger.debug("read_sub_proc_results %s from %s", table_name, file_path)
+        if pyarrow is not None:
+            df = pd.read_feather(file_path)
+            df = df.set_index(df.columns[0])
+            if df.index.name == 'index':
+                df.index.name = None
+        else:
+            df = pd.read_pickle(file_path)
+        tables[table_name] = df
+
+    if pipeline_keys:
+        logger.info("coalesce pipeline %s", pipeline_path)
+        with checkpoint_store.open_store(pipeline_path, mode='r') as pipeline_store:
+            for table_name, hdf5_key in iteritems(pipeline_keys):
+                tables[table_name] = pipeline.read_table_key(pipeline_store, hdf5_key)
+
+    return tables
+
+
+def remove_sub_proc_results(sub_proc_names, table_names):
+    """
+    Remove (coalesced) files written by write_sub_proc_results
+    """
+
+    for process_name in sub_proc_names:
+        for table_name in table_names:
+            try:
+                os.unlink(sub_proc_result_path(process_name, table_name))
+            except OSError:
+                pass
 
 
 def coalesce_pipelines(sub_proc_names, slice_info):
@@ -548,17 +939,14 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     logger.debug("coalesce_pipelines to: %s", pipeline_file_name)
 
     # - read all tables from first process pipeline
-    tables = {}
     pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=sub_proc_names[0])
 
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+    with checkpoint_store.open_store(pipeline_path, mode='r') as pipeline_store:
 
         # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
         checkpoint_name, hdf5_keys = pipeline_table_keys(pipeline_store)
 
-        for table_name, hdf5_key in iteritems(hdf5_keys):
-            logger.debug("loading table %s %s", table_name, hdf5_key)
-            tables[table_name] = pipeline_store[hdf5_key]
+    tables = read_sub_proc_results(sub_proc_names[0], hdf5_keys)
 
     # - use slice rules followed by apportion_pipeline to identify mirrored tables
     # (tables that are identical in every pipeline and so don't need to be concatenated)
@@ -572,14 +960,11 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     logger.debug("omnibus_keys: %s", omnibus_keys)
 
     # assemble lists of omnibus tables from all sub_processes
-    omnibus_tables = {table_name: [] for table_name in omnibus_keys}
-    for process_name in sub_proc_names:
-        pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
-        logger.info("coalesce pipeline %s", pipeline_path)
-
-        with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
-            for table_name, hdf5_key in iteritems(omnibus_keys):
-                omnibus_tables[table_name].append(pipeline_store[hdf5_key])
+    omnibus_tables = {table_name: [tables[table_name]] for table_name in omnibus_keys}
+    for process_name in sub_proc_names[1:]:
+        sub_proc_tables = read_sub_proc_results(process_name, omnibus_keys)
+        for table_name in omnibus_keys:
+            omnibus_tables[table_name].append(sub_proc_tables[table_name])
 
     pipeline.open_pipeline()
 
@@ -599,6 +984,8 @@ def coalesce_pipelines(sub_proc_names, slice_info):
 
     pipeline.close_pipeline()
 
+    remove_sub_proc_results(sub_proc_names, list(hdf5_keys.keys()))
+
 
 def setup_injectables_and_logging(injectables, locutor=True):
     """
@@ -619,20 +1006,32 @@ def setup_injectables_and_logging(injectables, locutor=True):
     injects injectables
     """
 
+    setup_injectables(injectables, locutor)
+
+    config.filter_warnings()
+
+    tracing.config_logger()
+
+
+def setup_injectables(injectables, locutor):
+    """
+    Inject injectables (passed by parent process) and sub process injectables within sub process
+
+    (See setup_injectables_and_logging)
+    """
+
     for k, v in iteritems(injectables):
         inject.add_injectable(k, v)
 
     inject.add_injectable("is_sub_task", True)
     inject.add_injectable("locutor", locutor)
 
-    config.filter_warnings()
-
     process_name = multiprocessing.current_process().name
     inject.add_injectable("log_file_prefix", process_name)
-    tracing.config_logger()
 
 
-def run_simulation(queue, step_info, resume_after, shared_data_buffer):
+def run_simulation(queue, step_info, resume_after, shared_data_buffer,
+                   checkpoints=None, tables=None):
     """
     run step models as subtask
 
@@ -649,6 +1048,10 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
     resume_after : str or None
     shared_data_buffer : dict
         dict of shared data (e.g. skims and shadow_pricing)
+    checkpoints : pandas.DataFrame or None
+    tables : dict {<table_name>, <pandas.DataFrame>} or None
+        if not None, the pipeline is opened with these (apportioned) tables in memory, as of the
+        last checkpoint in checkpoints, rather than by resuming from the pipeline file
     """
 
     models = step_info['models']
@@ -660,17 +1063,21 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
     inject.add_injectable("chunk_size", chunk_size)
     inject.add_injectable("num_processes", num_processes)
 
-    if resume_after:
-        logger.info('resume_after %s', resume_after)
+    if tables is not None:
+        pipeline.open_pipeline_with_tables(checkpoints, tables)
+    else:
+        if resume_after:
+            logger.info('resume_after %s', resume_after)
 
-        # if they specified a resume_after model, check to make sure it is checkpointed
-        if resume_after != LAST_CHECKPOINT and \
-                resume_after not in pipeline.get_checkpoints()[pipeline.CHECKPOINT_NAME].values:
-            # if not checkpointed, then fall back to last checkpoint
-            logger.info("resume_after checkpoint '%s' not in pipeline.", resume_after)
-            resume_after = LAST_CHECKPOINT
+            # if they specified a resume_after model, check to make sure it is checkpointed
+            if resume_after != LAST_CHECKPOINT and \
+                    resume_after not in \
+                    pipeline.get_checkpoints()[pipeline.CHECKPOINT_NAME].values:
+                # if not checkpointed, then fall back to last checkpoint
+                logger.info("resume_after checkpoint '%s' not in pipeline.", resume_after)
+                resume_after = LAST_CHECKPOINT
 
-    pipeline.open_pipeline(resume_after)
+        pipeline.open_pipeline(resume_after)
     last_checkpoint = pipeline.last_checkpoint()
 
     if last_checkpoint in models:
@@ -696,6 +1103,9 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
 
     tracing.print_elapsed_time("run (%s models)" % len(models), t0)
 
+    if shared_memory_apportion() and inject.get_injectable('pipeline_file_prefix', None):
+        write_sub_proc_results()
+
     pipeline.close_pipeline()
 
 
@@ -704,7 +1114,8 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
 """
 
 
-def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kwargs):
+def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, apportion_info,
+                      **kwargs):
     """
     mp entry point for run_simulation
 
@@ -715,11 +1126,14 @@ def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kw
     injectables
     step_info
     resume_after : bool
+    apportion_info : dict or None
+        apportion_info for this sub_proc if apportioning via shared memory
     kwargs : dict
         shared_data_buffers passed as kwargs to avoid picking dict
     """
 
-    shared_data_buffer = kwargs
+    shared_data_buffer = {k: v for k, v in iteritems(kwargs)
+                          if not k.startswith(APPORTION_BUFFER_PREFIX)}
     # handle_standard_args()
 
     setup_injectables_and_logging(injectables, locutor)
@@ -731,7 +1145,85 @@ def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kw
         logger.debug("injecting pipeline_file_prefix '%s'", pipeline_prefix)
         inject.add_injectable("pipeline_file_prefix", pipeline_prefix)
 
-    run_simulation(queue, step_info, resume_after, shared_data_buffer)
+    checkpoints = tables = None
+    if apportion_info is not None:
+        checkpoints = apportion_info['checkpoints']
+        tables = setup_apportioned_pipeline(apportion_info, kwargs, step_info)
+
+    run_simulation(queue, step_info, resume_after, shared_data_buffer, checkpoints, tables)
+
+    chunk.log_write_hwm()
+    mem.log_hwm()
+
+
+def mp_run_batches(queue, injectables, step_info, resume_after, apportion_info,
+                   work_queue, locutor_batch, **kwargs):
+    """
+    mp entry point for batch worker - run_simulation for batches from work_queue until empty
+
+    Each batch has its own apportioned pipeline (with the batch name as pipeline_file_prefix)
+    and the worker resets injectables and orca tables between batches so that nothing from one
+    batch leaks into the next.
+
+    Batches are run one at a time and not all at once, so workers can't synchronize with each
+    other (e.g. to aggregate shadow_pricing modeled_size) and so run as if single process.
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+        for messages to parent ({'batch': <batch_name>, 'time': <seconds>} when batch completes)
+    injectables
+    step_info
+    resume_after
+    apportion_info : dict or None
+        apportion_info with slices for all batches if apportioning via shared memory
+    work_queue : multiprocessing.Queue
+        batch names to run, terminated by None
+    locutor_batch : str
+        name of the batch whose worker should act as locutor
+    kwargs : dict
+        shared_data_buffers passed as kwargs to avoid picking dict
+    """
+
+    shared_data_buffer = {k: v for k, v in iteritems(kwargs)
+                          if not k.startswith(APPORTION_BUFFER_PREFIX)}
+
+    setup_injectables_and_logging(injectables, locutor=False)
+
+    mem.init_trace(setting('mem_tick'))
+
+    batch_step_info = dict(step_info, num_processes=1)
+
+    first_batch = True
+    while True:
+
+        batch_name = work_queue.get()
+        if batch_name is None:
+            break
+
+        t0 = time.time()
+
+        if not first_batch:
+            # - clear tables and injectables left over from previous batch
+            inject.clear_cache()
+            inject.reinject_decorated_tables()
+        first_batch = False
+
+        setup_injectables(injectables, locutor=(batch_name == locutor_batch))
+
+        logger.info("running batch %s", batch_name)
+        inject.add_injectable("pipeline_file_prefix", batch_name)
+
+        checkpoints = tables = None
+        if apportion_info is not None:
+            batch_apportion_info = dict(apportion_info, slices=apportion_info['slices'][batch_name])
+            checkpoints = apportion_info['checkpoints']
+            tables = setup_apportioned_pipeline(batch_apportion_info, kwargs, step_info)
+
+        run_simulation(queue, batch_step_info, resume_after, shared_data_buffer,
+                       checkpoints, tables)
+
+        queue.put({'batch': batch_name, 'time': time.time() - t0})
 
     chunk.log_write_hwm()
     mem.log_hwm()
@@ -776,7 +1268,14 @@ def mp_setup_skims(injectables, **kwargs):
     omx_file_path = config.data_file_path(setting('skims_file'))
     tags_to_load = setting('skim_time_periods')['labels']
 
-    skim_info = skims.get_skim_info(omx_file_path, tags_to_load)
+    settings = inject.get_injectable('settings')
+    if skims.memmap_skims(settings):
+        # build memmap skim store (if missing or stale) for sub-processes to memmap
+        skims.setup_memmap_skims(omx_file_path, tags_to_load, skims.memmap_dir(settings),
+                                 setting('skim_dtypes'))
+        return
+
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load, setting('skim_dtypes'))
     skims.load_skims(omx_file_path, skim_info, shared_data_buffer)
 
 
@@ -815,11 +1314,15 @@ def allocate_shared_skim_buffers():
 
     logger.info("allocate_shared_skim_buffer")
 
+    if skims.memmap_skims(inject.get_injectable('settings')):
+        logger.info("memmap_skims: not allocating shared skim buffers")
+        return {}
+
     omx_file_path = config.data_file_path(setting('skims_file'))
     tags_to_load = setting('skim_time_periods')['labels']
 
     # select the skims to load
-    skim_info = skims.get_skim_info(omx_file_path, tags_to_load)
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load, setting('skim_dtypes'))
     skim_buffers = skims.buffers_for_skims(skim_info, shared=True)
 
     return skim_buffers
@@ -846,7 +1349,8 @@ def run_sub_simulations(
         injectables,
         shared_data_buffers,
         step_info, process_names,
-        resume_after, previously_completed, fail_fast):
+        resume_after, previously_completed, fail_fast,
+        apportion_info=None):
     """
     Launch sub processes to run models in step according to specification in step_info.
 
@@ -857,6 +1361,10 @@ def run_sub_simulations(
 
     Drop 'completed' breadcrumbs for this run as sub-processes terminate
 
+    If the step has num_batches, then process_names are the names of batches, which are put on
+    a shared work queue for num_processes worker processes to run until the queue is empty
+    (see mp_run_batches) and 'completed' breadcrumbs are dropped as batches complete.
+
     Wait for all sub-processes to terminate and return list of those that completed successfully.
 
     Parameters
@@ -868,24 +1376,35 @@ def run_sub_simulations(
     step_info : dict
         step_info from run_list
     process_names : list of str
-        list of sub process names to in parallel
+        list of sub process (or batch) names to in parallel
     resume_after : str or None
         name of simulation to resume after, or LAST_CHECKPOINT to resume where previous run left off
     previously_completed : list of str
         names of processes that successfully completed in previous run
     fail_fast : bool
         whether to raise error if a sub process terminates with nonzero exitcode
+    apportion_info : dict or None
+        apportion_info from allocate_shared_apportion_buffers if apportioning via shared memory
+        (in which case shared_data_buffers should include the apportion buffers)
 
     Returns
     -------
     completed : list of str
-        names of sub_processes that completed successfully
+        names of sub_processes (or batches) that completed successfully
 
     """
     def log_queued_messages():
         for process, queue in zip(procs, queues):
             while not queue.empty():
                 msg = queue.get(block=False)
+                if 'batch' in msg:
+                    # batch worker completed a batch
+                    logger.info("%s batch %s completed : %s", process.name, msg['batch'],
+                                tracing.format_elapsed_time(msg['time']))
+                    completed.add(msg['batch'])
+                    drop_breadcrumb(step_name, 'completed', list(completed))
+                    mem.trace_memory_info("%s.%s.completed" % (process.name, msg['batch']))
+                    continue
                 logger.info("%s %s : %s", process.name, msg['model'],
                             tracing.format_elapsed_time(msg['time']))
                 mem.trace_memory_info("%s.%s.completed" % (process.name, msg['model']))
@@ -898,10 +1417,14 @@ def run_sub_simulations(
                 pass  # still running
             elif p.exitcode == 0:
                 # completed successfully
-                if p.name not in completed:
+                if p.name not in completed and p.name not in finished_workers:
                     logger.info("process %s completed", p.name)
-                    completed.add(p.name)
-                    drop_breadcrumb(step_name, 'completed', list(completed))
+                    if batched:
+                        # batches are tallied as they complete by log_queued_messages
+                        finished_workers.add(p.name)
+                    else:
+                        completed.add(p.name)
+                        drop_breadcrumb(step_name, 'completed', list(completed))
                     mem.trace_memory_info("%s.completed" % p.name)
             else:
                 # process failed
@@ -950,21 +1473,52 @@ def run_sub_simulations(
     if resume_after is None and step_info['step_num'] > 0:
         resume_after = LAST_CHECKPOINT
 
-    num_simulations = len(process_names)
     procs = []
     queues = []
     stagger_starts = step_info['stagger']
 
     completed = set(previously_completed)
     failed = set([])  # so we can log process failure first time it happens
+    finished_workers = set([])  # batch workers that ran out of batches
     drop_breadcrumb(step_name, 'completed', list(completed))
 
+    batched = step_info.get('num_batches', 0) > 0
+
+    if batched:
+        batch_names = process_names
+        work_queue = multiprocessing.Queue()
+        for batch_name in batch_names:
+            work_queue.put(batch_name)
+        num_workers = min(step_info['num_processes'], len(batch_names))
+        for i in range(num_workers):
+            work_queue.put(None)
+        # - spokesman is whichever worker gets the first batch
+        locutor_batch = batch_names[0] if batch_names else None
+        process_names = ["%s_worker_%s" % (step_name, i) for i in range(num_workers)]
+        logger.info('step %s: running %s batches with %s workers',
+                    step_name, len(batch_names), num_workers)
+
+    num_simulations = len(process_names)
+
     for i, process_name in enumerate(process_names):
         q = multiprocessing.Queue()
-        spokesman = (i == 0)
-        p = multiprocessing.Process(target=mp_run_simulation, name=process_name,
-                                    args=(spokesman, q, injectables, step_info, resume_after,),
-                                    kwargs=shared_data_buffers)
+        if batched:
+            p = multiprocessing.Process(target=mp_run_batches, name=process_name,
+                                        args=(q, injectables, step_info, resume_after,
+                                              apportion_info, work_queue, locutor_batch,),
+                                        kwargs=shared_data_buffers)
+        else:
+            spokesman = (i == 0)
+            if apportion_info is not None:
+                # each sub_proc only needs its own slices
+                sub_proc_apportion_info = dict(apportion_info,
+                                               slices=apportion_info['slices'][process_name])
+            else:
+                sub_proc_apportion_info = None
+            p = multiprocessing.Process(target=mp_run_simulation, name=process_name,
+                                        args=(spokesman, q, injectables, step_info, resume_after,
+                                              sub_proc_apportion_info,),
+                                        kwargs=shared_data_buffers)
         procs.append(p)
         queues.append(q)
 
@@ -991,7 +1545,7 @@ def run_sub_simulations(
             assert p.name in failed
         else:
             logger.info("Process %s completed with exitcode %s", p.name, p.exitcode)
-            assert p.name in completed
+            assert p.name in (finished_workers if batched else completed)
 
     t0 = tracing.print_elapsed_time('run_sub_simulations step %s' % step_name, t0)
 
@@ -1134,15 +1688,26 @@ def run_multiprocess(run_list, injectables):
         step_name = step_info['name']
 
         num_processes = step_info['num_processes']
+        num_batches = step_info.get('num_batches', 0)
         slice_info = step_info.get('slice', None)
 
         if num_processes == 1:
             sub_proc_names = [step_name]
         else:
-            sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_processes)]
+            # if batched, apportion into batches and run them with num_processes workers
+            sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_batches or num_processes)]
 
         # - mp_apportion_pipeline
-        if not skip_phase('apportion') and num_processes > 1:
+        apportion_info = None
+        step_data_buffers = shared_data_buffers
+        if num_processes > 1 and shared_memory_apportion():
+            # shared buffers don't outlive the run, so we need them unless skipping simulate
+            if not skip_phase('simulate'):
+                apportion_info, apportion_buffers = \
+                    allocate_shared_apportion_buffers(sub_proc_names, slice_info)
+                step_data_buffers = dict(shared_data_buffers, **apportion_buffers)
+                t0 = tracing.print_elapsed_time('allocate shared apportion buffers', t0)
+        elif not skip_phase('apportion') and num_processes > 1:
             run_sub_task(
                 multiprocessing.Process(
                     target=mp_apportion_pipeline, name='%s_apportion' % step_name,
@@ -1157,14 +1722,15 @@ def run_multiprocess(run_list, injectables):
             previously_completed = find_breadcrumb('completed', default=[])
 
             completed = run_sub_simulations(injectables,
-                                            shared_data_buffers,
+                                            step_data_buffers,
                                             step_info,
                                             sub_proc_names,
-                                            resume_after, previously_completed, fail_fast)
+                                            resume_after, previously_completed, fail_fast,
+                                            apportion_info)
 
-            if len(completed) != num_processes:
+            if len(completed) != len(sub_proc_names):
                 raise RuntimeError("%s processes failed in step %s" %
-                                   (num_processes - len(completed), step_name))
+                                   (len(sub_proc_names) - len(completed), step_name))
         drop_breadcrumb(step_name, 'simulate')
 
         # - mp_coalesce_pipelines
@@ -1378,6 +1944,18 @@ def get_run_list():
 
             multiprocess_steps[istep]['num_processes'] = num_processes
 
+            # - validate num_batches
+            num_batches = step.get('num_batches', 0)
+            if num_batches:
+                if not isinstance(num_batches, int) or num_batches < num_processes:
+                    raise RuntimeError("bad value (%s) for num_batches for step %s"
+                                       " (must be at least num_processes %s)" %
+                                       (num_batches, name, num_processes))
+                if num_processes == 1:
+                    raise RuntimeError("num_batches but num_processes is 1 for step %s"
+                                       " in multiprocess_steps" % name)
+                multiprocess_steps[istep]['num_batches'] = num_batches
+
             # - validate chunk_size and assign default
             chunk_size = step.get('chunk_size', None)
             if chunk_size is None:
@@ -1438,6 +2016,18 @@ def get_run_list():
 
             multiprocess_steps[istep]['models'] = step_models
 
+        # - batches are run one at a time so workers can't synchronize shadow prices
+        if setting('use_shadow_pricing', False):
+            shadow_settings = config.read_model_settings('shadow_pricing.yaml')
+            shadow_priced_models = \
+                set((shadow_settings.get('shadow_pricing_models') or {}).values())
+            for step in multiprocess_steps:
+                step_shadow_priced_models = shadow_priced_models.intersection(step['models'])
+                if step.get('num_batches', 0) and step_shadow_priced_models:
+                    raise RuntimeError("num_batches not supported with use_shadow_pricing"
+                                       " for step %s with shadow priced models %s" %
+                                       (step['name'], sorted(step_shadow_priced_models)))
+
         run_list['multiprocess_steps'] = multiprocess_steps
 
         # - add resume breadcrumbs
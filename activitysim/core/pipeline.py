@@ -10,10 +10,12 @@ from builtins import object
 
 from future.utils import iteritems
 
-import os
 import logging
+import hashlib
 import datetime as dt
 
+from collections import OrderedDict
+
 import pandas as pd
 
 from . import orca
@@ -22,6 +24,7 @@ from . import config
 from . import random
 from . import tracing
 from . import mem
+from . import checkpoint_store
 
 from . import util
 from .tracing import print_elapsed_time
@@ -47,6 +50,9 @@ LAST_CHECKPOINT = '_'
 # single character prefix for run_list model name to indicate that no checkpoint should be saved
 NO_CHECKPOINT_PREFIX = '_'
 
+# key prefix for incremental checkpoint column maps (see write_incremental_df)
+COLUMN_MAP_PREFIX = 'column_map'
+
 
 class Pipeline(object):
     def __init__(self):
@@ -62,6 +68,10 @@ class Pipeline(object):
 
         self.replaced_tables = {}
 
+        # for incremental checkpoints, {<table_name>: (<index_hash>, {<column>: (<hash>, <key>)})}
+        # with hash of last checkpointed version of every column and store key it was written to
+        self.checkpointed_columns = {}
+
         self._rng = random.Random()
 
         self.open_files = {}
@@ -92,6 +102,10 @@ def pipeline_table_key(table_name, checkpoint_name):
     return key
 
 
+def column_map_key(key):
+    return "%s/%s" % (COLUMN_MAP_PREFIX, key)
+
+
 def close_on_exit(file, name):
     assert name not in _PIPELINE.open_files
     _PIPELINE.open_files[name] = file
@@ -108,6 +122,9 @@ def open_pipeline_store(overwrite=False):
     """
     Open the pipeline checkpoint store
 
+    The store is an hdf5 file or, if the checkpoint_format setting is 'parquet', a directory
+    of parquet files (see checkpoint_store)
+
     Parameters
     ----------
     overwrite : bool
@@ -121,21 +138,19 @@ def open_pipeline_store(overwrite=False):
 
     if overwrite:
         try:
-            if os.path.isfile(pipeline_file_path):
-                logger.debug("removing pipeline store: %s" % pipeline_file_path)
-                os.unlink(pipeline_file_path)
+            checkpoint_store.remove_store(pipeline_file_path)
         except Exception as e:
             print(e)
             logger.warning("Error removing %s: %s" % (pipeline_file_path, e))
 
-    _PIPELINE.pipeline_store = pd.HDFStore(pipeline_file_path, mode='a')
+    _PIPELINE.pipeline_store = checkpoint_store.open_store(pipeline_file_path, mode='a')
 
     logger.debug("opened pipeline_store")
 
 
 def get_pipeline_store():
     """
-    Return the open pipeline hdf5 checkpoint store or return None if it not been opened
+    Return the open pipeline checkpoint store or return None if it not been opened
     """
     return _PIPELINE.pipeline_store
 
@@ -151,7 +166,7 @@ def get_rn_generator():
     return _PIPELINE.rng()
 
 
-def read_df(table_name, checkpoint_name=None):
+def read_df(table_name, checkpoint_name=None, columns=None):
     """
     Read a pandas dataframe from the pipeline store.
 
@@ -160,12 +175,14 @@ def read_df(table_name, checkpoint_name=None):
 
     The only exception is the checkpoints dataframe, which just has a table_name
 
-    An error will be raised by HDFStore if the table is not found
+    An error will be raised by the store if the table is not found
 
     Parameters
     ----------
     table_name : str
     checkpoint_name : str
+    columns : list of str or None
+        columns to read (default all) - only these columns are read from a parquet store
 
     Returns
     -------
@@ -175,11 +192,57 @@ def read_df(table_name, checkpoint_name=None):
     """
 
     store = get_pipeline_store()
-    df = store[pipeline_table_key(table_name, checkpoint_name)]
+    df = read_table_key(store, pipeline_table_key(table_name, checkpoint_name), columns=columns)
 
     return df
 
 
+def _read_table_key(store, key, columns=None):
+
+    map_key = column_map_key(key)
+    if map_key not in store:
+        df = store.read(key, columns=columns)
+        return df, pd.Series(key, index=df.columns)
+
+    # incremental checkpoint - series mapping column names to key of version they were written in
+    column_keys = store[map_key].idxmax(axis=1)
+    if columns is not None:
+        column_keys = column_keys[columns]
+
+    versions = [store.read(k, columns=list(column_keys.index[column_keys == k]))
+                for k in column_keys.unique()]
+
+    if versions:
+        df = pd.concat(versions, axis=1)[column_keys.index]
+    else:
+        # no columns requested (or left)
+        df = store.read(key, columns=[])
+
+    return df, column_keys
+
+
+def read_table_key(store, key, columns=None):
+    """
+    Read a table version from an open checkpoint store by key, assembling it from the column
+    deltas of earlier versions if it was written as an incremental checkpoint.
+
+    Parameters
+    ----------
+    store : open checkpoint_store
+    key : str
+        pipeline_table_key of table version
+    columns : list of str or None
+        columns to read (default all)
+
+    Returns
+    -------
+    df : pandas.DataFrame
+    """
+
+    df, _ = _read_table_key(store, key, columns)
+    return df
+
+
 def write_df(df, table_name, checkpoint_name=None):
     """
     Write a pandas dataframe to the pipeline store.
@@ -204,9 +267,97 @@ def write_df(df, table_name, checkpoint_name=None):
 
     store = get_pipeline_store()
 
-    store[pipeline_table_key(table_name, checkpoint_name)] = df
+    store.write(pipeline_table_key(table_name, checkpoint_name), df)
+
+
+def _index_hash(index):
+
+    h = hashlib.md5(pd.util.hash_pandas_object(index).values.tobytes())
+    h.update(repr((index.name, index.dtype)).encode())
+    return h.hexdigest()
+
+
+def _column_hash(series):
+
+    h = hashlib.md5(pd.util.hash_pandas_object(series, index=False).values.tobytes())
+    # dtype repr includes categories of categoricals
+    h.update(repr(series.dtype).encode())
+    return h.hexdigest()
 
-    store.flush()
+
+def write_incremental_df(df, table_name, checkpoint_name):
+    """
+    Write the columns of df that have changed since the table was last checkpointed
+
+    If the table hasn't been checkpointed before, or its index has changed (e.g. rows were added),
+    the whole table is written, as with write_df. Otherwise only new and changed columns (as
+    detected by comparing hashes of their values) are written, along with a column map
+    (see column_map_key) flagging the key of the version each column of the table was last
+    written in, which read_table_key uses to reassemble the table.
+
+    Since this compares column values rather than relying on orca to tell us about added or
+    replaced columns, it also detects columns that were modified in place.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        current version of table
+    table_name : str
+    checkpoint_name : str
+
+    Returns
+    -------
+    changed : bool
+        False if the table hasn't changed since it was last checkpointed (and nothing was written)
+    """
+
+    key = pipeline_table_key(table_name, checkpoint_name)
+
+    index_hash = _index_hash(df.index)
+    column_hashes = [(str(c), _column_hash(df[c])) for c in df.columns]
+
+    last_index_hash, last_columns = \
+        _PIPELINE.checkpointed_columns.get(table_name, (None, OrderedDict()))
+
+    if index_hash != last_index_hash:
+        write_df(df, table_name, checkpoint_name)
+        _PIPELINE.checkpointed_columns[table_name] = \
+            (index_hash, OrderedDict((c, (h, key)) for c, h in column_hashes))
+        return True
+
+    changed_columns = [c for c, h in column_hashes if last_columns.get(c, (None, None))[0] != h]
+
+    if not changed_columns and [c for c, _ in column_hashes] == list(last_columns.keys()):
+        return False
+
+    columns = OrderedDict((c, (h, key) if c in changed_columns else last_columns[c])
+                          for c, h in column_hashes)
+
+    logger.debug("write_incremental_df '%s' at '%s' changed columns %s" %
+                 (table_name, checkpoint_name, changed_columns))
+
+    store = get_pipeline_store()
+
+    if changed_columns:
+        delta = df[[c for c in df.columns if str(c) in changed_columns]]
+        delta.columns = delta.columns.astype(str)
+        store.write(key, delta)
+
+    # boolean column map (with a column per key) since fixed format hdf5 object columns are bulky
+    column_keys = pd.Series([k for _, k in columns.values()], index=list(columns.keys()))
+    column_map = pd.DataFrame(OrderedDict((k, column_keys == k) for k in column_keys.unique()))
+    store.write(column_map_key(key), column_map)
+
+    _PIPELINE.checkpointed_columns[table_name] = (index_hash, columns)
+
+    return True
+
+
+def incremental_checkpoints():
+    """
+    Should checkpoints only write new or changed columns of tables (see write_incremental_df)
+    """
+    return config.setting('incremental_checkpoints', False)
 
 
 def rewrap(table_name, df=None):
@@ -278,21 +429,31 @@ def add_checkpoint(checkpoint_name):
 
     logger.debug("add_checkpoint %s timestamp %s" % (checkpoint_name, timestamp))
 
+    incremental = incremental_checkpoints()
+
     for table_name in orca_dataframe_tables():
 
         # if we have not already checkpointed it or it has changed
-        # FIXME - this won't detect if the orca table was modified
+        # FIXME - this won't detect if the orca table was modified (unless incremental_checkpoints)
         if len(orca.list_columns_for_table(table_name)):
             # rewrap the changed orca table as a unitary DataFrame-backed DataFrameWrapper table
             df = rewrap(table_name)
+        elif incremental:
+            # write_incremental_df will detect whether (and which columns) it changed
+            df = orca.get_raw_table(table_name).local
         elif table_name not in _PIPELINE.last_checkpoint or table_name in _PIPELINE.replaced_tables:
             df = orca.get_table(table_name).to_frame()
         else:
             continue
 
+        if incremental:
+            if not write_incremental_df(df, table_name, checkpoint_name):
+                continue
+        else:
+            write_df(df, table_name, checkpoint_name)
+
         logger.debug("add_checkpoint '%s' table '%s' %s" %
                      (checkpoint_name, table_name, util.df_size(df)))
-        write_df(df, table_name, checkpoint_name)
 
         # remember which checkpoint it was last written
         _PIPELINE.last_checkpoint[table_name] = checkpoint_name
@@ -335,7 +496,7 @@ def checkpointed_tables():
 
 def load_checkpoint(checkpoint_name):
     """
-    Load dataframes and restore random number channel state from pipeline hdf5 file.
+    Load dataframes and restore random number channel state from pipeline checkpoint store.
     This restores the pipeline state that existed at the specified checkpoint in a prior simulation.
     This allows us to resume the simulation after the specified checkpoint
 
@@ -363,17 +524,8 @@ def load_checkpoint(checkpoint_name):
         logger.error(msg)
         raise RuntimeError(msg)
 
-    # convert pandas dataframe back to array of checkpoint dicts
-    checkpoints = checkpoints.to_dict(orient='records')
-
-    # drop tables with empty names
-    for checkpoint in checkpoints:
-        for key in list(checkpoint.keys()):
-            if key not in NON_TABLE_COLUMNS and not checkpoint[key]:
-                del checkpoint[key]
-
     # patch _CHECKPOINTS array of dicts
-    _PIPELINE.checkpoints = checkpoints
+    _PIPELINE.checkpoints = checkpoint_records(checkpoints)
 
     # patch _CHECKPOINTS dict with latest checkpoint info
     _PIPELINE.last_checkpoint.clear()
@@ -384,14 +536,53 @@ def load_checkpoint(checkpoint_name):
 
     tables = checkpointed_tables()
 
+    incremental = incremental_checkpoints()
+
     loaded_tables = {}
     for table_name in tables:
         # read dataframe from pipeline store
-        df = read_df(table_name, checkpoint_name=_PIPELINE.last_checkpoint[table_name])
+        key = pipeline_table_key(table_name, _PIPELINE.last_checkpoint[table_name])
+        df, column_keys = _read_table_key(get_pipeline_store(), key)
         logger.info("load_checkpoint table %s %s" % (table_name, df.shape))
+
+        if incremental:
+            # so next incremental checkpoint will know which columns have changed
+            _PIPELINE.checkpointed_columns[table_name] = \
+                (_index_hash(df.index),
+                 OrderedDict((str(c), (_column_hash(df[c]), column_keys[c])) for c in df.columns))
+        loaded_tables[table_name] = df
+
+    register_checkpoint_tables(loaded_tables)
+
+
+def checkpoint_records(checkpoints):
+    """
+    convert checkpoints dataframe to array of checkpoint dicts (without tables with empty names)
+    """
+
+    checkpoints = checkpoints.to_dict(orient='records')
+
+    # drop tables with empty names
+    for checkpoint in checkpoints:
+        for key in list(checkpoint.keys()):
+            if key not in NON_TABLE_COLUMNS and not checkpoint[key]:
+                del checkpoint[key]
+
+    return checkpoints
+
+
+def register_checkpoint_tables(loaded_tables):
+    """
+    register tables of loaded checkpoint as orca tables, traceable tables and rng channels
+
+    Parameters
+    ----------
+    loaded_tables : dict {<table_name>: <pandas.DataFrame>}
+    """
+
+    for table_name, df in iteritems(loaded_tables):
         # register it as an orca table
         rewrap(table_name, df)
-        loaded_tables[table_name] = df
 
     # register for tracing in order that tracing.register_traceable_table wants us to register them
     traceable_tables = inject.get_injectable('traceable_tables', [])
@@ -503,6 +694,7 @@ def open_pipeline(resume_after=None):
     _PIPELINE.is_open = True
 
     get_rn_generator().set_base_seed(inject.get_injectable('rng_base_seed', 0))
+    get_rn_generator().set_channel_type(inject.get_injectable('rng_channel_type', None))
 
     if resume_after:
         # open existing pipeline
@@ -521,6 +713,49 @@ def open_pipeline(resume_after=None):
     logger.debug("open_pipeline complete")
 
 
+def open_pipeline_with_tables(checkpoints, tables):
+    """
+    Start pipeline for a new run, resuming from the last checkpoint in checkpoints but with
+    the checkpointed tables passed in rather than loaded from a pipeline store.
+
+    This lets multiprocess sub-processes start from the tables apportioned to them in memory,
+    without writing them to a pipeline file only to read them back. Only the checkpoints table
+    is written to the (new, empty) pipeline store, so unless they change, the tables won't be in
+    the store. (mp_tasks.setup_apportioned_pipeline adds them if resuming from the store.)
+
+    Parameters
+    ----------
+    checkpoints : pandas.DataFrame
+        checkpoints table with the checkpoint to start from as its last row
+    tables : dict {<table_name>: <pandas.DataFrame>}
+        the tables in that checkpoint
+    """
+
+    logger.info("open_pipeline_with_tables")
+
+    if _PIPELINE.is_open:
+        raise RuntimeError("Pipeline is already open!")
+
+    _PIPELINE.init_state()
+    _PIPELINE.is_open = True
+
+    get_rn_generator().set_base_seed(inject.get_injectable('rng_base_seed', 0))
+    get_rn_generator().set_channel_type(inject.get_injectable('rng_channel_type', None))
+
+    open_pipeline_store(overwrite=True)
+
+    _PIPELINE.checkpoints = checkpoint_records(checkpoints)
+    _PIPELINE.last_checkpoint.update(_PIPELINE.checkpoints[-1])
+
+    assert set(checkpointed_tables()) == set(tables.keys())
+
+    register_checkpoint_tables(tables)
+
+    write_df(checkpoints, CHECKPOINT_TABLE_NAME)
+
+    logger.debug("open_pipeline_with_tables complete")
+
+
 def last_checkpoint():
     """
 
@@ -598,7 +833,7 @@ def run(models, resume_after=None):
     # don't close the pipeline, as the user may want to read intermediate results from the store
 
 
-def get_table(table_name, checkpoint_name=None):
+def get_table(table_name, checkpoint_name=None, columns=None):
     """
     Return pandas dataframe corresponding to table_name
 
@@ -612,6 +847,9 @@ def get_table(table_name, checkpoint_name=None):
     ----------
     table_name : str
     checkpoint_name : str or None
+    columns : list of str or None
+        if specified, only return these columns (with a parquet checkpoint_format, only these
+        columns are read when reading an earlier version of the table from the store)
 
     Returns
     -------
@@ -626,7 +864,7 @@ def get_table(table_name, checkpoint_name=None):
             raise RuntimeError("get_table: checkpoint_name ('%s') not supported"
                                "for non-checkpointed table '%s'" % (checkpoint_name, table_name))
 
-        return orca.get_table(table_name).to_frame()
+        return orca.get_table(table_name).to_frame(columns)
 
     # if they want current version of table, no need to read from pipeline store
     if checkpoint_name is None:
@@ -638,7 +876,7 @@ def get_table(table_name, checkpoint_name=None):
             raise RuntimeError("table '%s' was dropped." % table_name)
 
         # return orca.get_table(table_name).local
-        return orca.get_table(table_name).to_frame()
+        return orca.get_table(table_name).to_frame(columns)
 
     # find the requested checkpoint
     checkpoint = \
@@ -654,9 +892,9 @@ def get_table(table_name, checkpoint_name=None):
 
     # if this version of table is same as current
     if _PIPELINE.last_checkpoint.get(table_name, None) == last_checkpoint_name:
-        return orca.get_table(table_name).to_frame()
+        return orca.get_table(table_name).to_frame(columns)
 
-    return read_df(table_name, last_checkpoint_name)
+    return read_df(table_name, last_checkpoint_name, columns=columns)
 
 
 def get_checkpoints():
@@ -677,7 +915,8 @@ def get_checkpoints():
         df = store[CHECKPOINT_TABLE_NAME]
     else:
         pipeline_file_path = config.pipeline_file_path(orca.get_injectable('pipeline_file_name'))
-        df = pd.read_hdf(pipeline_file_path, CHECKPOINT_TABLE_NAME)
+        with checkpoint_store.open_store(pipeline_file_path, mode='r') as store:
+            df = store[CHECKPOINT_TABLE_NAME]
 
     # non-table columns first (column order in df is random because created from a dict)
     table_names = [name for name in df.columns.values if name not in NON_TABLE_COLUMNS]
@@ -781,6 +1020,8 @@ def drop_table(table_name):
         logger.debug("drop_table forgetting replaced_tables '%s'" % table_name)
         del _PIPELINE.replaced_tables[table_name]
 
+    _PIPELINE.checkpointed_columns.pop(table_name, None)
+
     if table_name in _PIPELINE.last_checkpoint:
 
         logger.debug("drop_table removing table %s from last_checkpoint" % table_name)
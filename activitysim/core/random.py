@@ -21,6 +21,20 @@ logger = logging.getLogger(__name__)
 # one more than 0xFFFFFFFF so we can wrap using: int64 % _MAX_SEED
 _MAX_SEED = (1 << 32)
 _SEED_MASK = 0xffffffff
+_SEED_MASK_64 = 0xffffffffffffffff
+
+# splitmix64 constants
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_MULT_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_MULT_2 = np.uint64(0x94D049BB133111EB)
+
+# 53 bits of float mantissa
+_FLOAT_SHIFT = np.uint64(11)
+_FLOAT_SCALE = 1.0 / (1 << 53)
+
+# rng_channel_type setting values
+SIMPLE_CHANNEL = 'simple'
+COUNTER_CHANNEL = 'counter'
 
 
 def hash32(s):
@@ -39,6 +53,26 @@ def hash32(s):
     return int(h, base=16) & _SEED_MASK
 
 
+def splitmix64(x):
+    """
+    splitmix64 finalizer - a cheap, well distributed 64 bit hash
+
+    arithmetic wraps (mod 1 << 64) silently since we only operate on uint64 arrays
+
+    Parameters
+    ----------
+    x : numpy.ndarray of uint64
+
+    Returns
+    -------
+        numpy.ndarray of uint64 of same shape as x
+    """
+    x = x + _GOLDEN_GAMMA
+    x = (x ^ (x >> np.uint64(30))) * _MIX_MULT_1
+    x = (x ^ (x >> np.uint64(27))) * _MIX_MULT_2
+    return x ^ (x >> np.uint64(31))
+
+
 class SimpleChannel(object):
     """
 
@@ -175,6 +209,19 @@ class SimpleChannel(object):
         self.row_states['offset'] = 0
         self.row_states['row_seed'] = 0
 
+    def get_row_offsets(self, df):
+        """
+        Return the number of rands consumed this step by each row in df (in df order)
+        """
+        return self.row_states.loc[df.index, 'offset'].values.copy()
+
+    def set_row_offsets(self, df, offsets):
+        """
+        Set the number of rands consumed this step by each row in df (e.g. to bring this
+        channel up to date with draws made for those rows in a forked subprocess)
+        """
+        self.row_states.loc[df.index, 'offset'] = offsets
+
     def _generators_for_df(self, df):
         """
         Python generator function for iterating over numpy prngs (nomenclature collision!)
@@ -359,6 +406,247 @@ class SimpleChannel(object):
         return sample
 
 
+class CounterChannel(object):
+    """
+    Counter-based alternative to SimpleChannel
+
+    Rather than seeding (and fast-forwarding) a numpy RandomState for every row, the n-th random
+    number for a row is computed directly as a hash of (base_seed, channel_seed, step_seed,
+    row index, n) using splitmix64. So rands for every row can be generated in a single
+    vectorized numpy operation, and the rands for a row don't depend on what other rows
+    are in the df, so results are the same no matter how rows are chunked or sliced
+    across processes.
+
+    The only state we keep for each row is the number of rands consumed this step (offset.)
+
+    Note that the resulting random streams are (of course) different from those of SimpleChannel,
+    so results will not match those of runs made with SimpleChannel.
+    """
+
+    def __init__(self, channel_name, base_seed, domain_df, step_name):
+
+        self.base_seed = base_seed
+
+        # ensure that every channel is different, even for the same df index values and max_steps
+        self.channel_name = channel_name
+        self.channel_seed = hash32(self.channel_name)
+
+        self.step_name = None
+        self.step_seed = None
+        self.step_key = None
+
+        # row index values and number of rands pulled this step for each row
+        self.row_index = None
+        self.offsets = None
+
+        self.extend_domain(domain_df)
+        assert len(self.row_index) == domain_df.shape[0]
+
+        if step_name:
+            self.begin_step(step_name)
+
+    def extend_domain(self, domain_df):
+        """
+        Extend or create row offsets for each row in domain_df
+
+        If extending, the index values of new tables must be disjoint so
+        there will be no ambiguity/collisions between rows
+
+        Parameters
+        ----------
+        domain_df : pandas.DataFrame
+            domain dataframe with index values for which random streams are to be generated
+            and well-known index name corresponding to the channel
+        """
+
+        if domain_df.empty:
+            logger.warning("extend_domain for channel %s for empty domain_df" % self.channel_name)
+
+        offsets = np.zeros(len(domain_df.index), dtype=np.int64)
+
+        if self.row_index is None:
+            self.row_index = domain_df.index
+            self.offsets = offsets
+        else:
+            # if extending, these should be new rows, no intersection with existing rows
+            assert len(self.row_index.intersection(domain_df.index)) == 0
+            self.row_index = self.row_index.append(domain_df.index)
+            self.offsets = np.concatenate((self.offsets, offsets))
+
+    def begin_step(self, step_name):
+        """
+        Reset channel state for a new state
+
+        Parameters
+        ----------
+        step_name : str
+            pipeline step name for this step
+        """
+
+        assert self.step_name is None
+
+        self.step_name = step_name
+        self.step_seed = hash32(self.step_name)
+
+        seeds = [self.base_seed, self.channel_seed, self.step_seed]
+        step_key = np.zeros(1, dtype=np.uint64)
+        for seed in seeds:
+            # mask (possibly negative) seeds to 64 bits so they can be converted to uint64
+            step_key = splitmix64(step_key ^ np.uint64(seed & _SEED_MASK_64))
+        self.step_key = step_key[0]
+
+        self.offsets[:] = 0
+
+    def end_step(self, step_name):
+
+        assert self.step_name == step_name
+
+        self.step_name = None
+        self.step_seed = None
+        self.step_key = None
+        self.offsets[:] = 0
+
+    def _row_positions(self, df):
+
+        # assert no dupes
+        assert len(df.index.unique()) == len(df.index)
+
+        positions = self.row_index.get_indexer(df.index)
+        if (positions < 0).any():
+            raise RuntimeError("Channel '%s' has no rows for %s %s index values" %
+                               (self.channel_name, (positions < 0).sum(), df.index.name))
+
+        return positions
+
+    def get_row_offsets(self, df):
+        """
+        Return the number of rands consumed this step by each row in df (in df order)
+        """
+        return self.offsets[self._row_positions(df)].copy()
+
+    def set_row_offsets(self, df, offsets):
+        """
+        Set the number of rands consumed this step by each row in df (e.g. to bring this
+        channel up to date with draws made for those rows in a forked subprocess)
+        """
+        self.offsets[self._row_positions(df)] = offsets
+
+    def _uniforms(self, df, n):
+        """
+        Return the next n uniform rands in range [0, 1) for each row in df and update offsets
+
+        Returns
+        -------
+        rands : 2-D ndarray with shape (len(df), n)
+        """
+
+        positions = self._row_positions(df)
+
+        row_keys = splitmix64(np.asanyarray(df.index.values).astype(np.int64).view(np.uint64)
+                              ^ self.step_key)
+
+        counters = (self.offsets[positions][:, np.newaxis] + np.arange(n)).astype(np.uint64)
+
+        x = splitmix64(row_keys[:, np.newaxis] + counters * _GOLDEN_GAMMA)
+        rands = (x >> _FLOAT_SHIFT).astype(np.float64) * _FLOAT_SCALE
+
+        # update offset for rows we handled
+        self.offsets[positions] += n
+
+        return rands
+
+    def random_for_df(self, df, step_name, n=1):
+        """
+        Return n floating point random numbers in range [0, 1) for each row in df
+
+        See SimpleChannel.random_for_df
+
+        Returns
+        -------
+        rands : 2-D ndarray
+            array the same length as df, with n floats in range [0, 1) for each df row
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        return self._uniforms(df, n)
+
+    def lognormal_for_df(self, df, step_name, mu, sigma):
+        """
+        Return a floating point random number in lognormal distribution for each row in df
+
+        Uses the Box-Muller transform, so two rands are consumed for each row.
+
+        See SimpleChannel.lognormal_for_df
+
+        Returns
+        -------
+        rands : 1-D ndarray the same length as df
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        def to_array(x):
+            if isinstance(x, pd.Series):
+                return x.values
+            return x
+
+        u = self._uniforms(df, 2)
+
+        # 1 - u is in range (0, 1] so log is safe
+        z = np.sqrt(-2.0 * np.log(1.0 - u[:, 0])) * np.cos(2.0 * np.pi * u[:, 1])
+
+        return np.exp(to_array(mu) + to_array(sigma) * z)
+
+    def choice_for_df(self, df, step_name, a, size, replace):
+        """
+        Equivalent of numpy.random.choice applied once for each row in df
+
+        See SimpleChannel.choice_for_df
+
+        Sampling without replacement draws the k-th sample from the alternatives not yet selected
+        for each row. This is done for all rows at once, so cost is proportional to size * size
+        (but not to the number of alternatives.)
+
+        Returns
+        -------
+        choices : 1-D ndarray of length: size * len(df.index)
+            The generated random samples for each row concatenated into a single (flat) array
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        a = np.arange(a) if np.isscalar(a) else np.asanyarray(a)
+        num_alts = len(a)
+
+        u = self._uniforms(df, size)
+
+        if replace:
+            choices = (u * num_alts).astype(np.int64)
+        else:
+            assert size <= num_alts
+
+            choices = np.empty(u.shape, dtype=np.int64)
+            chosen = np.empty(u.shape, dtype=np.int64)  # sorted choices so far for each row
+
+            for j in range(size):
+                # index of choice among the num_alts - j alternatives not yet chosen
+                k = (u[:, j] * (num_alts - j)).astype(np.int64)
+
+                # skip over previous choices (in ascending order) to get index into alternatives
+                for i in range(j):
+                    k += (k >= chosen[:, i])
+
+                choices[:, j] = k
+                chosen[:, j] = k
+                chosen[:, :j + 1].sort(axis=1)
+
+        return a[choices].flatten()
+
+
 class Random(object):
 
     def __init__(self):
@@ -373,6 +661,8 @@ class Random(object):
         self.base_seed = 0
         self.global_rng = np.random.RandomState()
 
+        self.channel_type = SIMPLE_CHANNEL
+
     def get_channel_for_df(self, df):
         """
         Return the channel for this df. Channel should already have been loaded/added.
@@ -468,7 +758,10 @@ class Random(object):
         else:
             logger.debug("Adding channel '%s' %s ids" % (channel_name, len(domain_df.index)))
 
-            channel = SimpleChannel(channel_name,
+            channel_class = CounterChannel if self.channel_type == COUNTER_CHANNEL \
+                else SimpleChannel
+
+            channel = channel_class(channel_name,
                                     self.base_seed,
                                     domain_df,
                                     self.step_name
@@ -524,6 +817,35 @@ class Random(object):
             logger.info("Set random seed base to %s" % seed)
             self.base_seed = seed
 
+    def set_channel_type(self, channel_type=None):
+        """
+        Select the channel implementation used to generate random streams for channel domains.
+
+        'simple' (the default) seeds a numpy RandomState for each row (SimpleChannel)
+        'counter' computes rands as a hash of seeds, row index and offset (CounterChannel)
+
+        Must be called before first step (before any channels are added or rands are consumed)
+
+        Parameters
+        ----------
+        channel_type : str or None
+            'simple' or 'counter' (None means 'simple')
+        """
+
+        channel_type = channel_type or SIMPLE_CHANNEL
+
+        if channel_type not in [SIMPLE_CHANNEL, COUNTER_CHANNEL]:
+            raise RuntimeError("Unknown rng channel type '%s'" % channel_type)
+
+        if channel_type == self.channel_type:
+            return
+
+        if self.step_name is not None or self.channels:
+            raise RuntimeError("Can only call set_channel_type before the first step.")
+
+        logger.info("Set random channel type to %s" % channel_type)
+        self.channel_type = channel_type
+
     def get_global_rng(self):
         """
         Return a numpy random number generator for use within current step.
@@ -556,6 +878,52 @@ class Random(object):
         seed = [self.base_seed, hash32(one_off_step_name)]
         return np.random.RandomState(seed)
 
+    def get_row_offsets(self, df):
+        """
+        Return the current random stream offsets (number of rands consumed this step)
+        for the rows in df, in df order.
+
+        Together with set_row_offsets, this allows draws for a subset of rows to be made in
+        a forked subprocess and the channel state to then be brought up to date in the parent,
+        so that results are identical to what they would have been had the draws been made
+        in the parent process.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            df with index name and values corresponding to a registered channel
+
+        Returns
+        -------
+        offsets : 1-D ndarray the same length as df
+        """
+
+        # FIXME - for tests
+        if not self.channels:
+            return np.zeros(len(df.index), dtype=np.int64)
+
+        channel = self.get_channel_for_df(df)
+        return channel.get_row_offsets(df)
+
+    def set_row_offsets(self, df, offsets):
+        """
+        Set the random stream offsets for the rows in df (see get_row_offsets)
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            df with index name and values corresponding to a registered channel
+        offsets : 1-D array-like the same length as df
+        """
+
+        # FIXME - for tests
+        if not self.channels:
+            return
+
+        assert len(offsets) == len(df.index)
+        channel = self.get_channel_for_df(df)
+        channel.set_row_offsets(df, offsets)
+
     def random_for_df(self, df, n=1):
         """
         Return a single floating point random number in range [0, 1) for each row in df
@@ -26,6 +26,7 @@ from . import util
 from . import assign
 from . import chunk
 from . import mem
+from . import spec_compiler
 
 logger = logging.getLogger(__name__)
 
@@ -171,17 +172,12 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None, have_trace_t
 
     locals_dict['df'] = choosers
 
-    exprs = spec.index
+    # spec expressions are parsed once and cached, so we just evaluate the compiled plan
+    # straight into expression_values
+    compiled_spec = spec_compiler.compile_spec(spec.index)
+
     expression_values = np.empty((spec.shape[0], choosers.shape[0]))
-    for i, expr in enumerate(exprs):
-        try:
-            if expr.startswith('@'):
-                expression_values[i] = eval(expr[1:], globals_dict, locals_dict)
-            else:
-                expression_values[i] = choosers.eval(expr)
-        except Exception as err:
-            logger.exception("Variable evaluation failed for: %s" % str(expr))
-            raise err
+    compiled_spec.evaluate_into(choosers, expression_values, globals_dict, locals_dict)
 
     # - compute_utilities
     utilities = np.dot(expression_values.transpose(), spec.astype(np.float64).values)
@@ -277,13 +273,13 @@ def eval_variables(exprs, df, locals_d=None):
 
         return a
 
+    compiled_spec = spec_compiler.compile_spec(exprs)
+
     values = OrderedDict()
-    for expr in exprs:
+    for compiled_expr in compiled_spec:
+        expr = compiled_expr.expr
         try:
-            if expr.startswith('@'):
-                expr_values = to_array(eval(expr[1:], globals_dict, locals_dict))
-            else:
-                expr_values = to_array(df.eval(expr))
+            expr_values = to_array(compiled_expr.evaluate(df, globals_dict, locals_dict))
             # read model spec should ensure uniqueness, otherwise we should uniquify
             assert expr not in values
             values[expr] = expr_values
@@ -356,6 +352,39 @@ def set_skim_wrapper_targets(df, skims):
         skims.set_df(df)
 
 
+def skim_wrapper_columns(skims):
+    """
+    Return set of df column names that skim wrappers use to dereference skims
+
+    Parameters
+    ----------
+    skims : SkimDictWrapper or SkimStackWrapper object, or a list or dict of skims, or None
+
+    Returns
+    -------
+    columns : set of str
+    """
+
+    if skims is None:
+        return set()
+
+    if isinstance(skims, list):
+        wrappers = skims
+    elif isinstance(skims, dict):
+        wrappers = listvalues(skims)
+    else:
+        wrappers = [skims]
+
+    columns = set()
+    for skim in wrappers:
+        if isinstance(skim, SkimDictWrapper):
+            columns.update([skim.left_key, skim.right_key])
+        elif isinstance(skim, SkimStackWrapper):
+            columns.update([skim.left_key, skim.right_key, skim.skim_key])
+
+    return columns
+
+
 def _check_for_variability(expression_values, trace_label):
     """
     This is an internal method which checks for variability in each
@@ -823,7 +852,8 @@ def simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
 
     result_list = []
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk \
+            in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -998,12 +1028,86 @@ def simple_simulate_logsums_rpc(chunk_size, choosers, spec, nest_spec, trace_lab
     return chunk.rows_per_chunk(chunk_size, row_size, num_choosers, trace_label)
 
 
+def logsum_key_columns(choosers, spec, skims):
+    """
+    Return list of the choosers columns that logsums can depend on, or None if logsums might
+    depend on other chooser attributes (or we can't tell)
+
+    These are the columns referenced by spec expressions and the skim wrapper keys (e.g. origin,
+    destination, and out_period and in_period skim_keys.)
+    """
+
+    names = spec_compiler.compile_spec(spec.index).referenced_names()
+
+    # can't dedupe if spec might reference the index (e.g. df.index or person_id)
+    if names is None or 'index' in names or choosers.index.name in names:
+        return None
+
+    names = names | skim_wrapper_columns(skims)
+
+    return [c for c in choosers.columns if c in names]
+
+
+def dedupe_logsum_choosers(choosers, spec, skims, key_columns=None):
+    """
+    Return the first of each set of choosers with the same key_columns values, and the position
+    of each chooser's representative in unique_choosers.
+
+    Parameters
+    ----------
+    choosers : pandas.DataFrame
+    spec : pandas.DataFrame
+    skims
+    key_columns : list of str or None
+        declared key columns, otherwise inferred by logsum_key_columns
+
+    Returns
+    -------
+    unique_choosers : pandas.DataFrame or None
+        None if we can't dedupe or there aren't any duplicates
+    group_ids : numpy.ndarray
+        position in unique_choosers of each chooser's representative
+    """
+
+    if key_columns is None:
+        key_columns = logsum_key_columns(choosers, spec, skims)
+
+    if key_columns is None or choosers.empty:
+        return None, None
+
+    if key_columns:
+        # groupby drops null keys, so group on factorized key values (null values factorize to -1)
+        key_codes = pd.DataFrame({c: pd.factorize(choosers[c].values)[0] for c in key_columns})
+        group_ids = key_codes.groupby(key_columns, sort=False).ngroup().values
+    else:
+        group_ids = np.zeros(len(choosers), dtype=int)
+
+    num_groups = group_ids.max() + 1
+    if num_groups == len(choosers):
+        return None, None
+
+    # position of first chooser in each group
+    first = np.full(num_groups, len(choosers), dtype=int)
+    np.minimum.at(first, group_ids, np.arange(len(choosers)))
+
+    return choosers.take(first), group_ids
+
+
 def simple_simulate_logsums(choosers, spec, nest_spec,
                             skims=None, locals_d=None, chunk_size=0,
-                            trace_label=None):
+                            trace_label=None, key_columns=None):
     """
     like simple_simulate except return logsums instead of making choices
 
+    Unless the dedupe_logsums setting is False, logsums are only computed once for choosers with
+    the same values for key_columns (the chooser columns referenced by the spec and the skim keys)
+    and then scattered back to the other choosers with the same key values.
+
+    Parameters
+    ----------
+    key_columns : list of str or None
+        optional declared list of the choosers columns that logsums depend on
+
     Returns
     -------
     logsums : pandas.Series
@@ -1014,12 +1118,35 @@ def simple_simulate_logsums(choosers, spec, nest_spec,
 
     assert len(choosers) > 0
 
+    # traced choosers need their own logsums so we don't dedupe if there are trace targets
+    if config.setting('dedupe_logsums', True) and not tracing.has_trace_targets(choosers):
+
+        unique_choosers, group_ids = \
+            dedupe_logsum_choosers(choosers, spec, skims, key_columns)
+
+        if unique_choosers is not None:
+            logger.debug("%s dedupe logsums for %s choosers to %s" %
+                         (trace_label, len(choosers), len(unique_choosers)))
+
+            logsums = _chunked_simple_simulate_logsums(
+                unique_choosers, spec, nest_spec, skims, locals_d, chunk_size, trace_label)
+
+            return pd.Series(logsums.values[group_ids], index=choosers.index)
+
+    return _chunked_simple_simulate_logsums(
+        choosers, spec, nest_spec, skims, locals_d, chunk_size, trace_label)
+
+
+def _chunked_simple_simulate_logsums(choosers, spec, nest_spec,
+                                     skims, locals_d, chunk_size, trace_label):
+
     rows_per_chunk, effective_chunk_size = \
         simple_simulate_logsums_rpc(chunk_size, choosers, spec, nest_spec, trace_label)
 
     result_list = []
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk \
+            in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -16,12 +16,15 @@ from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
+import yaml
 
 from activitysim.core.util import quick_loc_series
 
 
 logger = logging.getLogger(__name__)
 
+SKIM_USAGE_MANIFEST = 'skim_usage.yaml'
+
 
 class OffsetMapper(object):
     """
@@ -115,6 +118,38 @@ class OffsetMapper(object):
         return offsets
 
 
+def decode_skim_values(values, skim_dtype=None, quantization=None):
+    """
+    convert skim values from (compact) storage dtype to skim_dtype, applying any quantization
+
+    Parameters
+    ----------
+    values : numpy array
+        skim values as stored
+    skim_dtype : numpy type or None
+        dtype of returned values (None to leave dtype as stored)
+    quantization : tuple (scale, offset) or None
+        value = stored_value * scale + offset
+
+    Returns
+    -------
+    values : numpy array
+    """
+
+    if skim_dtype is not None and values.dtype != skim_dtype:
+        values = values.astype(skim_dtype)
+
+    if quantization:
+        scale, offset = quantization
+        values = values * values.dtype.type(scale) + values.dtype.type(offset)
+
+    return values
+
+
+def skim_key1(key):
+    return key[0] if isinstance(key, tuple) else key
+
+
 class SkimWrapper(object):
     """
     Container for skim arrays.
@@ -127,12 +162,26 @@ class SkimWrapper(object):
         values to turn them into array indices.
         For example, if zone IDs are 1-based, an offset of -1
         would turn them into 0-based array indices.
+    skim_dtype : numpy type, optional
+        dtype of values returned by get, if data is stored in a different (compact) dtype
+    quantization : tuple (scale, offset), optional
+        scale and offset to apply to stored data values
 
     """
-    def __init__(self, data, offset_mapper=None):
+    def __init__(self, data, offset_mapper=None, skim_dtype=None, quantization=None):
 
         self.data = data
         self.offset_mapper = offset_mapper if offset_mapper is not None else OffsetMapper()
+        self.skim_dtype = skim_dtype
+        self.quantization = quantization
+
+    def decoded_data(self):
+        """
+        Returns
+        -------
+        data : 2D array of skim values (converted from storage dtype and quantization)
+        """
+        return decode_skim_values(self.data, self.skim_dtype, self.quantization)
 
     def get(self, orig, dest):
         """
@@ -159,7 +208,7 @@ class SkimWrapper(object):
         orig = self.offset_mapper.map(orig)
         dest = self.offset_mapper.map(dest)
 
-        result = self.data[orig, dest]
+        result = decode_skim_values(self.data[orig, dest], self.skim_dtype, self.quantization)
 
         return result
 
@@ -171,9 +220,15 @@ class SkimDict(object):
     dictionary - i.e. use brackets to add and get skim objects.
 
     Note that keys are either strings or tuples of two strings (to support stacking of skims.)
+
+    If a skim_loader is supplied, skims are loaded lazily (the first time they are used) by
+    calling skim_loader(key). Lazily loaded skims are kept as separate contiguous 2D arrays in
+    loaded_skims (rather than strided slices of a (zones, zones, n_skims) block in skim_data, which
+    would spread every skim across all the pages of its block) so only skims that are actually
+    used take up memory. skim_data is not used (and may be None) when lazy loading.
     """
 
-    def __init__(self, skim_data, skim_info):
+    def __init__(self, skim_data, skim_info, skim_loader=None):
 
         self.skim_info = skim_info
         self.skim_data = skim_data
@@ -181,10 +236,44 @@ class SkimDict(object):
         self.offset_mapper = OffsetMapper()
         self.usage = set()
 
+        self.skim_loader = skim_loader
+        self.loaded_skims = {}
+
     def touch(self, key):
 
         self.usage.add(key)
 
+    def load(self, key):
+        """
+        Load skim into loaded_skims if lazy loading and not already loaded
+
+        Parameters
+        ----------
+        key : hashable
+             The key (identifier) for this skim object
+        """
+
+        if self.skim_loader is None or key in self.loaded_skims:
+            return
+
+        assert key in self.skim_info['block_offsets'], "SkimDict key %s missing" % (key, )
+
+        self.loaded_skims[key] = np.ascontiguousarray(self.skim_loader(key))
+
+        logger.debug("SkimDict.load loaded skim %s" % (key, ))
+
+    def skim_array(self, key):
+        """
+        Returns 2D array of stored skim values for key (loading it first if lazy loading)
+        """
+
+        if self.skim_loader is not None:
+            self.load(key)
+            return self.loaded_skims[key]
+
+        block, offset = self.skim_info['block_offsets'].get(key)
+        return self.skim_data[block][:, :, offset]
+
     def get(self, key):
         """
         Get an available wrapped skim object (not the lookup)
@@ -200,14 +289,19 @@ class SkimDict(object):
              The skim object
         """
 
-        block, offset = self.skim_info['block_offsets'].get(key)
-        block_data = self.skim_data[block]
-
         self.touch(key)
 
-        data = block_data[:, :, offset]
+        data = self.skim_array(key)
 
-        return SkimWrapper(data, self.offset_mapper)
+        return SkimWrapper(data, self.offset_mapper,
+                           skim_dtype=self.skim_info.get('dtype', None),
+                           quantization=self.quantization(key))
+
+    def quantization(self, key):
+        """
+        (scale, offset) of skim with specified key if quantized, else None
+        """
+        return self.skim_info.get('key1_quantization', {}).get(skim_key1(key), None)
 
     def wrap(self, left_key, right_key):
         """
@@ -380,6 +474,29 @@ class SkimStack(object):
     def touch(self, key):
         self.usage.add(key)
 
+    def load(self, key, key2s=None):
+        """
+        Load (key, key2) skims into skim_dict if skim_dict is lazy loading
+
+        Parameters
+        ----------
+        key : str
+            key1 of stacked skims
+        key2s : iterable of str or None
+            key2 (e.g. time period) subkeys to load, or None to load all subkeys of key
+        """
+
+        if self.skim_dict.skim_loader is None:
+            return
+
+        if key2s is None:
+            key2s = self.skim_dim3[key].keys()
+
+        skim_keys_to_indexes = self.skim_dim3[key]
+        for key2 in key2s:
+            if key2 in skim_keys_to_indexes:
+                self.skim_dict.load((key, key2))
+
     def lookup(self, orig, dest, dim3, key):
 
         orig = self.offset_mapper.map(orig)
@@ -388,17 +505,33 @@ class SkimStack(object):
         assert key in self.key1_blocks, "SkimStack key %s missing" % key
         assert key in self.skim_dim3, "SkimStack key %s missing" % key
 
+        self.touch(key)
+
+        if self.skim_dict.skim_loader is not None:
+            # lazily loaded skims are separate 2D arrays, so look up each subkey in its own skim
+            orig, dest, dim3 = np.asanyarray(orig), np.asanyarray(dest), np.asanyarray(dim3)
+            key2s = pd.unique(dim3)
+            skims = [self.skim_dict.skim_array((key, key2)) for key2 in key2s]
+            values = np.empty(len(orig), dtype=skims[0].dtype if skims else np.float64)
+            for key2, data in zip(key2s, skims):
+                rows = (dim3 == key2)
+                values[rows] = data[orig[rows], dest[rows]]
+
+            return decode_skim_values(values,
+                                      self.skim_dict.skim_info.get('dtype', None),
+                                      self.skim_dict.quantization(key))
+
         block = self.key1_blocks[key]
         stacked_skim_data = self.skim_dict.skim_data[block]
         skim_keys_to_indexes = self.skim_dim3[key]
 
-        self.touch(key)
-
         # skim_indexes = dim3.map(skim_keys_to_indexes).astype('int')
         # this should be faster than map
         skim_indexes = np.vectorize(skim_keys_to_indexes.get)(dim3)
 
-        return stacked_skim_data[orig, dest, skim_indexes]
+        return decode_skim_values(stacked_skim_data[orig, dest, skim_indexes],
+                                  self.skim_dict.skim_info.get('dtype', None),
+                                  self.skim_dict.quantization(key))
 
     def wrap(self, left_key, right_key, skim_key):
         """
@@ -563,3 +696,38 @@ class DataFrameMatrix(object):
             result = pd.Series(result, index=row_ids.index)
 
         return result
+
+
+def write_skim_usage_manifest(file_path, skim_dict_usage, skim_stack_usage):
+    """
+    write skim keys used in this run as yaml (tuple keys are written as lists)
+    """
+
+    def encode_key(skim_key):
+        return list(skim_key) if isinstance(skim_key, tuple) else skim_key
+
+    manifest = {
+        'skim_dict': sorted([encode_key(k) for k in skim_dict_usage], key=str),
+        'skim_stack': sorted(skim_stack_usage),
+    }
+
+    with open(file_path, 'w') as f:
+        yaml.dump(manifest, f, default_flow_style=False)
+
+
+def read_skim_usage_manifest(file_path):
+    """
+    Returns
+    -------
+    skim_dict_keys : list of skim_dict keys (str or tuple)
+    skim_stack_keys : list of skim_stack key1 str
+    """
+
+    with open(file_path) as f:
+        manifest = yaml.safe_load(f)
+
+    skim_dict_keys = [tuple(k) if isinstance(k, list) else k
+                      for k in manifest.get('skim_dict', None) or []]
+    skim_stack_keys = manifest.get('skim_stack', None) or []
+
+    return skim_dict_keys, skim_stack_keys
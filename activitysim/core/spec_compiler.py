@@ -0,0 +1,491 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+from future.standard_library import install_aliases
+install_aliases()  # noqa: E402
+from builtins import object
+
+import ast
+import logging
+
+import numpy as np
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Spec expressions are parsed once per spec and cached as a compiled plan.
+
+Each expression is sorted into one of the following kinds, so that evaluating a chunk of choosers
+only does the work the expression actually needs (rather than re-parsing every expression with
+DataFrame.eval or eval for every chunk.)
+
+    COLUMN    expression is a bare column name (e.g. 'is_worker')
+    NUMEXPR   arithmetic/boolean expression of numeric columns and constants that we can hand
+              directly to numexpr (e.g. '(income_in_thousands>=30) & (income_in_thousands<60)')
+    PANDAS    any other simple expression, evaluated with DataFrame.eval as before
+    PYTHON    '@' python expression, evaluated with eval of a precompiled code object
+    TEMP      '_target@expr' temp assignment (interaction specs only)
+"""
+
+COLUMN = 'column'
+NUMEXPR = 'numexpr'
+PANDAS = 'pandas'
+PYTHON = 'python'
+TEMP = 'temp'
+
+# dict of CompiledSpec keyed by (tuple of expressions, python)
+COMPILED_SPECS = {}
+
+_BIN_OPS = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Pow: '**',
+    ast.Mod: '%',
+    ast.BitAnd: '&',
+    ast.BitOr: '|',
+}
+
+_COMPARE_OPS = {
+    ast.Eq: '==',
+    ast.NotEq: '!=',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+}
+
+# DataFrame.eval treats 'and', 'or' and 'not' as elementwise operators
+_BOOL_OPS = {
+    ast.And: '&',
+    ast.Or: '|',
+}
+
+_UNARY_OPS = {
+    ast.USub: '-',
+    ast.Not: '~',
+    ast.Invert: '~',
+}
+
+_CONSTANT_NODES = tuple(getattr(ast, n) for n in ['Constant', 'Num', 'NameConstant']
+                        if hasattr(ast, n))
+
+
+_STRING_NODES = tuple(getattr(ast, n) for n in ['Constant', 'Str'] if hasattr(ast, n))
+
+
+def _constant_value(node):
+
+    for attr in ['value', 'n']:
+        if hasattr(node, attr):
+            return getattr(node, attr)
+    raise RuntimeError("unexpected constant node %s" % type(node))
+
+
+def numexpr_source(node, names):
+    """
+    Return numexpr source string for ast node or None if node can't be evaluated by numexpr
+
+    Only arithmetic, comparison and boolean operations on names and numeric constants are
+    translated. Every sub-expression is parenthesized so we don't need to worry about operator
+    precedence. Names referenced by the expression are added to names.
+
+    Parameters
+    ----------
+    node : ast.AST
+    names : set
+        names referenced by expression (updated in place)
+
+    Returns
+    -------
+    source : str or None
+    """
+
+    if isinstance(node, ast.Name):
+        if node.id in ['True', 'False']:
+            return node.id
+        names.add(node.id)
+        return node.id
+
+    if isinstance(node, _CONSTANT_NODES):
+        value = _constant_value(node)
+        if isinstance(value, (bool, int, float)):
+            return repr(value)
+        return None
+
+    if isinstance(node, ast.BinOp):
+        op = _BIN_OPS.get(type(node.op))
+        left = numexpr_source(node.left, names)
+        right = numexpr_source(node.right, names)
+        if op is None or left is None or right is None:
+            return None
+        return '(%s %s %s)' % (left, op, right)
+
+    if isinstance(node, ast.Compare):
+        # numexpr doesn't do chained comparisons (e.g. 0 < x < 5)
+        if len(node.ops) != 1:
+            return None
+        op = _COMPARE_OPS.get(type(node.ops[0]))
+        left = numexpr_source(node.left, names)
+        right = numexpr_source(node.comparators[0], names)
+        if op is None or left is None or right is None:
+            return None
+        return '(%s %s %s)' % (left, op, right)
+
+    if isinstance(node, ast.BoolOp):
+        op = _BOOL_OPS.get(type(node.op))
+        values = [numexpr_source(v, names) for v in node.values]
+        if op is None or None in values:
+            return None
+        return '(%s)' % (' %s ' % op).join(values)
+
+    if isinstance(node, ast.UnaryOp):
+        op = _UNARY_OPS.get(type(node.op))
+        operand = numexpr_source(node.operand, names)
+        if op is None or operand is None:
+            return None
+        return '(%s%s)' % (op, operand)
+
+    return None
+
+
+def _is_string_constant(node):
+
+    # python < 3.9 wraps subscript slice in ast.Index
+    if hasattr(ast, 'Index') and isinstance(node, ast.Index):
+        node = node.value
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return all(_is_string_constant(n) for n in node.elts)
+
+    return isinstance(node, _STRING_NODES) and \
+        isinstance(getattr(node, 'value', getattr(node, 's', None)), str)
+
+
+def _local_string_name(node, locals_dict):
+
+    # python < 3.9 wraps subscript slice in ast.Index
+    if hasattr(ast, 'Index') and isinstance(node, ast.Index):
+        node = node.value
+
+    if locals_dict and isinstance(node, ast.Name) and \
+            isinstance(locals_dict.get(node.id), str):
+        return locals_dict[node.id]
+
+    return None
+
+
+def expression_names(source, locals_dict=None):
+    """
+    Return set of identifiers, attribute names and string constants in python expression source,
+    or None if the expression can't be parsed or uses df other than as df.<col> or df['<col>']
+
+    If locals_dict is supplied, df[<name>] also counts as column access if <name> is a locals_dict
+    string (e.g. df[ORIGIN] with ORIGIN column name constant) and the string is added to names.
+    """
+
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except (SyntaxError, ValueError, TypeError, AttributeError):
+        return None
+
+    names = set()
+    df_refs = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+            df_refs += (node.id == 'df')
+        elif isinstance(node, ast.Attribute):
+            names.add(node.attr)
+            df_refs -= (isinstance(node.value, ast.Name) and node.value.id == 'df')
+        elif isinstance(node, ast.Subscript):
+            if not (isinstance(node.value, ast.Name) and node.value.id == 'df'):
+                continue
+            # column name could be in a variable, so df[<col>] only counts if <col> is a constant
+            # (or names a string in locals_dict)
+            local_name = _local_string_name(node.slice, locals_dict)
+            if local_name is not None:
+                names.add(local_name)
+            df_refs -= (_is_string_constant(node.slice) or local_name is not None)
+        elif isinstance(node, _STRING_NODES):
+            value = getattr(node, 'value', getattr(node, 's', None))
+            if isinstance(value, str):
+                names.add(value)
+
+    # every use of df must be column access
+    if df_refs:
+        return None
+
+    return names
+
+
+def compile_python(source):
+    """
+    compile python expression source to code object for eval
+
+    returns None if source won't compile, so that caller can eval source string as before
+    and get the usual error and logging when the expression is actually evaluated.
+    """
+    try:
+        return compile(source.strip(), '<expression>', 'eval')
+    except (SyntaxError, ValueError, TypeError, AttributeError):
+        return None
+
+
+class CompiledExpression(object):
+    """
+    A single spec expression, classified and precompiled for repeated evaluation.
+
+    Parameters
+    ----------
+    expr : str
+        spec expression
+    python : bool
+        if True expr is a python expression without a leading '@' (as in assignment specs)
+    """
+
+    def __init__(self, expr, python=False):
+
+        self.expr = expr
+        self.target = None
+        self.column = None
+        self.source = None
+        self.code = None
+        self.names = set()
+
+        if python:
+            self.kind = PYTHON
+            self.source = expr
+            self.code = compile_python(expr)
+        elif expr.startswith('_') and '@' in expr:
+            # - allow temps of form _od_DIST@od_skim['DIST']
+            self.kind = TEMP
+            self.target = expr[:expr.index('@')]
+            self.source = expr[expr.index('@') + 1:]
+            self.code = compile_python(self.source)
+        elif expr.startswith('@'):
+            self.kind = PYTHON
+            self.source = expr[1:]
+            self.code = compile_python(self.source)
+        else:
+            self.kind = PANDAS
+            self.source = expr
+            self._classify_simple_expression()
+
+    def _classify_simple_expression(self):
+
+        try:
+            tree = ast.parse(self.expr.strip(), mode='eval')
+        except SyntaxError:
+            # leave it for DataFrame.eval to complain about
+            return
+
+        node = tree.body
+
+        if isinstance(node, ast.Name):
+            self.kind = COLUMN
+            self.column = node.id
+            self.names.add(node.id)
+            return
+
+        names = set()
+        source = numexpr_source(node, names)
+        if source is not None and ne is not None:
+            self.kind = NUMEXPR
+            self.source = source
+            self.names = names
+
+    def _numexpr_locals(self, df):
+
+        local_dict = {}
+        for name in self.names:
+            if name not in df.columns:
+                return None
+            values = df[name].values
+            # categoricals, strings, uint64, etc. are left to pandas
+            if not isinstance(values, np.ndarray) or values.dtype.kind not in 'biuf' or \
+                    (values.dtype.kind == 'u' and values.dtype.itemsize > 4):
+                return None
+            local_dict[name] = values
+        return local_dict
+
+    def evaluate(self, df, globals_dict=None, locals_dict=None):
+        """
+        Evaluate expression in the context of df (and locals_dict for python expressions)
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        globals_dict : dict
+        locals_dict : dict
+            environment for evaluation of python expressions
+
+        Returns
+        -------
+        values : pandas.Series, numpy.ndarray or scalar
+            whatever the expression evaluates to
+        """
+
+        if self.kind in [PYTHON, TEMP]:
+            globals_dict = {} if globals_dict is None else globals_dict
+            if self.code is not None:
+                return eval(self.code, globals_dict, locals_dict)
+            return eval(self.source, globals_dict, locals_dict)
+
+        if self.kind == COLUMN and self.column in df.columns:
+            return df[self.column]
+
+        if self.kind == NUMEXPR:
+            local_dict = self._numexpr_locals(df)
+            if local_dict is not None:
+                try:
+                    return ne.evaluate(self.source, local_dict=local_dict, global_dict={})
+                except Exception as err:
+                    # numexpr is picky about types - don't try again, let pandas deal with it
+                    logger.debug("numexpr failed (%s) for expression: %s" % (err, self.expr))
+                    self.kind = PANDAS
+
+        return df.eval(self.expr)
+
+    def evaluate_into(self, df, out, globals_dict=None, locals_dict=None):
+        """
+        Like evaluate, but write the values into out (e.g. a row of an expression_values array)
+
+        Numeric column references are copied straight into out and NUMEXPR expressions are
+        evaluated by numexpr directly into out, without an intermediate result array. Anything
+        else (including constant expressions) is evaluated and copied.
+        """
+
+        if self.kind == COLUMN and self.column in df.columns:
+            values = df[self.column].values
+            if isinstance(values, np.ndarray) and values.dtype.kind in 'biuf':
+                np.copyto(out, values, casting='unsafe')
+                return
+
+        if self.kind == NUMEXPR:
+            local_dict = self._numexpr_locals(df)
+            if local_dict:
+                try:
+                    ne.evaluate(self.source, local_dict=local_dict, global_dict={},
+                                out=out, casting='unsafe')
+                    return
+                except Exception as err:
+                    # numexpr is picky about types - don't try again, let pandas deal with it
+                    logger.debug("numexpr failed (%s) for expression: %s" % (err, self.expr))
+                    self.kind = PANDAS
+
+        out[...] = self.evaluate(df, globals_dict, locals_dict)
+
+
+class CompiledSpec(object):
+    """
+    Compiled plan for a list of spec expressions.
+
+    Use compile_spec to get a (cached) instance rather than instantiating directly.
+    """
+
+    def __init__(self, exprs, python=False):
+
+        self.expressions = [CompiledExpression(expr, python=python) for expr in exprs]
+
+    def __len__(self):
+        return len(self.expressions)
+
+    def __iter__(self):
+        return iter(self.expressions)
+
+    def evaluate_into(self, df, out, globals_dict=None, locals_dict=None):
+        """
+        Evaluate every expression in the context of df, writing the values of expression i
+        into out[i]
+
+        Numeric column references are copied and NUMEXPR expressions are evaluated by numexpr
+        directly into their row of out, so only PANDAS and PYTHON expressions allocate (and copy)
+        an intermediate result.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        out : numpy.ndarray
+            array of shape (len(expressions), len(df.index))
+        globals_dict : dict
+        locals_dict : dict
+            environment for evaluation of python expressions
+        """
+
+        assert out.shape == (len(self.expressions), len(df.index))
+
+        for i, e in enumerate(self.expressions):
+            try:
+                e.evaluate_into(df, out[i], globals_dict, locals_dict)
+            except Exception as err:
+                logger.exception("Variable evaluation failed for: %s" % str(e.expr))
+                raise err
+
+    def column_names(self):
+        """
+        Returns set of names referenced by COLUMN and NUMEXPR expressions
+        """
+        names = set()
+        for e in self.expressions:
+            names.update(e.names)
+        return names
+
+    def referenced_names(self, locals_dict=None):
+        """
+        Returns set of all names that expressions might use to reference df columns
+
+        This is deliberately conservative: it includes every identifier, attribute name and
+        string constant in every expression. Returns None if that can't be determined (e.g.
+        an expression can't be parsed, or passes df itself to a function that might access
+        any column.) Column names held in locals_dict string constants (as in df[ORIGIN])
+        are resolved if locals_dict is supplied.
+        """
+        names = set()
+        for e in self.expressions:
+            expr_names = expression_names(e.source, locals_dict)
+            if expr_names is None:
+                return None
+            names.update(expr_names)
+        return names
+
+    def kind_counts(self):
+        counts = {}
+        for e in self.expressions:
+            counts[e.kind] = counts.get(e.kind, 0) + 1
+        return counts
+
+
+def compile_spec(exprs, python=False):
+    """
+    Return compiled plan for spec expressions, parsing and caching it the first time it is seen.
+
+    Parameters
+    ----------
+    exprs : sequence of str
+        typically spec.index
+    python : bool
+        if True, all exprs are python expressions without leading '@' (e.g. assignment specs)
+
+    Returns
+    -------
+    compiled_spec : CompiledSpec
+    """
+
+    key = (tuple(exprs), python)
+
+    compiled_spec = COMPILED_SPECS.get(key)
+    if compiled_spec is None:
+        compiled_spec = CompiledSpec(key[0], python=python)
+        COMPILED_SPECS[key] = compiled_spec
+        logger.debug("compile_spec compiled %s expressions %s" %
+                     (len(compiled_spec), compiled_spec.kind_counts()))
+
+    return compiled_spec
@@ -14,6 +14,7 @@ from collections import OrderedDict
 from activitysim.core import pipeline
 from activitysim.core import inject
 from activitysim.core import config
+from activitysim.core import skim
 
 from activitysim.core.config import setting
 
@@ -24,7 +25,8 @@ def track_skim_usage(output_dir):
     """
     write statistics on skim usage (diagnostic to detect loading of un-needed skims)
 
-    FIXME - have not yet implemented a facility to avoid loading of unused skims
+    Also writes the skim usage manifest (skim_usage.yaml) which can be used to preload
+    the skims used by this run when skims are lazy loaded (see preload_skims setting)
 
     Parameters
     ----------
@@ -75,6 +77,10 @@ def track_skim_usage(output_dir):
             for key in unused:
                 print(key, file=output_file)
 
+    skim.write_skim_usage_manifest(config.output_file_path(skim.SKIM_USAGE_MANIFEST),
+                                   skim_dict.usage,
+                                   skim_stack.usage if skim_stack is not None else set())
+
 
 def write_data_dictionary(output_dir):
     """
@@ -0,0 +1,56 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from builtins import range
+
+import multiprocessing
+
+import numpy as np
+import numpy.testing as npt
+
+from .. import allreduce
+
+NUM_PROCESSES = 3
+NUM_ROUNDS = 4
+SHAPE = (5, 2)
+
+
+def local_data(process_id, round_id):
+    return np.full(SHAPE, (process_id + 1) * (round_id + 1), dtype=np.int64)
+
+
+def sum_rounds(shared, process_id, queue):
+    totals = [shared.sum(local_data(process_id, r), NUM_PROCESSES) for r in range(NUM_ROUNDS)]
+    queue.put((process_id, totals))
+
+
+def test_allreduce():
+
+    shared = allreduce.AllReduce(SHAPE, np.int64)
+    queue = multiprocessing.Queue()
+
+    procs = [multiprocessing.Process(target=sum_rounds, args=(shared, i, queue))
+             for i in range(NUM_PROCESSES)]
+    for p in procs:
+        p.start()
+
+    results = [queue.get(timeout=30) for _ in procs]
+
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+    for process_id, totals in results:
+        assert len(totals) == NUM_ROUNDS
+        for r, total in enumerate(totals):
+            expected = sum(local_data(i, r) for i in range(NUM_PROCESSES))
+            npt.assert_array_equal(total, expected)
+
+
+def test_allreduce_single_process():
+
+    shared = allreduce.AllReduce(SHAPE, np.float64)
+
+    data = np.arange(10, dtype=np.float64).reshape(SHAPE)
+    npt.assert_array_equal(shared.sum(data, 1), data)
+    npt.assert_array_equal(shared.sum(data * 2, 1), data * 2)
@@ -0,0 +1,103 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .. import chunk
+from .. import inject
+
+
+def setup_function():
+
+    output_dir = os.path.join(os.path.dirname(__file__), 'output')
+    inject.add_injectable("output_dir", output_dir)
+    inject.add_injectable('settings', {'adaptive_chunking': True})
+
+    cache_path = chunk.chunk_cache_path()
+    if os.path.isfile(cache_path):
+        os.unlink(cache_path)
+
+
+def teardown_function(func):
+
+    cache_path = chunk.chunk_cache_path()
+    if os.path.isfile(cache_path):
+        os.unlink(cache_path)
+
+    chunk.CALIBRATED_ROW_BYTES.clear()
+    del chunk.CALIBRATION_LOADED[:]
+    chunk.ADAPTIVE_CHUNK_SIZE.clear()
+
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def run_chunks(choosers, chunk_size, row_size, trace_label):
+
+    rows_per_chunk, effective_chunk_size = \
+        chunk.rows_per_chunk(chunk_size, row_size, len(choosers), trace_label)
+
+    chunk_lengths = []
+    for i, num_chunks, chooser_chunk \
+            in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label):
+
+        chunk_trace_label = '%s.chunk_%s' % (trace_label, i)
+        chunk.log_open(chunk_trace_label, chunk_size, effective_chunk_size)
+
+        # actually uses 1000 float64 per chooser row (8000 bytes)
+        utilities = np.zeros((len(chooser_chunk), 1000))
+        chunk.log_df(chunk_trace_label, 'utilities', utilities)
+        chunk.log_df(chunk_trace_label, 'utilities', None)
+        del utilities
+
+        chunk.log_close(chunk_trace_label)
+
+        chunk_lengths.append(len(chooser_chunk))
+
+    return rows_per_chunk, chunk_lengths
+
+
+def test_adaptive_chunking():
+
+    choosers = pd.DataFrame({'income': np.arange(100)})
+
+    # row_size estimate of 100 elements (800 bytes) is much too low
+    rows_per_chunk, chunk_lengths = run_chunks(choosers, 40000, 100, 'test_adaptive')
+
+    assert rows_per_chunk == 50
+    assert chunk_lengths[0] == 50
+    assert sum(chunk_lengths) == 100
+    # remaining chunks resized based on measured bytes per row
+    assert max(chunk_lengths[1:]) <= 5
+
+    cache = pd.read_csv(chunk.chunk_cache_path(), index_col='trace_label')
+    assert cache.bytes_per_row['test_adaptive'] >= 8000
+
+    # - next run starts with calibrated rows_per_chunk from cache file
+    chunk.CALIBRATED_ROW_BYTES.clear()
+    del chunk.CALIBRATION_LOADED[:]
+
+    rows_per_chunk, chunk_lengths = run_chunks(choosers, 40000, 100, 'test_adaptive')
+    assert rows_per_chunk <= 5
+
+
+def test_adaptive_chunk_size_bytes(caplog):
+
+    caplog.set_level('DEBUG', logger='activitysim.core.chunk')
+
+    # 100 element row_size estimate is 800 bytes, so 50 rows per 40000 byte chunk
+    rows_per_chunk, effective_chunk_size = chunk.rows_per_chunk(40000, 100, 100, 'test_bytes')
+    assert rows_per_chunk == 50
+    assert effective_chunk_size == 40000
+
+    # first chunk actually uses 400000 bytes (in 50000 elements)
+    caplog.clear()
+    run_chunks(pd.DataFrame({'income': np.arange(100)}), 40000, 100, 'test_bytes')
+    warnings = [r.getMessage() for r in caplog.records if '#warning' in r.getMessage()]
+    assert '#warning total_bytes (400,000) > effective_chunk_size (40,000)' in warnings[0]
+    assert '#warning total_bytes (400,000) > chunk_size (40,000)' in warnings[1]
@@ -0,0 +1,85 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from .. import chunk
+from .. import inject
+from .. import pipeline
+from .. import interaction_sample
+
+
+def teardown_function(func):
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+    pipeline._PIPELINE.init_state()
+
+
+@pytest.fixture
+def choosers():
+    return pd.DataFrame({
+        'TAZ': [1, 2, 1, 3, 2, 1],
+        'income': [10, 20, 30, 40, 50, 60]},
+        index=pd.Index(np.arange(10, 16), name='person_id'))
+
+
+@pytest.fixture
+def alternatives():
+    alternatives = pd.DataFrame({
+        'size': [1.0, 5.0, 2.0, 0.5]},
+        index=pd.Index([1, 2, 3, 4], name='TAZ'))
+    alternatives['TAZ'] = alternatives.index
+    return alternatives
+
+
+@pytest.fixture
+def spec():
+    return pd.DataFrame({
+        'coefficient': [1.0, -0.3]},
+        index=["@np.log(df['size'])", '@(df.TAZ_chooser - df.TAZ).abs()'])
+
+
+def test_sample_group_columns(choosers, alternatives, spec):
+
+    assert interaction_sample.sample_group_columns(spec, choosers, alternatives, None) == ['TAZ']
+
+    spec = pd.DataFrame({'coefficient': [1.0]}, index=['@df.income * df.size'])
+    assert interaction_sample.sample_group_columns(spec, choosers, alternatives, None) == \
+        ['income']
+
+    spec = pd.DataFrame({'coefficient': [1.0]}, index=['@size_func(df)'])
+    assert interaction_sample.sample_group_columns(spec, choosers, alternatives, None) is None
+
+
+def test_grouped_sample_choices(choosers, alternatives, spec):
+
+    inject.add_injectable('settings', {})
+
+    rng = pipeline.get_rn_generator()
+    rng.add_channel('persons', choosers)
+
+    chunk.log_open('test_grouped_sample_choices', 0, 0)
+
+    results = []
+    for grouped in [False, True]:
+        rng.begin_step('test_grouped_sample_choices')
+        if grouped:
+            choices_df = interaction_sample._grouped_sample_choices(
+                choosers, alternatives, spec, 5, 'dest_TAZ', False,
+                ['TAZ'], None, {'np': np}, 'test')
+        else:
+            choices_df = interaction_sample._sample_choices(
+                choosers, alternatives, spec, 5, 'dest_TAZ', False,
+                None, {'np': np}, False, 'test')
+        rng.end_step('test_grouped_sample_choices')
+        results.append(choices_df)
+
+    chunk.log_close('test_grouped_sample_choices')
+
+    # same rands and same probs, so same choices
+    pdt.assert_frame_equal(results[0], results[1])
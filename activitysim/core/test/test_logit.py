@@ -149,3 +149,19 @@ def test_interaction_dataset_sampled(
 
     interacted, expected = interacted.align(expected, axis=1)
     pdt.assert_frame_equal(interacted, expected)
+
+
+def test_interaction_dataset_columns(interaction_choosers, interaction_alts):
+
+    choosers = interaction_choosers.assign(prop=[1, 2, 3, 4], unused=0)
+    alts = interaction_alts.assign(unused_alt=0)
+
+    interacted = logit.interaction_dataset(choosers, alts, columns={'prop', 'prop_chooser'})
+
+    assert list(interacted.columns) == ['prop', 'prop_chooser']
+    pdt.assert_series_equal(interacted.prop_chooser,
+                            pd.Series(np.repeat([1, 2, 3, 4], 4), index=interacted.index),
+                            check_names=False)
+
+    expected = logit.interaction_dataset(choosers, alts)[['prop', 'prop_chooser']]
+    pdt.assert_frame_equal(interacted, expected)
@@ -11,6 +11,7 @@ import logging
 import pytest
 
 import tables
+import pandas.util.testing as pdt
 
 from activitysim.core import tracing
 from activitysim.core import pipeline
@@ -85,6 +86,11 @@ def test_pipeline_run():
     # get table from
     pipeline.get_table("table1", checkpoint_name="step3")
 
+    # get some columns of table, both from store and current version
+    table2 = pipeline.get_table("table2", checkpoint_name="step2", columns=['c'])
+    assert list(table2.columns) == ['c']
+    assert list(pipeline.get_table("table2", columns=['c2']).columns) == ['c2']
+
     # try to get a table from a step before it was checkpointed
     with pytest.raises(RuntimeError) as excinfo:
         pipeline.get_table("table2", checkpoint_name="step1")
@@ -143,6 +149,118 @@ def test_pipeline_checkpoint_drop():
     pipeline.close_pipeline()
     close_handlers()
 
+
+def test_parquet_checkpoint_store():
+
+    pytest.importorskip('pyarrow')
+
+    inject.add_injectable('settings', {'checkpoint_format': 'parquet'})
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    _MODELS = [
+        'step1',
+        'step2',
+        'step_add_col.table_name=table2;column_name=c2'
+    ]
+
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    table2 = pipeline.get_table("table2")
+    assert list(pipeline.get_table("table2", checkpoint_name="step2", columns=['c']).columns) \
+        == ['c']
+    pipeline.close_pipeline()
+
+    assert pipeline.get_checkpoints().checkpoint_name.tolist()[:2] == ['step1', 'step2']
+
+    # resume from parquet store
+    pipeline.run(models=_MODELS, resume_after='_')
+    pdt.assert_frame_equal(pipeline.get_table("table2"), table2)
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
+def test_incremental_checkpoints():
+
+    inject.add_injectable('settings', {'incremental_checkpoints': True})
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step3', steps.step3)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    _MODELS = [
+        'step1',
+        'step2',
+        'step_add_col.table_name=table2;column_name=c2',
+        'step3',
+    ]
+
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    checkpoints = pipeline.get_checkpoints()
+    add_col_checkpoint = checkpoints.checkpoint_name.iloc[2]
+
+    # unchanged tables aren't rewritten
+    assert checkpoints.table1.tolist() == ['step1'] * 4
+    assert checkpoints.table2.tolist()[1:] == ['step2', add_col_checkpoint, add_col_checkpoint]
+
+    # only the new column is written
+    store = pipeline.get_pipeline_store()
+    assert list(store.read(pipeline.pipeline_table_key('table2', add_col_checkpoint)).columns) \
+        == ['c2']
+
+    table2 = pipeline.get_table("table2")
+    assert list(table2.columns) == ['c', 'c2']
+    pdt.assert_frame_equal(pipeline.read_df('table2', add_col_checkpoint), table2)
+    pdt.assert_frame_equal(pipeline.read_df('table2', add_col_checkpoint, columns=['c']),
+                           table2[['c']])
+    pipeline.close_pipeline()
+
+    # resume from incremental checkpoint
+    pipeline.run(models=_MODELS, resume_after='_')
+    pdt.assert_frame_equal(pipeline.get_table("table2"), table2)
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
+def test_open_pipeline_with_tables():
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    pipeline.run(models=['step1', 'step2'], resume_after=None)
+    checkpoints = pipeline.get_checkpoints()
+    tables = {t: pipeline.get_table(t) for t in ['table1', 'table2']}
+    pipeline.close_pipeline()
+
+    # start from tables in memory (e.g. apportioned to a sub-process)
+    tables['table1'] = tables['table1'] * 10
+    pipeline.open_pipeline_with_tables(checkpoints, tables)
+    assert pipeline.last_checkpoint() == 'step2'
+    pdt.assert_frame_equal(pipeline.get_table('table1'), tables['table1'])
+
+    pipeline.run_model('step_add_col.table_name=table2;column_name=c2')
+    add_col_checkpoint = pipeline.last_checkpoint()
+    assert list(pipeline.get_table('table2').columns) == ['c', 'c2']
+
+    # only the changed table (and checkpoints) were written to the store
+    store = pipeline.get_pipeline_store()
+    assert pipeline.pipeline_table_key('table2', add_col_checkpoint) in store
+    assert pipeline.pipeline_table_key('table1', 'step1') not in store
+    pipeline.close_pipeline()
+
+    assert pipeline.get_checkpoints().checkpoint_name.tolist() == \
+        ['step1', 'step2', add_col_checkpoint]
+
+    close_handlers()
+
+
 # if __name__ == "__main__":
 #
 #     print "\n\ntest_pipeline_run"
@@ -112,3 +112,106 @@ def test_channel():
     npt.assert_almost_equal(np.asanyarray(rands).flatten(), test1_expected_rands2)
 
     rng.end_step('test_step')
+
+
+def test_counter_channel():
+
+    rng = random.Random()
+    rng.set_channel_type('counter')
+
+    persons = pd.DataFrame({
+        "household_id": [1, 1, 2, 2, 2],
+    }, index=[1, 2, 3, 4, 5])
+    persons.index.name = 'person_id'
+
+    rng.begin_step('test_step')
+    rng.add_channel('persons', persons)
+
+    rands = rng.random_for_df(persons)
+    assert rands.shape == (5, 1)
+    assert ((rands >= 0) & (rands < 1)).all()
+
+    # second call should return something different
+    rands2 = rng.random_for_df(persons, n=2)
+    assert rands2.shape == (5, 2)
+    assert not np.isin(rands2, rands).any()
+
+    choices = rng.choice_for_df(persons, [1, 2, 3, 4, 5, 6], 4, replace=False)
+    assert choices.shape == (20, )
+    # sampled without replacement
+    for row_choices in choices.reshape(5, 4):
+        assert len(set(row_choices)) == 4
+
+    lognormals = rng.lognormal_for_df(persons, mu=0, sigma=1)
+    assert lognormals.shape == (5, )
+    assert (lognormals > 0).all()
+
+    rng.end_step('test_step')
+
+    # rands for each row don't depend on which other rows (or how many) are in the df
+    rng.begin_step('test_step')
+
+    for i in range(len(persons)):
+        npt.assert_almost_equal(rng.random_for_df(persons.iloc[[i]]), rands[[i]])
+
+    chunk_rands2 = np.concatenate([rng.random_for_df(persons.iloc[:3], n=2),
+                                   rng.random_for_df(persons.iloc[3:], n=2)])
+    npt.assert_almost_equal(chunk_rands2, rands2)
+
+    npt.assert_almost_equal(rng.choice_for_df(persons.iloc[::-1], [1, 2, 3, 4, 5, 6], 4,
+                                              replace=False).reshape(5, 4)[::-1],
+                            choices.reshape(5, 4))
+
+    rng.end_step('test_step')
+
+    # can't change channel type once channels have been added
+    with pytest.raises(RuntimeError) as excinfo:
+        rng.set_channel_type('simple')
+    assert "set_channel_type before the first step" in str(excinfo.value)
+
+
+def test_counter_channel_negative_seed():
+
+    persons = pd.DataFrame(index=pd.Index([1, 2, 3], name='person_id'))
+
+    rands = {}
+    for channel_class in [random.SimpleChannel, random.CounterChannel]:
+        for base_seed in [0, -1]:
+            channel = channel_class('persons', base_seed, persons, 'test_step')
+            rands[channel_class, base_seed] = channel.random_for_df(persons, 'test_step')
+
+    # counter channels accept negative base seeds, as simple channels do
+    negative_rands = rands[random.CounterChannel, -1]
+    assert ((negative_rands >= 0) & (negative_rands < 1)).all()
+    assert not np.isin(negative_rands, rands[random.CounterChannel, 0]).any()
+
+
+@pytest.mark.parametrize('channel_type', ['simple', 'counter'])
+def test_row_offsets(channel_type):
+
+    persons = pd.DataFrame({
+        "household_id": [1, 1, 2, 2, 2],
+    }, index=[1, 2, 3, 4, 5])
+    persons.index.name = 'person_id'
+
+    rng = random.Random()
+    rng.set_channel_type(channel_type)
+    rng.begin_step('test_step')
+    rng.add_channel('persons', persons)
+
+    rng.random_for_df(persons.iloc[:2], n=3)
+    npt.assert_array_equal(rng.get_row_offsets(persons), [3, 3, 0, 0, 0])
+
+    offsets = rng.get_row_offsets(persons)
+    rands = rng.random_for_df(persons)
+
+    # restoring offsets rewinds the streams
+    rng.set_row_offsets(persons, offsets)
+    npt.assert_almost_equal(rng.random_for_df(persons), rands)
+
+    # offsets are set in df order
+    rng.set_row_offsets(persons.iloc[::-1], [1, 0, 0, 3, 3])
+    npt.assert_array_equal(rng.get_row_offsets(persons), [3, 3, 0, 0, 1])
+    npt.assert_almost_equal(rng.random_for_df(persons)[:4], rands[:4])
+
+    rng.end_step('test_step')
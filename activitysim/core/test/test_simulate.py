@@ -91,3 +91,29 @@ def test_simple_simulate_chunked(data, spec):
     choices = simulate.simple_simulate(choosers=data, spec=spec, nest_spec=None, chunk_size=2)
     expected = pd.Series([1, 1, 1], index=data.index)
     pdt.assert_series_equal(choices, expected)
+
+
+def test_simple_simulate_logsums_deduped(data, spec):
+
+    choosers = pd.concat([data, data, data.iloc[[1]]], ignore_index=True)
+    choosers['unused'] = np.arange(len(choosers))
+
+    assert simulate.logsum_key_columns(choosers, spec, None) == ['thing1', 'thing2']
+
+    unique_choosers, group_ids = simulate.dedupe_logsum_choosers(choosers, spec, None)
+    assert len(unique_choosers) == len(data)
+    npt.assert_array_equal(group_ids, [0, 1, 2, 0, 1, 2, 1])
+
+    inject.add_injectable("settings", {'dedupe_logsums': False})
+    expected = simulate.simple_simulate_logsums(choosers, spec, nest_spec=None)
+
+    inject.add_injectable("settings", {})
+    logsums = simulate.simple_simulate_logsums(choosers, spec, nest_spec=None)
+
+    pdt.assert_series_equal(logsums, expected)
+
+    # null key values are grouped rather than dropped
+    choosers.loc[[0, 3], 'thing1'] = np.nan
+    unique_choosers, group_ids = simulate.dedupe_logsum_choosers(choosers, spec, None)
+    assert len(unique_choosers) == len(data)
+    npt.assert_array_equal(group_ids, [0, 1, 2, 0, 1, 2, 1])
@@ -144,3 +144,60 @@ def test_3dskims(data):
         ),
         check_dtype=False
     )
+
+
+def test_lazy_skims(data, tmpdir):
+
+    skim_info = {
+        'block_offsets': {('SOV', 'AM'): (0, 0), ('SOV', 'PM'): (0, 1), 'DIST': (0, 2)},
+        'key1_block_offsets': {'SOV': (0, 0), 'DIST': (0, 2)}
+    }
+    skims = {('SOV', 'AM'): data, ('SOV', 'PM'): data*10, 'DIST': data*100}
+
+    loaded = []
+
+    def skim_loader(key):
+        loaded.append(key)
+        return skims[key]
+
+    # lazy skim_dict has no skim blocks
+    skim_dict = skim.SkimDict(None, skim_info, skim_loader=skim_loader)
+    stack = skim.SkimStack(skim_dict)
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4],
+        "taz_r": [2, 3, 7],
+        "period": ["AM", "AM", "AM"]
+    })
+
+    skims3d = stack.wrap(left_key="taz_l", right_key="taz_r", skim_key="period")
+    skims3d.set_df(df)
+
+    # only the AM period is loaded
+    npt.assert_array_equal(skims3d["SOV"], [12, 93, 47])
+    assert loaded == [('SOV', 'AM')]
+
+    skims2d = skim_dict.wrap("taz_l", "taz_r")
+    skims2d.set_df(df)
+
+    npt.assert_array_equal(skims2d["DIST"], [1200, 9300, 4700])
+    npt.assert_array_equal(skims2d["DIST"], [1200, 9300, 4700])
+    assert loaded == [('SOV', 'AM'), 'DIST']
+
+    # loaded skims are kept as separate contiguous arrays
+    assert set(skim_dict.loaded_skims.keys()) == {('SOV', 'AM'), 'DIST'}
+    assert all(a.flags['C_CONTIGUOUS'] for a in skim_dict.loaded_skims.values())
+
+    # lookups mixing periods read each period from its own skim
+    df.period = ["PM", "AM", "PM"]
+    skims3d.set_df(df)
+    npt.assert_array_equal(skims3d["SOV"], [120, 93, 470])
+    assert loaded == [('SOV', 'AM'), 'DIST', ('SOV', 'PM')]
+
+    # usage manifest round trip
+    file_path = str(tmpdir.join(skim.SKIM_USAGE_MANIFEST))
+    skim.write_skim_usage_manifest(file_path, skim_dict.usage, stack.usage)
+    skim_dict_keys, skim_stack_keys = skim.read_skim_usage_manifest(file_path)
+
+    assert skim_dict_keys == ['DIST']
+    assert skim_stack_keys == ['SOV']
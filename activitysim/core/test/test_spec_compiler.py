@@ -0,0 +1,142 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+from __future__ import (absolute_import, division, print_function, )
+
+import numpy as np
+import pandas as pd
+import numpy.testing as npt
+
+from .. import spec_compiler
+
+
+def test_classify():
+
+    exprs = [
+        'is_worker',
+        '(income >= 30) & (income < 60)',
+        '(duration >=1) and (duration <= 4)',
+        "tour_type == 'work'",
+        '1 < duration < 4',
+        '@df.income.clip(upper=50)',
+        "_DIST@skims['DIST']",
+    ]
+
+    compiled_spec = spec_compiler.compile_spec(exprs)
+
+    kinds = [e.kind for e in compiled_spec]
+
+    assert kinds == [
+        spec_compiler.COLUMN,
+        spec_compiler.NUMEXPR,
+        spec_compiler.NUMEXPR,
+        spec_compiler.PANDAS,
+        spec_compiler.PANDAS,
+        spec_compiler.PYTHON,
+        spec_compiler.TEMP,
+    ]
+
+    assert compiled_spec.expressions[-1].target == '_DIST'
+    assert compiled_spec.column_names() == set(['is_worker', 'income', 'duration'])
+
+    # plan is cached
+    assert spec_compiler.compile_spec(exprs) is compiled_spec
+
+
+def test_evaluate():
+
+    df = pd.DataFrame({
+        'is_worker': [True, False, True, False],
+        'income': [10, 40, 50, 70],
+        'duration': [1, 3, 5, 2],
+        'tour_type': ['work', 'shop', 'work', 'eat'],
+    })
+
+    exprs = [
+        'is_worker',
+        '(income >= 30) & (income < 60)',
+        '(duration >=1) and (duration <= 4)',
+        "tour_type == 'work'",
+        '1 < duration < 4',
+        '@df.income.clip(upper=50)',
+        '@_scale * df.duration',
+    ]
+
+    compiled_spec = spec_compiler.compile_spec(exprs)
+
+    locals_dict = {'df': df, '_scale': 2}
+
+    for compiled_expr in compiled_spec:
+        result = compiled_expr.evaluate(df, {}, locals_dict)
+        if compiled_expr.expr.startswith('@'):
+            expected = eval(compiled_expr.expr[1:], {}, locals_dict)
+        else:
+            expected = df.eval(compiled_expr.expr)
+        npt.assert_array_equal(np.asanyarray(result), np.asanyarray(expected))
+
+
+def test_evaluate_into():
+
+    df = pd.DataFrame({
+        'is_worker': [True, False, True, False],
+        'income': [10, 40, 50, 70],
+        'duration': [1.0, 3.0, 5.0, 2.0],
+        'tour_type': ['work', 'shop', 'work', 'eat'],
+        'ptype': pd.Categorical([1, 2, 3, 1]),
+    })
+
+    exprs = [
+        'income',
+        'is_worker',
+        '(income >= 30) & (income < 60)',
+        'duration * 2',
+        '1',
+        "tour_type == 'work'",
+        'ptype == 1',
+        '@df.income.clip(upper=50)',
+    ]
+
+    compiled_spec = spec_compiler.compile_spec(exprs)
+    locals_dict = {'df': df}
+
+    expression_values = np.full((len(exprs), len(df)), np.nan)
+    compiled_spec.evaluate_into(df, expression_values, {}, locals_dict)
+
+    for values, compiled_expr in zip(expression_values, compiled_spec):
+        expected = compiled_expr.evaluate(df, {}, locals_dict)
+        npt.assert_array_equal(values, np.broadcast_to(expected, values.shape).astype(float))
+
+
+def test_numexpr_falls_back_to_pandas():
+
+    df = pd.DataFrame({'ptype': pd.Categorical([1, 2, 3, 1])})
+    df.index.name = 'person_id'
+
+    compiled_spec = spec_compiler.compile_spec(['ptype == 1', 'person_id > 1'])
+
+    npt.assert_array_equal(compiled_spec.expressions[0].evaluate(df), [True, False, False, True])
+    npt.assert_array_equal(compiled_spec.expressions[1].evaluate(df), [False, False, True, True])
+
+
+def test_referenced_names():
+
+    compiled_spec = spec_compiler.compile_spec([
+        'income > 30',
+        "@df.dist.clip(upper=5) * df['is_worker']",
+        "_DIST@skims['DIST']",
+    ])
+
+    assert set(['income', 'dist', 'is_worker', 'DIST']) <= \
+        compiled_spec.referenced_names()
+
+    # df passed to a function might access any column
+    assert spec_compiler.compile_spec(['@my_func(df)']).referenced_names() is None
+
+    # column name in a variable might be any column
+    assert spec_compiler.compile_spec(['@df[col_name] > 0']).referenced_names() is None
+
+    # unless it is a known string constant
+    assert 'origin' in spec_compiler.compile_spec(['@df[col_name] > 0']) \
+        .referenced_names({'col_name': 'origin'})
+    assert spec_compiler.compile_spec(['@df[col_name] > 0']) \
+        .referenced_names({'col_name': 3}) is None
@@ -3,6 +3,7 @@
 
 from builtins import range
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
 import pandas.util.testing as pdt
 import pytest
@@ -184,3 +185,63 @@ def test_basic(persons, tdd_alts):
     ends = pd.Series([10, 10, 10, 9])
     periods_available = timetable.remaining_periods_available(person_ids, starts, ends)
     pdt.assert_series_equal(periods_available, pd.Series([6, 3, 4, 3]))
+
+
+def test_packed_windows():
+
+    # more periods than fit in one packed word
+    periods = list(range(1, 50))
+    tdd_alts = pd.DataFrame(
+        data=[[start, end] for start in periods for end in periods if end >= start],
+        columns=['start', 'end'])
+    tdd_alts['duration'] = tdd_alts.end - tdd_alts.start
+
+    persons = pd.DataFrame(index=list(range(200)))
+    person_windows = tt.create_timetable_windows(persons, tdd_alts)
+    timetable = tt.TimeTable(person_windows, tdd_alts, 'person_windows')
+
+    assert timetable.bits.shape == (200, 3)
+
+    # schedule some short tours
+    rng = np.random.RandomState(0)
+    short_tdds = tdd_alts.index[tdd_alts.duration < 6].values
+    for i in range(4):
+        person_ids = pd.Series(persons.index)
+        tdds = pd.Series(rng.choice(short_tdds, len(person_ids)))
+        available = timetable.tour_available(person_ids, tdds)
+        timetable.assign(person_ids[available], tdds[available])
+
+    windows = timetable.windows
+    npt.assert_array_equal(tt.unpack_windows(tt.pack_windows(windows), windows.shape[1]), windows)
+    npt.assert_array_equal(timetable.get_windows_df().values, windows)
+
+    # - tour_available should agree with unpacked COLLISION_LIST test
+    person_ids = pd.Series(rng.choice(persons.index, 5000))
+    tdds = pd.Series(rng.choice(tdd_alts.index, 5000))
+    x = timetable.tdd_footprints[tdds.values] + (windows[person_ids.values] << tt.I_BIT_SHIFT)
+    expected = ~np.isin(x, tt.COLLISION_LIST).any(axis=1)
+    npt.assert_array_equal(timetable.tour_available(person_ids, tdds).values, expected)
+
+    # - available_tdds should agree with tour_available
+    person_ids = pd.Series(persons.index)
+    row_positions, tdds = timetable.available_tdds(person_ids)
+    all_person_ids = pd.Series(np.repeat(person_ids.values, len(tdd_alts)))
+    all_tdds = pd.Series(np.tile(tdd_alts.index.values, len(person_ids)))
+    available = timetable.tour_available(all_person_ids, all_tdds).values
+    npt.assert_array_equal(person_ids.values[row_positions], all_person_ids[available].values)
+    npt.assert_array_equal(tdds, all_tdds[available].values)
+
+    # - adjacent window run lengths should agree with unpacked windows
+    person_ids = pd.Series(rng.choice(persons.index, 500))
+    periods = pd.Series(rng.choice(periods, 500))
+
+    after = timetable.adjacent_window_after(person_ids, periods)
+    before = timetable.adjacent_window_before(person_ids, periods)
+
+    for person_id, period, a, b in zip(person_ids, periods, after, before):
+        # padding periods not available
+        available = windows[person_id] != tt.I_MIDDLE
+        available[[0, -1]] = False
+        col = timetable.time_ix[period]
+        assert a == np.argmin(available[col + 1:])
+        assert b == np.argmin(available[:col][::-1])
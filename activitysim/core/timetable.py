@@ -43,6 +43,20 @@ COLLISIONS = [
 
 COLLISION_LIST = [a + (b << I_BIT_SHIFT) for a, b in COLLISIONS]
 
+# TimeTable packs window states into uint64 words with I_BIT_SHIFT bits per time period
+# so 21 periods per word, with period k of each word in bits 3k (middle), 3k+1 (start), 3k+2 (end)
+PERIODS_PER_WORD = 64 // I_BIT_SHIFT
+PERIOD_SHIFTS = (np.arange(PERIODS_PER_WORD) * I_BIT_SHIFT).astype(np.uint64)
+STATE_MASK = np.uint64(I_MIDDLE)
+
+# low bit of each period's state bits (e.g. the I_MIDDLE state bit)
+PERIOD_BITS = np.uint64(sum(1 << (k * I_BIT_SHIFT) for k in range(PERIODS_PER_WORD)))
+
+# PERIOD_BITS of the first n periods of a word
+LOW_PERIOD_BITS = np.array(
+    [sum(1 << (k * I_BIT_SHIFT) for k in range(n)) for n in range(PERIODS_PER_WORD + 1)],
+    dtype=np.uint64)
+
 
 # str versions of time windows period states
 C_EMPTY = str(I_EMPTY)
@@ -170,6 +184,84 @@ def create_timetable_windows(rows, tdd_alts):
     return df
 
 
+def pack_windows(windows):
+    """
+    pack array of window states (one column per time period) into uint64 words
+
+    Parameters
+    ----------
+    windows : numpy.ndarray
+        int array of window states with one row per window and one column per time period
+
+    Returns
+    -------
+    bits : numpy.ndarray
+        uint64 array with one row per window and one column per PERIODS_PER_WORD time periods
+    """
+
+    num_rows, num_periods = windows.shape
+    num_words = -(-num_periods // PERIODS_PER_WORD)
+
+    padded = np.zeros((num_rows, num_words * PERIODS_PER_WORD), dtype=np.uint64)
+    padded[:, :num_periods] = windows
+    padded = padded.reshape(num_rows, num_words, PERIODS_PER_WORD)
+
+    return np.bitwise_or.reduce(padded << PERIOD_SHIFTS, axis=2)
+
+
+def unpack_windows(bits, num_periods, dtype=np.int8):
+    """
+    unpack uint64 words packed by pack_windows into array of window states
+
+    Parameters
+    ----------
+    bits : numpy.ndarray
+        uint64 array with one row per window
+    num_periods : int
+        number of time periods
+    dtype : numpy dtype
+
+    Returns
+    -------
+    windows : numpy.ndarray
+        array of window states with one row per window and one column per time period
+    """
+
+    num_rows, num_words = bits.shape
+
+    windows = (bits[:, :, np.newaxis] >> PERIOD_SHIFTS) & STATE_MASK
+    windows = windows.reshape(num_rows, num_words * PERIODS_PER_WORD)[:, :num_periods]
+
+    return windows.astype(dtype)
+
+
+def popcount(bits):
+    """
+    number of set bits in each element of uint64 array
+    """
+
+    bits = bits - ((bits >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    bits = (bits & np.uint64(0x3333333333333333)) + \
+        ((bits >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    bits = (bits + (bits >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+
+    return ((bits * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
+def period_planes(bits):
+    """
+    return middle, start, and end bits of each period's state aligned to PERIOD_BITS
+
+    I_MIDDLE has all three bits set, I_START_END has start and end bits set
+    """
+
+    middle = bits & PERIOD_BITS
+    start = (bits >> np.uint64(1)) & PERIOD_BITS
+    end = (bits >> np.uint64(2)) & PERIOD_BITS
+
+    return middle, start, end
+
+
 class TimeTable(object):
     """
     ::
@@ -180,6 +272,9 @@ class TimeTable(object):
       5      6    ==>  0   2   4   0   0 ...
       5      7    ==>  0   2   7   4   0 ...
 
+    Windows (and tdd footprints) are stored packed into uint64 words (see pack_windows) so that
+    tests like tour_available are a few bitwise operations per window row (rather than per period)
+    The windows property and get_windows_df unpack them into the usual one column per period form.
     """
 
     def __init__(self, windows_df, tdd_alts_df, table_name=None):
@@ -194,8 +289,12 @@ class TimeTable(object):
 
         self.windows_table_name = table_name
 
-        self.windows_df = windows_df
-        self.windows = self.windows_df.values
+        self.windows_index = windows_df.index
+        self.windows_columns = windows_df.columns
+        self.windows_dtype = windows_df.values.dtype
+        self.num_periods = len(windows_df.columns)
+
+        self.bits = pack_windows(windows_df.values)
 
         # series to map window row index value to window row's ordinal index
         self.window_row_ix = pd.Series(list(range(len(windows_df.index))), index=windows_df.index)
@@ -217,14 +316,35 @@ class TimeTable(object):
         # we want range index so we can use raw numpy
         assert (tdd_alts_df.index == list(range(tdd_alts_df.shape[0]))).all()
         self.tdd_footprints = np.asanyarray([list(r) for r in w_strings]).astype(int)
+        self.tdd_footprint_bits = pack_windows(self.tdd_footprints)
+
+        # tdd alt id for each (start, end) time col ix pair, or -1 if there is no such alt
+        self.tdd_ids = np.full((self.num_periods, self.num_periods), -1, dtype=int)
+        self.tdd_ids[tdd_alts_df.start.map(self.time_ix).values,
+                     tdd_alts_df.end.map(self.time_ix).values] = tdd_alts_df.index.values
+
+    @property
+    def windows(self):
+        """
+        unpacked (read only) copy of windows array with one column per time period
+        """
+        return unpack_windows(self.bits, self.num_periods, self.windows_dtype)
+
+    def slice_bits_by_row_id(self, window_row_ids):
+        """
+        return packed windows slice containing rows for specified window_row_ids
+        """
+        row_ixs = window_row_ids.map(self.window_row_ix).values
+
+        return self.bits[row_ixs]
 
     def slice_windows_by_row_id(self, window_row_ids):
         """
         return windows array slice containing rows for specified window_row_ids
         (in window_row_ids order)
         """
-        row_ixs = window_row_ids.map(self.window_row_ix).values
-        windows = self.windows[row_ixs]
+        windows = unpack_windows(self.slice_bits_by_row_id(window_row_ids),
+                                 self.num_periods, self.windows_dtype)
 
         return windows
 
@@ -236,18 +356,16 @@ class TimeTable(object):
         # col ixs of periods in windows
         time_col_ixs = periods.map(self.time_ix).values
 
-        windows = self.windows[row_ixs, time_col_ixs]
+        words = self.bits[row_ixs, time_col_ixs // PERIODS_PER_WORD]
+        windows = (words >> PERIOD_SHIFTS[time_col_ixs % PERIODS_PER_WORD]) & STATE_MASK
 
-        return windows
+        return windows.astype(self.windows_dtype)
 
     def get_windows_df(self):
 
-        # It appears that assignments into windows write through to underlying pandas table.
-        # because we set windows = windows_df.values, and since all the columns are the same type
-        # so no need to refresh pandas dataframe, but if we had to it would go here
-
-        # assert (self.windows_df.values == self.windows).all()
-        return self.windows_df
+        return pd.DataFrame(data=self.windows,
+                            index=self.windows_index,
+                            columns=self.windows_columns)
 
     def replace_table(self):
         """
@@ -261,8 +379,7 @@ class TimeTable(object):
 
         assert self.windows_table_name is not None
 
-        # get windows_df from bottleneck function in case updates to self.person_window
-        # do not write through to pandas dataframe
+        # updates to packed windows do not write through to pandas dataframe
         pipeline.replace_table(self.windows_table_name, self.get_windows_df())
 
     def tour_available(self, window_row_ids, tdds):
@@ -284,20 +401,89 @@ class TimeTable(object):
 
         assert len(window_row_ids) == len(tdds)
 
-        # numpy array with one tdd_footprints_df row for tdds
-        tour_footprints = self.tdd_footprints[tdds.values.astype(int)]
+        # packed tdd footprint and window words for each row
+        tour_middle, tour_start, tour_end = \
+            period_planes(self.tdd_footprint_bits[tdds.values.astype(int)])
+        window_middle, window_start, window_end = \
+            period_planes(self.slice_bits_by_row_id(window_row_ids))
+
+        # bitwise version of COLLISIONS:
+        # a middle period collides with any scheduled period,
+        # and a (not START_END) start or end collides with the same
+        collisions = \
+            (tour_middle & (window_start | window_end)) | \
+            (window_middle & (tour_start | tour_end)) | \
+            (tour_start & ~tour_end & window_start & ~window_end) | \
+            (tour_end & ~tour_start & window_end & ~window_start)
+
+        available = ~collisions.any(axis=1)
+        available = pd.Series(available, index=window_row_ids.index)
+
+        return available
+
+    def available_tdds(self, window_row_ids):
+        """
+        Return the tdd alts available for each window row (the same tdds for which tour_available
+        would be True) without testing every tdd alt for every row.
+
+        A tour can start in a period that is empty or where another tour ends, can end in a period
+        that is empty or where another tour starts, and every period between start and end must be
+        empty. So the available ends for each start are the run of empty periods after the start,
+        plus the period after that if a tour starts there. Zero duration tours only require that
+        the period is not in the middle of another tour.
+
+        Parameters
+        ----------
+        window_row_ids : pandas Series
+            series of window_row_ids indexed by tour_id
+
+        Returns
+        -------
+        row_positions : numpy.ndarray of int
+            position in window_row_ids of each available (window row, tdd) pair
+        tdds : numpy.ndarray of int
+            tdd alt id of each available (window row, tdd) pair, in tdd order for each row
+        """
 
-        # numpy array with one windows row for each person
         windows = self.slice_windows_by_row_id(window_row_ids)
+        num_rows, num_cols = windows.shape
 
-        # t0 = tracing.print_elapsed_time("slice_windows_by_row_id", t0, debug=True)
+        can_start = np.isin(windows, [I_EMPTY, I_END, I_START_END])
+        can_end = np.isin(windows, [I_EMPTY, I_START, I_START_END])
+        can_start_end = (windows != I_MIDDLE)
 
-        x = tour_footprints + (windows << I_BIT_SHIFT)
+        # number of consecutive empty periods starting with each period (plus one past the end)
+        empty_run = np.zeros((num_rows, num_cols + 1), dtype=int)
+        for col in range(num_cols - 1, -1, -1):
+            empty_run[:, col] = (empty_run[:, col + 1] + 1) * (windows[:, col] == I_EMPTY)
 
-        available = ~np.isin(x, COLLISION_LIST).any(axis=1)
-        available = pd.Series(available, index=window_row_ids.index)
+        # last period in which a tour starting in each period could end
+        cols = np.arange(num_cols)
+        last_end = cols + empty_run[:, 1:]
+        can_end_after_run = np.take_along_axis(
+            np.hstack([can_end, np.zeros((num_rows, 1), dtype=bool)]),
+            np.minimum(last_end + 1, num_cols), axis=1)
+        last_end = np.where(can_end_after_run, last_end + 1, last_end)
 
-        return available
+        # range of available end periods for each start period
+        first_end = np.where(can_start_end, cols, cols + 1).ravel()
+        last_end = np.where(can_start, last_end, cols).ravel()
+        num_ends = np.clip(last_end - first_end + 1, 0, None)
+
+        # - one (row, start, end) for each available end of each start
+        row_positions = np.repeat(np.repeat(np.arange(num_rows), num_cols), num_ends)
+        starts = np.repeat(np.tile(cols, num_rows), num_ends)
+        ends = np.repeat(first_end, num_ends) + \
+            np.arange(num_ends.sum()) - np.repeat(np.cumsum(num_ends) - num_ends, num_ends)
+
+        # not every (start, end) pair is a tdd alt
+        tdds = self.tdd_ids[starts, ends]
+        row_positions = row_positions[tdds >= 0]
+        tdds = tdds[tdds >= 0]
+
+        order = np.lexsort((tdds, row_positions))
+
+        return row_positions[order], tdds[order]
 
     def assign(self, window_row_ids, tdds):
         """
@@ -319,13 +505,13 @@ class TimeTable(object):
         # vectorization doesn't work duplicates
         assert len(window_row_ids.index) == len(np.unique(window_row_ids.values))
 
-        # numpy array with one time window row for each person tdd
-        tour_footprints = self.tdd_footprints[tdds.values.astype(int)]
+        # packed time window row for each person tdd
+        tour_footprints = self.tdd_footprint_bits[tdds.values.astype(int)]
 
         # row idxs of windows to assign to
         row_ixs = window_row_ids.map(self.window_row_ix).values
 
-        self.windows[row_ixs] = np.bitwise_or(self.windows[row_ixs], tour_footprints)
+        self.bits[row_ixs] = np.bitwise_or(self.bits[row_ixs], tour_footprints)
 
     def assign_subtour_mask(self, window_row_ids, tdds):
         """
@@ -353,7 +539,7 @@ class TimeTable(object):
 
         assert len(window_row_ids) == len(tdds)
 
-        self.windows.fill(0)
+        self.bits.fill(0)
         self.assign(window_row_ids, tdds)
 
         # numpy array with one time window row for each person tdd
@@ -362,7 +548,7 @@ class TimeTable(object):
         # row idxs of windows to assign to
         row_ixs = window_row_ids.map(self.window_row_ix).values
 
-        self.windows[row_ixs] = (tour_footprints == 0) * I_MIDDLE
+        self.bits[row_ixs] = pack_windows((tour_footprints == 0) * I_MIDDLE)
 
     def assign_footprints(self, window_row_ids, footprints):
         """
@@ -382,7 +568,7 @@ class TimeTable(object):
         assert len(window_row_ids) == footprints.shape[0]
 
         # require same number of periods in footprints
-        assert self.windows.shape[1] == footprints.shape[1]
+        assert self.num_periods == footprints.shape[1]
 
         # vectorization doesn't work with duplicate row_ids
         assert len(window_row_ids.values) == len(np.unique(window_row_ids.values))
@@ -390,7 +576,7 @@ class TimeTable(object):
         # row idxs of windows to assign to
         row_ixs = window_row_ids.map(self.window_row_ix).values
 
-        self.windows[row_ixs] = np.bitwise_or(self.windows[row_ixs], footprints)
+        self.bits[row_ixs] = np.bitwise_or(self.bits[row_ixs], pack_windows(footprints))
 
     def pairwise_available(self, window1_row_ids, window2_row_ids):
 
@@ -423,32 +609,44 @@ class TimeTable(object):
 
         time_col_ixs = periods.map(self.time_ix).values
 
-        # sliced windows with 1s where windows state is I_MIDDLE and 0s elsewhere
-        available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE) * 1
+        # packed bits with I_MIDDLE state bit set for unavailable periods
+        unavailable = self.slice_bits_by_row_id(window_row_ids) & PERIOD_BITS
 
         # padding periods not available
-        available[:, 0] = 0
-        available[:, -1] = 0
+        num_rows, num_words = unavailable.shape
+        num_cols = self.num_periods
+        last_word, last_period = divmod(num_cols - 1, PERIODS_PER_WORD)
+        unavailable[:, 0] |= np.uint64(1)
+        unavailable[:, last_word] |= np.uint64(1) << PERIOD_SHIFTS[last_period]
+
+        # col ix of first period in each word
+        word_col_ixs = np.arange(num_words) * PERIODS_PER_WORD
 
-        # column idxs of windows
-        num_rows, num_cols = available.shape
-        time_col_ix_map = np.tile(np.arange(0, num_cols), num_rows).reshape(num_rows, num_cols)
-        # 0 1 2 3 4 5...
-        # 0 1 2 3 4 5...
-        # 0 1 2 3 4 5...
+        # number of periods in each word before (or up to and including) specified time
+        low_periods = np.clip(time_col_ixs.reshape(num_rows, 1) - word_col_ixs + (not before),
+                              0, PERIODS_PER_WORD)
 
         if before:
-            # ones after specified time, zeroes before
-            before_mask = (time_col_ix_map < time_col_ixs.reshape(num_rows, 1)) * 1
-            # index of first unavailable window after time
-            first_unavailable = np.where((1-available)*before_mask, time_col_ix_map, 0).max(axis=1)
+            # unavailable periods before time
+            masked = unavailable & LOW_PERIOD_BITS[low_periods]
+            # smear highest bit to the right so popcount gives its position
+            smeared = masked
+            for shift in [1, 2, 4, 8, 16, 32]:
+                smeared = smeared | (smeared >> np.uint64(shift))
+            period_in_word = (popcount(smeared) - 1) // I_BIT_SHIFT
+            # index of last unavailable window before time
+            first_unavailable = \
+                np.where(masked != 0, word_col_ixs + period_in_word, 0).max(axis=1)
             available_run_length = time_col_ixs - first_unavailable - 1
         else:
-            # ones after specified time, zeroes before
-            after_mask = (time_col_ix_map > time_col_ixs.reshape(num_rows, 1)) * 1
+            # unavailable periods after time
+            masked = unavailable & (PERIOD_BITS ^ LOW_PERIOD_BITS[low_periods])
+            # isolate lowest bit so popcount of the bits below it gives its position
+            lowest = masked & (~masked + np.uint64(1))
+            period_in_word = popcount(lowest - np.uint64(1)) // I_BIT_SHIFT
             # index of first unavailable window after time
             first_unavailable = \
-                np.where((1 - available) * after_mask, time_col_ix_map, num_cols).min(axis=1)
+                np.where(masked != 0, word_col_ixs + period_in_word, num_cols).min(axis=1)
             available_run_length = first_unavailable - time_col_ixs - 1
 
         return pd.Series(available_run_length, index=window_row_ids.index)
@@ -594,7 +792,9 @@ class TimeTable(object):
         assert len(window_row_ids) == len(starts)
         assert len(window_row_ids) == len(ends)
 
-        available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE).sum(axis=1)
+        # count periods with I_MIDDLE state bit set
+        unavailable = popcount(self.slice_bits_by_row_id(window_row_ids) & PERIOD_BITS).sum(axis=1)
+        available = self.num_periods - unavailable
 
         # don't count time window padding at both ends of day
         available -= 2